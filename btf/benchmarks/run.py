@@ -0,0 +1,191 @@
+import io
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import contextlib
+import multiprocessing
+
+from . import synthetic
+
+try:
+	import resource
+except ImportError: # not available on Windows, peak RSS is then not reported
+	resource = None
+
+"""
+Benchmarks of the piece analysis and peer decoding engines on synthetic data. Each benchmark runs in a fresh
+process so its peak RSS is its own. Results are saved as JSON and can be compared against a stored baseline.
+"""
+
+# name: (parameters, parameters with --quick)
+BENCHMARKS = {
+	'pieces_from_hex': ({'size': 32, 'piece_length': 256}, {'size': 4, 'piece_length': 256}),
+	'piece_analysis_single': ({'size': 256, 'piece_length': 256, 'files': 1}, {'size': 16, 'piece_length': 256, 'files': 1}),
+	'piece_analysis_multi': ({'size': 256, 'piece_length': 64, 'files': 200, 'missing': 5, 'truncated': 5},
+		{'size': 16, 'piece_length': 64, 'files': 40, 'missing': 2, 'truncated': 2}),
+	'piece_analysis_hybrid': ({'size': 256, 'piece_length': 256, 'files': 8, 'version': 'hybrid'},
+		{'size': 16, 'piece_length': 64, 'files': 8, 'version': 'hybrid'}),
+	'dht_peers_from_hex': ({'records': 200000}, {'records': 20000}),
+	'resume_peers_from_hex': ({'records': 200000}, {'records': 20000}),
+	'dht_nodes_from_dat': ({'records': 200000}, {'records': 20000}),
+	'resume_peers_from_dat': ({'torrents': 5000, 'peers': 20}, {'torrents': 500, 'peers': 20}),
+	'peer_store': ({'records': 500000, 'torrents': 5000, 'peers': 20}, {'records': 20000, 'torrents': 500, 'peers': 20})
+}
+
+THROUGHPUT_METRICS = {'mb_per_second': 'MB/s', 'pieces_per_second': 'pieces/s', 'records_per_second': 'records/s'}
+
+def _setup(name, params, directory):
+	"""
+	Generate the inputs of a benchmark in directory, outside of the timed code
+	"""
+	if name == 'pieces_from_hex':
+		synthetic.make_torrent(directory, size=params['size'] * 1024 * 1024, piece_length=params['piece_length'] * 1024)
+	elif name.startswith('piece_analysis'):
+		synthetic.make_torrent(directory, size=params['size'] * 1024 * 1024, piece_length=params['piece_length'] * 1024,
+			files=params['files'], missing=params.get('missing', 0), truncated=params.get('truncated', 0), version=params.get('version', 1))
+	elif name == 'dht_nodes_from_dat':
+		synthetic.make_dht_dat(os.path.join(directory, 'dht.dat'), params['records'])
+	elif name == 'resume_peers_from_dat':
+		synthetic.make_resume_dat(os.path.join(directory, 'resume.dat'), params['torrents'], params['peers'], params['peers'])
+	elif name == 'peer_store':
+		synthetic.make_dht_dat(os.path.join(directory, 'dht.dat'), params['records'])
+		synthetic.make_resume_dat(os.path.join(directory, 'resume.dat'), params['torrents'], params['peers'], params['peers'])
+
+def _run(name, params, directory):
+	"""
+	Run one benchmark in the current (fresh) process
+	:returns: dict of measurements
+	"""
+	from ..bittorrent import pieces
+	from ..bittorrent.metainfo import Metainfo
+	from ..utorrent import dht, resume, correlation
+
+	result = dict()
+	if name == 'pieces_from_hex':
+		metainfo = Metainfo.from_file(os.path.join(directory, 'synthetic.torrent'))
+		with open(os.path.join(directory, 'synthetic.bin'), 'rb') as data_file: data_hex = data_file.read().hex()
+		hashes = [x.hex() for x in metainfo.pieces]
+		started = time.perf_counter()
+		pieces.get_table_from_pieces(data_hex, hashes, metainfo.piece_length * 2, silent=True)
+		result['bytes'] = metainfo.total_length
+		result['pieces'] = len(hashes)
+	elif name.startswith('piece_analysis'):
+		torrent_path = os.path.join(directory, 'synthetic.torrent')
+		content_path = os.path.join(directory, 'synthetic' if params['files'] > 1 else 'synthetic.bin')
+		metainfo = Metainfo.from_file(torrent_path)
+		started = time.perf_counter()
+		with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+			pieces._perform_piece_analysis(torrent_path, content_path, os.path.join(directory, 'out.csv'), silent=True)
+		result['bytes'] = metainfo.total_length
+		result['pieces'] = len(metainfo.pieces)
+	elif name in ('dht_peers_from_hex', 'resume_peers_from_hex'):
+		module, record_size = (dht, 26) if name.startswith('dht') else (resume, 18)
+		data_hex = synthetic.make_peers_hex(record_size, params['records'])
+		started = time.perf_counter()
+		module.get_peers_from_hex(data_hex)
+		result['records'] = params['records']
+	elif name == 'dht_nodes_from_dat':
+		started = time.perf_counter()
+		result['records'] = len(dht.get_nodes_from_dat(os.path.join(directory, 'dht.dat')))
+	elif name == 'resume_peers_from_dat':
+		started = time.perf_counter()
+		result['records'] = len(resume.get_peers_from_dat(os.path.join(directory, 'resume.dat')))
+	elif name == 'peer_store':
+		started = time.perf_counter()
+		with correlation.PeerStore(os.path.join(directory, 'peers.db')) as store:
+			result['records'] = store.add_paths([directory], silent=True)[1]
+			queries = [{'networks': ['203.0.113.0/24'], 'ports': [6881]}, {'networks': ['198.51.100.7']}, {'ports': [6881]}, {'networks': ['2001:db8::/32']}]
+			query_started = time.perf_counter()
+			for query in queries: store.query_artifacts(**query)
+			result['query_ms'] = (time.perf_counter() - query_started) * 1000 / len(queries)
+	else:
+		raise ValueError(f"Unknown benchmark '{name}'")
+
+	result['seconds'] = time.perf_counter() - started
+	if resource is not None:
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		result['peak_rss_mb'] = peak / (1024 * 1024 if sys.platform == 'darwin' else 1024) # bytes on macOS, KiB elsewhere
+	return result
+
+def run_benchmark(name, params, repeat=1):
+	"""
+	Generate inputs and run a benchmark repeat times, each run in a new process
+	:returns: dict of measurements of the fastest run with derived throughputs
+	"""
+	context = multiprocessing.get_context('spawn')
+	with tempfile.TemporaryDirectory() as directory:
+		_setup(name, params, directory)
+		runs = list()
+		for _ in range(repeat):
+			pool = context.Pool(1)
+			try:
+				runs.append(pool.apply(_run, (name, params, directory)))
+			finally:
+				pool.close()
+				pool.join()
+
+	result = min(runs, key=lambda x: x['seconds'])
+	result['parameters'] = params
+	seconds = max(result['seconds'], 1e-9)
+	if 'bytes' in result: result['mb_per_second'] = result['bytes'] / seconds / (1024 * 1024)
+	if 'pieces' in result: result['pieces_per_second'] = result['pieces'] / seconds
+	if 'records' in result: result['records_per_second'] = result['records'] / seconds
+	return result
+
+def compare(results, baseline, tolerance=0.2):
+	"""
+	Compare benchmark results to a baseline, a throughput more than tolerance (as a fraction) below the baseline is
+	a regression. Benchmarks run with different parameters are not compared.
+	:returns: list of (benchmark, metric, baseline value, current value) regressions
+	"""
+	regressions = list()
+	for name, current in results['benchmarks'].items():
+		previous = baseline.get('benchmarks', dict()).get(name)
+		if previous is None or previous.get('parameters') != current.get('parameters'): continue
+		for metric in THROUGHPUT_METRICS:
+			if metric in current and metric in previous and current[metric] < previous[metric] * (1 - tolerance):
+				regressions.append((name, metric, previous[metric], current[metric]))
+	return regressions
+
+def main():
+	parser = argparse.ArgumentParser(description='Run BitTorrent Forensics benchmarks on synthetic data')
+	parser.add_argument('-b', '--benchmark', help='Benchmark(s) to run (default: all)', nargs='+', choices=list(BENCHMARKS))
+	parser.add_argument('-o', '--out', help='JSON file to save results to')
+	parser.add_argument('--baseline', help='JSON results to compare against, exits with status 1 on a regression')
+	parser.add_argument('--tolerance', help='Allowed throughput drop against the baseline, as a fraction', type=float, default=0.2)
+	parser.add_argument('--repeat', help='Number of runs per benchmark, the fastest is kept', type=int, default=3)
+	parser.add_argument('--quick', help='Use small inputs', action='store_true', default=False)
+	args = parser.parse_args()
+
+	results = {
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'cpus': os.cpu_count(),
+		'quick': args.quick,
+		'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'benchmarks': dict()
+	}
+
+	for name in args.benchmark or BENCHMARKS:
+		params = BENCHMARKS[name][1 if args.quick else 0]
+		result = run_benchmark(name, params, args.repeat)
+		results['benchmarks'][name] = result
+		rates = ', '.join(f'{result[x]:,.1f} {unit}' for x, unit in THROUGHPUT_METRICS.items() if x in result)
+		rss = f", peak RSS {result['peak_rss_mb']:.1f} MB" if 'peak_rss_mb' in result else ''
+		print(f"{name:<24} {result['seconds']:8.3f}s  {rates}{rss}")
+
+	if args.out:
+		with open(args.out, 'w') as out_file: json.dump(results, out_file, indent=2)
+
+	if args.baseline:
+		with open(args.baseline, 'r') as baseline_file: baseline = json.load(baseline_file)
+		regressions = compare(results, baseline, args.tolerance)
+		for name, metric, previous, current in regressions:
+			print(f'REGRESSION {name} {metric}: {previous:,.1f} -> {current:,.1f}')
+		if regressions: sys.exit(1)
+
+if __name__ == '__main__': main()
@@ -0,0 +1,143 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+
+from . import synthetic
+
+"""
+Startup benchmark of the command line entry point. Every subcommand is run on tiny synthetic inputs under
+python -X importtime, so the time spent importing modules (and which modules were loaded at all) is tracked
+separately from the work done. Results are saved as JSON and can be compared against a stored baseline.
+"""
+
+# modules that should only be loaded by the subcommands that need them
+HEAVY_MODULES = ['tqdm', 'tabulate', 'colorama', 'multiprocessing', 'concurrent.futures', 'sqlite3']
+
+# name: function of the folder with the synthetic inputs returning the command line arguments
+SUBCOMMANDS = {
+	'help': lambda d: ['--help'],
+	'torrent-piece-analysis': lambda d: ['torrent-piece-analysis', '-t', os.path.join(d, 'synthetic.torrent'), '-d', os.path.join(d, 'synthetic.bin'),
+		'--executor', 'serial', '--no-cache', '--silent'],
+	'torrent-library': lambda d: ['torrent-library', '-i', os.path.join(d, 'library.db'), '-a', os.path.join(d, 'synthetic.torrent'), '--silent'],
+	'torrent-carve': lambda d: ['torrent-carve', '-t', os.path.join(d, 'synthetic.torrent'), '-i', os.path.join(d, 'synthetic.bin'),
+		'--executor', 'serial', '--silent'],
+	'scan': lambda d: ['scan', '-r', d, '-o', os.path.join(d, 'case.sqlite'), '--no-verify', '--workers', '1', '--silent'],
+	'uTorrent-dht-nodes': lambda d: ['uTorrent-dht-nodes', '-d', os.path.join(d, 'dht.dat'), '--silent'],
+	'uTorrent-resume-peers': lambda d: ['uTorrent-resume-peers', '-d', os.path.join(d, 'resume.dat'), '--silent'],
+	'peer-query': lambda d: ['peer-query', '-i', os.path.join(d, 'peers.db'), '-a', os.path.join(d, 'dht.dat'), '--port', '6881', '--silent']
+}
+
+METRICS = ['import_seconds', 'wall_seconds']
+
+def parse_importtime(text):
+	"""
+	Parse the stderr of python -X importtime
+	:returns: list of (module, self microseconds, cumulative microseconds) in import order
+	"""
+	modules = list()
+	for line in text.splitlines():
+		if not line.startswith('import time:'): continue
+		fields = line[len('import time:'):].split('|')
+		if len(fields) != 3 or not fields[0].strip().isdigit(): continue # the column header line
+		modules.append((fields[2].strip(), int(fields[0]), int(fields[1])))
+	return modules
+
+def _setup(directory):
+	"""
+	Generate the inputs shared by all subcommands in directory
+	"""
+	synthetic.make_torrent(directory, size=256 * 1024, piece_length=16 * 1024)
+	synthetic.make_dht_dat(os.path.join(directory, 'dht.dat'), 100)
+	synthetic.make_resume_dat(os.path.join(directory, 'resume.dat'), 10, 2, 2)
+
+def _command(argv, importtime=False):
+	return [sys.executable] + (['-X', 'importtime'] if importtime else list()) + ['-m', 'btf.btf'] + argv
+
+def run_startup(name, directory, repeat=1, top=10):
+	"""
+	Run a subcommand repeat times with and without -X importtime
+	:returns: dict of the fastest import and wall times, the number of modules loaded, the heavy modules and the
+	modules of this package among them and the modules with the largest self import time
+	"""
+	argv = SUBCOMMANDS[name](directory)
+	root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+	env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+
+	walls = list()
+	profiles = list()
+	for _ in range(repeat):
+		started = time.perf_counter()
+		subprocess.run(_command(argv), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+		walls.append(time.perf_counter() - started)
+
+		process = subprocess.run(_command(argv, True), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True, universal_newlines=True)
+		profiles.append(parse_importtime(process.stderr))
+
+	modules = min(profiles, key=lambda x: sum(y[1] for y in x))
+	names = set(x[0] for x in modules)
+	return {
+		'import_seconds': sum(x[1] for x in modules) / 1e6,
+		'wall_seconds': min(walls),
+		'modules': len(modules),
+		'heavy_modules': [x for x in HEAVY_MODULES if x in names],
+		'package_modules': sorted(x for x in names if x.startswith('btf.')),
+		'top_modules': [[x[0], x[1] / 1e6] for x in sorted(modules, key=lambda x: x[1], reverse=True)[:top]]
+	}
+
+def compare(results, baseline, tolerance=0.2):
+	"""
+	Compare startup results to a baseline, an import or wall time more than tolerance (as a fraction) above the
+	baseline is a regression
+	:returns: list of (subcommand, metric, baseline value, current value) regressions
+	"""
+	regressions = list()
+	for name, current in results['subcommands'].items():
+		previous = baseline.get('subcommands', dict()).get(name)
+		if previous is None: continue
+		for metric in METRICS:
+			if metric in current and metric in previous and current[metric] > previous[metric] * (1 + tolerance):
+				regressions.append((name, metric, previous[metric], current[metric]))
+	return regressions
+
+def main():
+	parser = argparse.ArgumentParser(description='Measure BitTorrent Forensics startup and import time per subcommand')
+	parser.add_argument('-s', '--subcommand', help='Subcommand(s) to run (default: all)', nargs='+', choices=list(SUBCOMMANDS))
+	parser.add_argument('-o', '--out', help='JSON file to save results to')
+	parser.add_argument('--baseline', help='JSON results to compare against, exits with status 1 on a regression')
+	parser.add_argument('--tolerance', help='Allowed increase of import and wall time against the baseline, as a fraction', type=float, default=0.2)
+	parser.add_argument('--repeat', help='Number of runs per subcommand, the fastest is kept', type=int, default=5)
+	parser.add_argument('--top', help='Number of slowest modules to list per subcommand', type=int, default=10)
+	args = parser.parse_args()
+
+	results = {
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'subcommands': dict()
+	}
+
+	with tempfile.TemporaryDirectory() as directory:
+		_setup(directory)
+		for name in args.subcommand or SUBCOMMANDS:
+			result = run_startup(name, directory, args.repeat, args.top)
+			results['subcommands'][name] = result
+			heavy = ', '.join(result['heavy_modules']) or 'none'
+			print(f"{name:<24} imports {result['import_seconds'] * 1000:7.1f} ms ({result['modules']} modules), "
+				f"wall {result['wall_seconds'] * 1000:7.1f} ms, heavy modules: {heavy}")
+
+	if args.out:
+		with open(args.out, 'w') as out_file: json.dump(results, out_file, indent=2)
+
+	if args.baseline:
+		with open(args.baseline, 'r') as baseline_file: baseline = json.load(baseline_file)
+		regressions = compare(results, baseline, args.tolerance)
+		for name, metric, previous, current in regressions:
+			print(f'REGRESSION {name} {metric}: {previous * 1000:.1f} ms -> {current * 1000:.1f} ms')
+		if regressions: sys.exit(1)
+
+if __name__ == '__main__': main()
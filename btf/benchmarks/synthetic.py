@@ -0,0 +1,193 @@
+import os
+import random
+import hashlib
+import argparse
+
+from ..bittorrent import merkle
+from ..utility import bencode
+
+"""
+Generator of synthetic torrents with content on disk and of uTorrent dht.dat/resume.dat files, for benchmarks
+and tests. Output is deterministic for a given seed.
+"""
+
+WRITE_SIZE = 4 * 1024 * 1024
+
+def _random_bytes(rng, count):
+	return rng.getrandbits(count * 8).to_bytes(count, 'little') if count > 0 else b''
+
+def get_file_sizes(size, files):
+	"""
+	Split size bytes into files sizes that differ by at most one byte
+	:returns: list of int
+	"""
+	if files <= 0: raise ValueError('Number of files must be greater than zero')
+	return [size // files + (1 if i < size % files else 0) for i in range(files)]
+
+def _get_v2_entry(length, leaves, piece_length, piece_layers):
+	"""
+	File tree entry of a file from the digests of its blocks, adding its piece layer to piece_layers
+	"""
+	if length == 0: return {'': {'length': 0}}
+	blocks = piece_length // merkle.BLOCK_SIZE
+	width = merkle.get_piece_width(length, piece_length)
+	pieces = [merkle.get_root(leaves[i:i + blocks], width) for i in range(0, len(leaves), blocks)]
+	if length <= piece_length: return {'': {'length': length, 'pieces root': pieces[0]}}
+	root = merkle.get_file_root(pieces, piece_length)
+	piece_layers[root] = b''.join(pieces)
+	return {'': {'length': length, 'pieces root': root}}
+
+def make_torrent(directory, name='synthetic', *, size=16 * 1024 * 1024, piece_length=256 * 1024, files=1, missing=0, truncated=0, seed=0, version=1):
+	"""
+	Write random content and a .torrent file describing it to directory. With files > 1 a multi-file torrent is made.
+	version is 1, 2 (BEP 52 file tree and piece layers only) or 'hybrid' (both, with v1 padding files aligning each
+	file to a piece).
+	After the piece hashes are computed, the last missing files are deleted and the truncated files before them are
+	cut to half their size, to exercise unverifiable pieces.
+	:returns: tuple of (.torrent path, content path to pass to piece analysis)
+	"""
+	if missing + truncated > files: raise ValueError('More missing and truncated files than files')
+	if version not in (1, 2, 'hybrid'): raise ValueError(f"Invalid version '{version}', must be 1, 2 or 'hybrid'")
+	rng = random.Random(seed)
+
+	sizes = get_file_sizes(size, files)
+	if files == 1:
+		content_path = os.path.join(directory, name + '.bin')
+		paths = [content_path]
+	else:
+		content_path = os.path.join(directory, name)
+		paths = [os.path.join(content_path, f'{i // 100:03d}', f'file{i:05d}.bin') for i in range(files)]
+
+	pieces = list()
+	piece = hashlib.sha1()
+	piece_size = 0
+	v1_files = list()
+	file_tree = dict()
+	piece_layers = dict()
+
+	def update(view):
+		nonlocal piece, piece_size
+		while len(view) > 0:
+			take = min(len(view), piece_length - piece_size)
+			piece.update(view[:take])
+			piece_size += take
+			view = view[take:]
+			if piece_size == piece_length:
+				pieces.append(piece.digest())
+				piece = hashlib.sha1()
+				piece_size = 0
+
+	for i, (path, file_size) in enumerate(zip(paths, sizes)):
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		parts = os.path.relpath(path, content_path).split(os.sep) if files > 1 else [os.path.basename(path)]
+		v1_files.append({'length': file_size, 'path': parts})
+		leaves = list()
+		with open(path, 'wb') as content_file:
+			remaining = file_size
+			while remaining > 0:
+				chunk = _random_bytes(rng, min(remaining, WRITE_SIZE))
+				content_file.write(chunk)
+				remaining -= len(chunk)
+				if version != 2: update(memoryview(chunk))
+				if version != 1: leaves.extend(hashlib.sha256(chunk[j:j + merkle.BLOCK_SIZE]).digest() for j in range(0, len(chunk), merkle.BLOCK_SIZE))
+
+		if version != 1:
+			node = file_tree
+			for part in parts[:-1]: node = node.setdefault(part, dict())
+			node[parts[-1]] = _get_v2_entry(file_size, leaves, piece_length, piece_layers)
+		padding = -file_size % piece_length
+		if version == 'hybrid' and i < files - 1 and padding > 0:
+			update(memoryview(bytes(padding)))
+			v1_files.append({'attr': 'p', 'length': padding, 'path': ['.pad', str(padding)]})
+	if piece_size > 0: pieces.append(piece.digest())
+
+	info = {'name': os.path.basename(content_path), 'piece length': piece_length}
+	if version != 2:
+		info['pieces'] = b''.join(pieces)
+		if files == 1:
+			info['length'] = size
+		else:
+			info['files'] = v1_files
+	if version != 1:
+		info['meta version'] = 2
+		info['file tree'] = file_tree
+
+	metainfo = {'announce': 'http://tracker.invalid/announce', 'info': info}
+	if piece_layers: metainfo['piece layers'] = piece_layers
+	torrent_path = os.path.join(directory, name + '.torrent')
+	with open(torrent_path, 'wb') as torrent_file:
+		torrent_file.write(bencode.encode(metainfo))
+
+	for path in paths[files - missing:]: os.remove(path)
+	for path, file_size in list(zip(paths, sizes))[files - missing - truncated:files - missing]:
+		os.truncate(path, file_size // 2)
+
+	return torrent_path, content_path
+
+def make_peers_hex(record_size, count, seed=0):
+	"""
+	Random 0x prefixed hex string of count records, as pasted into the hex based subcommands
+	"""
+	return '0x' + _random_bytes(random.Random(seed), record_size * count).hex()
+
+def make_dht_dat(path, nodes=10000, seed=0):
+	"""
+	Write a dht.dat file with the given number of nodes
+	"""
+	rng = random.Random(seed)
+	with open(path, 'wb') as dat_file:
+		dat_file.write(bencode.encode({
+			'age': 1600000000,
+			'id': _random_bytes(rng, 20),
+			'ip': _random_bytes(rng, 4),
+			'nodes': _random_bytes(rng, 26 * nodes),
+			'port': 6881
+		}))
+
+def make_resume_dat(path, torrents=1000, peers6=20, peers=20, seed=0):
+	"""
+	Write a resume.dat file with the given number of torrent entries, each with peers6 and peers records and
+	the other keys uTorrent stores, so that walking the file costs what it does on a real profile
+	"""
+	rng = random.Random(seed)
+	resume = {'.fileguard': _random_bytes(rng, 20).hex().upper(), 'rec': {'mode': 0}}
+	for i in range(torrents):
+		resume[f'torrent{i:06d}.torrent'] = {
+			'added_on': 1600000000 + i,
+			'caption': f'Synthetic torrent {i}',
+			'downloaded': rng.getrandbits(32),
+			'have': _random_bytes(rng, 128),
+			'info': _random_bytes(rng, 20),
+			'path': f'C:\\Users\\user\\Downloads\\synthetic{i}',
+			'peers': _random_bytes(rng, 6 * peers),
+			'peers6': _random_bytes(rng, 18 * peers6),
+			'prio': b'\x08' * 16,
+			'trackers': ['http://tracker.invalid/announce', 'udp://tracker.invalid:80'],
+			'uploaded': rng.getrandbits(32)
+		}
+	with open(path, 'wb') as dat_file:
+		dat_file.write(bencode.encode(resume))
+
+def main():
+	parser = argparse.ArgumentParser(description='Generate synthetic torrents and uTorrent .dat files')
+	parser.add_argument('-d', '--directory', help='Folder to write to', required=True)
+	parser.add_argument('--size', help='Content size in MiB', type=int, default=16)
+	parser.add_argument('--piece-length', help='Piece length in KiB', type=int, default=256)
+	parser.add_argument('--files', help='Number of files, more than one makes a multi-file torrent', type=int, default=1)
+	parser.add_argument('--missing', help='Number of files to delete after hashing', type=int, default=0)
+	parser.add_argument('--truncated', help='Number of files to truncate after hashing', type=int, default=0)
+	parser.add_argument('--version', help='Torrent version, 1, 2 (BEP 52) or hybrid', choices=['1', '2', 'hybrid'], default='1')
+	parser.add_argument('--dht-nodes', help='Number of nodes in dht.dat', type=int, default=10000)
+	parser.add_argument('--resume-torrents', help='Number of torrent entries in resume.dat', type=int, default=1000)
+	parser.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args()
+
+	os.makedirs(args.directory, exist_ok=True)
+	torrent_path, content_path = make_torrent(args.directory, size=args.size * 1024 * 1024, piece_length=args.piece_length * 1024,
+		files=args.files, missing=args.missing, truncated=args.truncated, seed=args.seed,
+		version=args.version if args.version == 'hybrid' else int(args.version))
+	make_dht_dat(os.path.join(args.directory, 'dht.dat'), args.dht_nodes, args.seed)
+	make_resume_dat(os.path.join(args.directory, 'resume.dat'), args.resume_torrents, seed=args.seed)
+	print(f'Wrote {torrent_path}, {content_path}, dht.dat and resume.dat')
+
+if __name__ == '__main__': main()
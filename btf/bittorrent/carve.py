@@ -0,0 +1,235 @@
+import os
+import json
+import mmap
+import time
+import hashlib
+import threading
+
+from termcolor import cprint
+
+from .metainfo import Metainfo
+from .library import iter_torrent_paths
+from ..utility.io import open_sink, print_table
+from ..utility.progress import progress
+from ..utility.threading import get_executor
+
+"""
+Carving of torrent pieces from raw disk images and unallocated space, independent of any file system.
+"""
+
+CARVE_HEADER = ['Torrent', 'Info Hash', 'Piece #', 'Image Offset', 'Length']
+
+DEFAULT_ALIGNMENT = 512
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+STATE_SAVE_INTERVAL = 10 # seconds
+
+_windows = None # per worker: dict of window length to frozenset of digests
+_images = dict() # per worker: path to (file, mmap, size)
+_images_lock = threading.Lock()
+
+class PieceHashIndex:
+	"""
+	Hash set of the piece digests of one or more torrents, grouped by piece length. The last piece of a torrent
+	is usually shorter and is indexed under its own length.
+	"""
+	def __init__(self):
+		self.torrents = list()
+		self.pieces = dict() # digest to list of (torrent number, piece index, length)
+
+	def add(self, torrent_path, metainfo=None):
+		if metainfo is None: metainfo = Metainfo.from_file(torrent_path)
+		if metainfo.pieces is None: raise ValueError('pieces key not found')
+
+		torrent_number = len(self.torrents)
+		self.torrents.append((torrent_path, metainfo.info_hash))
+
+		piece_length = metainfo.piece_length
+		total_length = metainfo.total_length
+		for index, digest in enumerate(metainfo.pieces):
+			length = min(piece_length, total_length - index * piece_length)
+			self.pieces.setdefault(digest, list()).append((torrent_number, index, length))
+
+	def get_windows(self):
+		"""
+		:returns: dict of window length to frozenset of digests to look for at that length
+		"""
+		windows = dict()
+		for digest, entries in self.pieces.items():
+			for _, _, length in entries: windows.setdefault(length, set()).add(digest)
+		return {length: frozenset(digests) for length, digests in windows.items()}
+
+	def resolve(self, digest, length):
+		"""
+		:returns: list of (torrent path, info hash, piece index) for a digest found in a window of length
+		"""
+		return [self.torrents[t] + (i,) for t, i, l in self.pieces.get(digest, ()) if l == length]
+
+def _init_carve_worker(windows):
+	global _windows
+	_windows = windows
+
+def _get_image(path):
+	with _images_lock:
+		if path not in _images:
+			image_file = open(path, 'rb')
+			size = image_file.seek(0, os.SEEK_END) # works for block devices too, where getsize returns 0
+			_images[path] = (image_file, mmap.mmap(image_file.fileno(), size, access=mmap.ACCESS_READ), size)
+		return _images[path]
+
+def _close_images():
+	with _images_lock:
+		for image_file, image, _ in _images.values():
+			image.close()
+			image_file.close()
+		_images.clear()
+
+def scan_chunk(task):
+	"""
+	Hash every window length in the worker's index at each aligned offset in [start, end) of the image.
+	Windows may extend past end, but not past the end of the image.
+	:returns: tuple of (start, list of (offset, length, digest) hits)
+	"""
+	path, start, end, alignment = task
+	_, image, size = _get_image(path)
+	view = memoryview(image)
+	sha1 = hashlib.sha1
+	hits = list()
+	try:
+		for length, digests in _windows.items():
+			last = min(end, size - length + 1)
+			for offset in range(start, last, alignment):
+				digest = sha1(view[offset:offset+length]).digest()
+				if digest in digests: hits.append((offset, length, digest))
+	finally:
+		view.release()
+	return start, hits
+
+def get_image_size(path):
+	with open(path, 'rb') as image_file:
+		return image_file.seek(0, os.SEEK_END)
+
+class CarveState:
+	"""
+	Resumable progress of a carving run, saved as JSON
+	"""
+	def __init__(self, path, parameters):
+		self.path = path
+		self.parameters = parameters
+		self.done = set()
+		self.hits = list()
+		self._saved = time.monotonic()
+
+		if path is not None and os.path.isfile(path):
+			with open(path, 'r') as state_file:
+				state = json.load(state_file)
+			if state.get('parameters') != parameters:
+				raise ValueError(f"State file '{path}' belongs to a different image, torrent set or alignment")
+			self.done = set(state['done'])
+			self.hits = [(offset, length, bytes.fromhex(digest)) for offset, length, digest in state['hits']]
+
+	def add(self, start, hits):
+		self.done.add(start)
+		self.hits.extend(hits)
+		if time.monotonic() - self._saved >= STATE_SAVE_INTERVAL: self.save()
+
+	def save(self):
+		if self.path is None: return
+		state = {
+			'parameters': self.parameters,
+			'done': sorted(self.done),
+			'hits': [(offset, length, digest.hex()) for offset, length, digest in self.hits]
+		}
+		with open(self.path + '.tmp', 'w') as state_file: json.dump(state, state_file)
+		os.replace(self.path + '.tmp', self.path)
+		self._saved = time.monotonic()
+
+def carve_image(image_path, index, *, alignment=DEFAULT_ALIGNMENT, chunk_size=DEFAULT_CHUNK_SIZE, state_path=None,
+		executor='process', workers=None, silent=False):
+	"""
+	Find the pieces of the indexed torrents anywhere in a raw image, at every alignment-byte aligned offset.
+	The image is split into chunks scanned in parallel by workers that memory-map it themselves; with state_path,
+	completed chunks are recorded so an interrupted run can be resumed.
+	:returns: tuple of (list of lists with header CARVE_HEADER, dict of statistics)
+	"""
+	if alignment <= 0: raise ValueError('Alignment must be greater than zero')
+	chunk_size = max(alignment, chunk_size - chunk_size % alignment)
+
+	size = get_image_size(image_path)
+	windows = index.get_windows()
+	parameters = {
+		'image': os.path.abspath(image_path),
+		'size': size,
+		'alignment': alignment,
+		'chunk_size': chunk_size,
+		'torrents': sorted(info_hash.hex() for _, info_hash in index.torrents)
+	}
+	state = CarveState(state_path, parameters)
+
+	tasks = [(image_path, start, min(size, start + chunk_size), alignment)
+		for start in range(0, size, chunk_size) if start not in state.done]
+
+	if not silent and state.done: cprint(f'Resuming, {len(state.done)} chunk(s) already scanned', 'green')
+
+	started = time.monotonic()
+	scanned = 0
+	try:
+		with get_executor(executor, workers, 1, initializer=_init_carve_worker, initargs=(windows,)) as pool:
+			with progress(total=sum(end - start for _, start, end, _ in tasks), unit='B', unit_scale=True, disable=silent) as bar:
+				for (_, start, end, _), (_, hits) in zip(tasks, pool.map(scan_chunk, tasks)):
+					state.add(start, hits)
+					scanned += end - start
+					bar.update(end - start)
+	finally:
+		state.save()
+		_close_images() # images opened by serial and thread workers live in this process
+	elapsed = time.monotonic() - started
+
+	table = list()
+	for offset, length, digest in sorted(state.hits):
+		for torrent_path, info_hash, piece in index.resolve(digest, length):
+			table.append([torrent_path, info_hash.hex(), piece + 1, offset, length])
+
+	stats = {
+		'image_size': size,
+		'bytes_scanned': scanned,
+		'seconds': elapsed,
+		'gb_per_second': scanned / elapsed / 1e9 if elapsed > 0 else 0.0,
+		'windows_per_offset': len(windows),
+		'hits': len(table)
+	}
+	return table, stats
+
+def _perform_carve(args):
+	if not os.path.exists(args.image):
+		cprint(f"ERROR: image '{args.image}' does not exist", 'red')
+		return
+
+	index = PieceHashIndex()
+	for torrent_path in iter_torrent_paths(args.torrent_file):
+		try:
+			index.add(torrent_path)
+		except (OSError, ValueError) as e:
+			cprint(f"\tCould not load '{torrent_path}': {e}", 'red')
+
+	if not index.torrents:
+		cprint('ERROR: no torrent files loaded', 'red')
+		return
+
+	cprint(f'Loaded {len(index.pieces)} piece hash(es) from {len(index.torrents)} torrent(s)', 'green')
+	cprint(f'Scanning {args.image} at {args.alignment} byte alignment', 'green')
+
+	try:
+		table, stats = carve_image(args.image, index, alignment=args.alignment, chunk_size=args.chunk_size * 1024 * 1024,
+			state_path=args.state, executor=args.executor, workers=args.workers, silent=args.silent)
+	except ValueError as e:
+		cprint(f'ERROR: {e}', 'red')
+		return
+
+	if not args.out:
+		print_table(table, CARVE_HEADER)
+	else:
+		cprint(f'\nWriting table to {args.out}', 'green')
+		with open_sink(args.out, CARVE_HEADER) as sink: sink.write_rows(table)
+
+	cprint(f"Scanned {stats['bytes_scanned']} bytes in {stats['seconds']:.2f}s ({stats['gb_per_second']:.3f} GB/s), "
+		f"{stats['hits']} piece hit(s)", 'green')
@@ -0,0 +1,325 @@
+import os
+import bisect
+import collections
+
+from . import merkle
+
+"""
+Virtual model of a torrent's content, mapping pieces to byte ranges of the files on disk.
+"""
+
+FILE_COVERAGE_HEADER = ['File', 'Expected Size', 'Size On Disk', 'Pieces', 'Verified', 'Failed', 'Unverifiable']
+
+V2Piece = collections.namedtuple('V2Piece', ['file_index', 'file_piece', 'piece', 'offset', 'length', 'width', 'digest', 'v1_padding'])
+
+class LayoutFile:
+	"""
+	A file of the torrent: its path on disk, length in the torrent, offset in the torrent's data
+	and the size found on disk (None if the file is missing). Padding files are never read, their
+	content is zeros by definition.
+	"""
+	__slots__ = ('path', 'length', 'offset', 'size', 'padding')
+
+	def __init__(self, path, length, offset, size, padding=False):
+		self.path = path
+		self.length = length
+		self.offset = offset
+		self.size = size
+		self.padding = padding
+
+	@property
+	def exists(self):
+		return self.size is not None
+
+	@property
+	def available(self):
+		"""
+		Number of bytes of this file that can be read from disk
+		"""
+		return 0 if self.size is None else min(self.size, self.length)
+
+class FileLayout:
+	"""
+	Maps each piece of a torrent to the (file index, file offset, length) segments it covers. Pieces touching
+	a missing or short file are unverifiable and are never read or hashed.
+	"""
+	def __init__(self, files, piece_length, padding=()):
+		"""
+		:param files: list of (path, expected length) tuples in torrent order, path may be None for missing files
+		:param padding: indexes of padding files (see Metainfo.padding_files), which are not looked up on disk
+		"""
+		if piece_length <= 0: raise ValueError('Piece length must be greater than zero')
+
+		self.piece_length = piece_length
+		self.files = list()
+
+		offset = 0
+		for i, (path, length) in enumerate(files):
+			if i in padding:
+				self.files.append(LayoutFile(None, int(length), offset, int(length), True))
+			else:
+				size = os.path.getsize(path) if path is not None and os.path.isfile(path) else None
+				self.files.append(LayoutFile(path, int(length), offset, size))
+			offset += int(length)
+
+		self.total_length = offset
+		self.num_pieces = -(-offset // piece_length)
+		self._starts = [x.offset for x in self.files]
+
+	def piece_size(self, index):
+		if index < 0 or index >= self.num_pieces: raise IndexError('piece index out of range')
+		return min(self.piece_length, self.total_length - index * self.piece_length)
+
+	def piece_segments(self, index):
+		"""
+		:returns: list of (file index, offset in file, length) tuples making up the piece, in order
+		"""
+		start = index * self.piece_length
+		end = start + self.piece_size(index)
+
+		segments = list()
+		file_index = bisect.bisect_right(self._starts, start) - 1
+		while start < end:
+			file = self.files[file_index]
+			file_end = file.offset + file.length
+			if file_end > start:
+				length = min(end, file_end) - start
+				segments.append((file_index, start - file.offset, length))
+				start += length
+			file_index += 1
+		return segments
+
+	def is_verifiable(self, index):
+		"""
+		A piece is verifiable if all of its bytes are present on disk
+		"""
+		for file_index, offset, length in self.piece_segments(index):
+			if offset + length > self.files[file_index].available: return False
+		return True
+
+	def piece_range(self, file_index):
+		"""
+		:returns: range of piece indexes touching the given file (empty for zero length files)
+		"""
+		file = self.files[file_index]
+		if file.length == 0: return range(0)
+		return range(file.offset // self.piece_length, (file.offset + file.length - 1) // self.piece_length + 1)
+
+	@property
+	def missing_files(self):
+		return [x for x in self.files if not x.exists]
+
+	def get_extents(self, first, last):
+		"""
+		Map the pieces first to last (indexes, inclusive) back to the files they cover, padding files excluded
+		:returns: list of (first piece #, last piece #, path, offset in file, length) tuples, one per file, with
+		piece numbers counted from 1 like in the piece analysis table
+		"""
+		start = first * self.piece_length
+		end = min((last + 1) * self.piece_length, self.total_length)
+
+		extents = list()
+		file_index = bisect.bisect_right(self._starts, start) - 1
+		while start < end and file_index < len(self.files):
+			file = self.files[file_index]
+			file_end = file.offset + file.length
+			if file_end > start:
+				length = min(end, file_end) - start
+				if not file.padding:
+					extents.append((start // self.piece_length + 1, (start + length - 1) // self.piece_length + 1, file.path, start - file.offset, length))
+				start += length
+			file_index += 1
+		return extents
+
+	def get_work_unit(self, index):
+		"""
+		Describe a verifiable piece for a hashing worker, see btf.utility.threading.hash_segments
+		:returns: tuple of (path, offset in file, length) tuples, path is None for padding
+		"""
+		return tuple((self.files[i].path, offset, length) for i, offset, length in self.piece_segments(index))
+
+	def read_piece(self, index, handles=None, fill=None):
+		"""
+		Read the data of a piece from disk. If fill is given, bytes that are not available on disk are
+		replaced with it, otherwise a ValueError is raised for unverifiable pieces.
+		handles can be a dict of open files shared between calls to avoid reopening files for each piece.
+		:returns: bytes
+		"""
+		own_handles = handles is None
+		if own_handles: handles = dict()
+
+		try:
+			data = bytearray()
+			for file_index, offset, length in self.piece_segments(index):
+				file = self.files[file_index]
+				readable = max(0, min(length, file.available - offset))
+				if readable < length and fill is None:
+					raise ValueError(f'Piece {index + 1} is not available on disk')
+
+				if file.padding:
+					data += bytes(length)
+					continue
+
+				if readable > 0:
+					handle = handles.get(file_index)
+					if handle is None:
+						for other in list(handles): handles.pop(other).close()
+						handle = handles[file_index] = open(file.path, 'rb')
+					handle.seek(offset)
+					data += handle.read(readable)
+
+				if readable < length: data += fill * (length - readable)
+			return bytes(data)
+		finally:
+			if own_handles:
+				for handle in handles.values(): handle.close()
+
+	def iter_pieces(self, indexes=None, fill=None):
+		"""
+		Read pieces in order, keeping only the current file open
+		:returns: generator of (piece index, bytes) tuples
+		"""
+		handles = dict()
+		try:
+			for index in (range(self.num_pieces) if indexes is None else indexes):
+				yield index, self.read_piece(index, handles, fill)
+		finally:
+			for handle in handles.values(): handle.close()
+
+	def get_file_coverage(self, matches):
+		"""
+		Per file statistics of a piece analysis.
+		:param matches: sequence with one entry per piece, True (verified), False (failed) or None (unverifiable)
+		:returns: list of lists with header FILE_COVERAGE_HEADER
+		"""
+		table = list()
+		for file_index, file in enumerate(self.files):
+			if file.padding: continue
+			pieces = self.piece_range(file_index)
+			results = [matches[i] for i in pieces]
+			table.append([
+				file.path,
+				file.length,
+				file.size,
+				len(pieces),
+				sum(1 for x in results if x is True),
+				sum(1 for x in results if x is False),
+				sum(1 for x in results if x is None)
+			])
+		return table
+
+def _get_v1_offsets(metainfo):
+	"""
+	Position of the files of a hybrid torrent in its v1 data
+	:returns: dict of path components to (offset, length of the padding files following the file), padding files excluded
+	"""
+	result = dict()
+	padding = metainfo.padding_files
+	offset = 0
+	last = None
+	for i, (path, length) in enumerate(metainfo.files):
+		if i in padding:
+			if last is not None: result[last] = (result[last][0], result[last][1] + length)
+		else:
+			result[path] = (offset, 0)
+			last = path
+		offset += length
+	return result
+
+class V2Layout:
+	"""
+	Maps the pieces of a v2 (BEP 52) or hybrid torrent to the files on disk. v2 pieces never span files, each file
+	has its own pieces with digests from the piece layers, so every piece can be verified on its own. Pieces of
+	missing or short files are unverifiable and are never read.
+	For hybrid torrents the piece of a V2Piece is its index in the v1 pieces and v1_padding is the number of zero
+	bytes of padding files completing the v1 piece (None if the v1 piece can't be checked from the same data).
+	For v2 only torrents pieces are numbered across files in tree order.
+	"""
+	def __init__(self, metainfo, data_path):
+		piece_length = metainfo.piece_length
+		if piece_length < merkle.BLOCK_SIZE or piece_length & (piece_length - 1):
+			raise ValueError('Piece length of v2 torrents must be a power of two of at least 16 KiB')
+
+		self.piece_length = piece_length
+		self.files = list()
+		self.pieces = list()
+		self._file_pieces = list()
+
+		v1_offsets = _get_v1_offsets(metainfo) if metainfo.is_hybrid else dict()
+		v1_length = sum(length for _, length in metainfo.files) if metainfo.is_hybrid else 0
+		for file_index, entry in enumerate(metainfo.file_tree):
+			path = os.path.join(data_path, *entry.path) if metainfo.is_multi_file else data_path
+			size = os.path.getsize(path) if os.path.isfile(path) else None
+			v1_offset, padding = v1_offsets.get(entry.path, (None, 0))
+			aligned = v1_offset is not None and v1_offset % piece_length == 0
+
+			first = len(self.pieces)
+			self.files.append(LayoutFile(path, entry.length, v1_offset if aligned else first * piece_length, size))
+			width = merkle.get_piece_width(entry.length, piece_length)
+			for file_piece, digest in enumerate(metainfo.get_piece_layer(entry)):
+				offset = file_piece * piece_length
+				length = min(piece_length, entry.length - offset)
+				piece = len(self.pieces)
+				v1_padding = None
+				if aligned:
+					piece = (v1_offset + offset) // piece_length
+					v1_size = min(piece_length, v1_length - piece * piece_length)
+					if v1_size - length <= padding: v1_padding = v1_size - length
+				self.pieces.append(V2Piece(file_index, file_piece, piece, offset, length, width, digest, v1_padding))
+			self._file_pieces.append(range(first, len(self.pieces)))
+
+		self.total_length = sum(x.length for x in self.files)
+
+	@property
+	def num_pieces(self):
+		return len(self.pieces)
+
+	@property
+	def missing_files(self):
+		return [x for x in self.files if not x.exists]
+
+	def get_extents(self, first, last):
+		"""
+		Map the pieces first to last (indexes, inclusive) back to the files they cover, see FileLayout.get_extents
+		:returns: list of (first piece #, last piece #, path, offset in file, length) tuples, one per file
+		"""
+		extents = list()
+		for piece in self.pieces[first:last + 1]:
+			if extents and extents[-1][0] == piece.file_index:
+				extents[-1][2] = piece.piece + 1
+				extents[-1][4] = piece.offset + piece.length - extents[-1][3]
+			else:
+				extents.append([piece.file_index, piece.piece + 1, piece.piece + 1, piece.offset, piece.length])
+		return [(first, last, self.files[file_index].path, offset, length) for file_index, first, last, offset, length in extents]
+
+	def is_verifiable(self, index):
+		piece = self.pieces[index]
+		return piece.offset + piece.length <= self.files[piece.file_index].available
+
+	def get_work_unit(self, index):
+		"""
+		Describe a verifiable piece for a hashing worker, see btf.bittorrent.merkle.hash_piece
+		:returns: tuple of (path, offset in file, length, leaves under the piece digest, piece digest, v1 padding)
+		"""
+		piece = self.pieces[index]
+		return (self.files[piece.file_index].path, piece.offset, piece.length, piece.width, piece.digest, piece.v1_padding)
+
+	def get_file_coverage(self, matches):
+		"""
+		Per file statistics of a v2 piece analysis, see FileLayout.get_file_coverage
+		:param matches: sequence with one entry per piece of this layout, True, False or None
+		:returns: list of lists with header FILE_COVERAGE_HEADER
+		"""
+		table = list()
+		for file, pieces in zip(self.files, self._file_pieces):
+			results = [matches[i] for i in pieces]
+			table.append([
+				file.path,
+				file.length,
+				file.size,
+				len(pieces),
+				sum(1 for x in results if x is True),
+				sum(1 for x in results if x is False),
+				sum(1 for x in results if x is None)
+			])
+		return table
@@ -0,0 +1,255 @@
+import os
+import sqlite3
+
+from termcolor import cprint
+
+from .metainfo import Metainfo, PieceHashes
+from ..utility.io import open_sink, print_table
+from ..utility.progress import progress
+from ..utility.threading import hash_segments, get_executor
+
+"""
+Persistent index of many .torrent files and matching of a content tree against it.
+"""
+
+CONTENT_MATCH_HEADER = ['Content File', 'Torrent', 'Info Hash', 'File In Torrent', 'Pieces Checked', 'Pieces Matched', 'Status']
+TORRENT_MATCH_HEADER = ['Torrent', 'Info Hash', 'Files', 'Files Matched', 'Bytes Matched', 'Total Bytes']
+
+MATCH = 'match'
+PARTIAL = 'partial'
+MISMATCH = 'mismatch'
+SIZE_ONLY = 'size-only' # file has no piece fully inside it, only the size could be compared
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS torrents (
+	id INTEGER PRIMARY KEY,
+	info_hash BLOB UNIQUE NOT NULL,
+	torrent_path TEXT NOT NULL,
+	name TEXT NOT NULL,
+	piece_length INTEGER NOT NULL,
+	total_length INTEGER NOT NULL,
+	pieces BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+	torrent_id INTEGER NOT NULL REFERENCES torrents(id),
+	file_index INTEGER NOT NULL,
+	path TEXT NOT NULL,
+	offset INTEGER NOT NULL,
+	length INTEGER NOT NULL,
+	PRIMARY KEY (torrent_id, file_index)
+);
+CREATE INDEX IF NOT EXISTS files_length ON files(length);
+'''
+
+def iter_torrent_paths(paths):
+	"""
+	Expand a list of .torrent files and folders (searched recursively) into .torrent file paths
+	"""
+	for path in paths:
+		if os.path.isdir(path):
+			for root, _, names in os.walk(path):
+				for name in sorted(names):
+					if name.lower().endswith('.torrent'): yield os.path.join(root, name)
+		else:
+			yield path
+
+def get_contained_pieces(offset, length, piece_length, total_length):
+	"""
+	Pieces lying entirely within the byte range [offset, offset + length) of a torrent's data
+	:returns: range of piece indexes
+	"""
+	start = -(-offset // piece_length)
+	end = offset + length
+	if end == total_length: return range(start, -(-end // piece_length))
+	return range(start, end // piece_length)
+
+def _spread(pieces, count):
+	"""
+	Pick up to count pieces spread evenly over a range, always including the first and last
+	"""
+	if len(pieces) <= count: return list(pieces)
+	if count == 1: return [pieces[0]]
+	return sorted({pieces[round(i * (len(pieces) - 1) / (count - 1))] for i in range(count)})
+
+class TorrentLibrary:
+	"""
+	SQLite backed index of .torrent files (info-hash, files, piece length and piece hashes)
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.connection = sqlite3.connect(path, timeout=30)
+		self.connection.executescript(_SCHEMA)
+		self._pieces = dict()
+
+	def close(self):
+		self.connection.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def __len__(self):
+		return self.connection.execute('SELECT COUNT(*) FROM torrents').fetchone()[0]
+
+	def add_torrent(self, torrent_path, metainfo=None):
+		"""
+		Index a .torrent file, torrents already in the index (by info-hash) are skipped
+		:returns: True if the torrent was added
+		"""
+		if metainfo is None: metainfo = Metainfo.from_file(torrent_path)
+		if metainfo.pieces is None: raise ValueError('pieces key not found')
+
+		cursor = self.connection.execute(
+			'INSERT OR IGNORE INTO torrents (info_hash, torrent_path, name, piece_length, total_length, pieces) VALUES (?, ?, ?, ?, ?, ?)',
+			(metainfo.info_hash, torrent_path, metainfo.name, metainfo.piece_length, metainfo.total_length, metainfo.pieces.tobytes()))
+		if cursor.rowcount == 0: return False
+
+		torrent_id = cursor.lastrowid
+		rows = list()
+		offset = 0
+		padding = metainfo.padding_files # offsets count the padding of hybrid torrents, which is never matched as content
+		for file_index, (path, length) in enumerate(metainfo.files):
+			if file_index not in padding: rows.append((torrent_id, file_index, '/'.join(path), offset, length))
+			offset += length
+		self.connection.executemany('INSERT INTO files (torrent_id, file_index, path, offset, length) VALUES (?, ?, ?, ?, ?)', rows)
+		return True
+
+	def add_torrents(self, paths, silent=False):
+		"""
+		Index .torrent files and folders of .torrent files in a single transaction
+		:returns: tuple of (added, skipped as duplicate, failed) counts
+		"""
+		added = duplicates = failed = 0
+		with self.connection:
+			for torrent_path in progress(list(iter_torrent_paths(paths)), disable=silent):
+				try:
+					if self.add_torrent(torrent_path): added += 1
+					else: duplicates += 1
+				except (OSError, ValueError) as e:
+					if not silent: cprint(f"\tCould not index '{torrent_path}': {e}", 'red')
+					failed += 1
+		return added, duplicates, failed
+
+	def get_torrent(self, torrent_id):
+		"""
+		:returns: tuple of (torrent path, name, info hash, piece length, total length)
+		"""
+		return self.connection.execute(
+			'SELECT torrent_path, name, info_hash, piece_length, total_length FROM torrents WHERE id = ?', (torrent_id,)).fetchone()
+
+	def get_pieces(self, torrent_id):
+		if torrent_id not in self._pieces:
+			blob = self.connection.execute('SELECT pieces FROM torrents WHERE id = ?', (torrent_id,)).fetchone()[0]
+			self._pieces[torrent_id] = PieceHashes(blob)
+		return self._pieces[torrent_id]
+
+	def find_candidates(self, sizes):
+		"""
+		Find indexed files with one of the given lengths
+		:returns: list of (torrent id, file index, path in torrent, offset, length) tuples
+		"""
+		self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS content_sizes (length INTEGER PRIMARY KEY)')
+		self.connection.execute('DELETE FROM content_sizes')
+		self.connection.executemany('INSERT OR IGNORE INTO content_sizes (length) VALUES (?)', ((x,) for x in sizes))
+		return self.connection.execute(
+			'SELECT f.torrent_id, f.file_index, f.path, f.offset, f.length FROM files f JOIN content_sizes s ON f.length = s.length '
+			'ORDER BY f.torrent_id, f.file_index').fetchall()
+
+	def match_content(self, content_root, *, confirm_pieces=3, silent=False, executor='auto', workers=None):
+		"""
+		Match the files under content_root against the index. Candidates are narrowed down by file size and then
+		confirmed by hashing up to confirm_pieces pieces lying entirely inside each candidate file. Each distinct
+		byte range is only read and hashed once, however many torrents it is checked against.
+		:returns: tuple of (content matches with header CONTENT_MATCH_HEADER, torrent summary with header TORRENT_MATCH_HEADER)
+		"""
+		by_size = dict()
+		for root, _, names in os.walk(content_root):
+			for name in names:
+				path = os.path.join(root, name)
+				if not os.path.isfile(path): continue
+				size = os.path.getsize(path)
+				if size > 0: by_size.setdefault(size, list()).append(path)
+
+		if not silent: cprint(f'Found {sum(len(x) for x in by_size.values())} file(s) with {len(by_size)} distinct size(s)', 'green')
+
+		candidates = list()
+		units = dict()
+		torrents = dict()
+		for torrent_id, file_index, torrent_file_path, offset, length in self.find_candidates(by_size):
+			if torrent_id not in torrents: torrents[torrent_id] = self.get_torrent(torrent_id)
+			piece_length, total_length = torrents[torrent_id][3:5]
+			checked = _spread(get_contained_pieces(offset, length, piece_length, total_length), confirm_pieces)
+
+			for content_path in by_size[length]:
+				checks = list()
+				for piece in checked:
+					start = piece * piece_length
+					unit = ((content_path, start - offset, min(piece_length, total_length - start)),)
+					units[unit] = None
+					checks.append((piece, unit))
+				candidates.append((content_path, torrent_id, torrent_file_path, checks))
+
+		if not silent: cprint(f'{len(candidates)} candidate(s) by size, hashing {len(units)} distinct piece(s)', 'green')
+
+		unit_list = list(units)
+		with get_executor(executor, workers, piece_length=None, num_items=len(unit_list)) as pool:
+			for unit, digest in zip(unit_list, progress(pool.map(hash_segments, unit_list), total=len(unit_list), disable=silent)):
+				units[unit] = digest
+
+		table = list()
+		summary = dict()
+		for content_path, torrent_id, torrent_file_path, checks in candidates:
+			torrent_path, name, info_hash = torrents[torrent_id][0:3]
+			pieces = self.get_pieces(torrent_id)
+			matched = sum(1 for piece, unit in checks if units[unit] == pieces[piece])
+
+			if len(checks) == 0: status = SIZE_ONLY
+			elif matched == len(checks): status = MATCH
+			elif matched > 0: status = PARTIAL
+			else: status = MISMATCH
+
+			table.append([content_path, torrent_path, info_hash.hex(), torrent_file_path, len(checks), matched, status])
+			if status == MATCH: summary.setdefault(torrent_id, dict())[torrent_file_path] = content_path
+
+		return table, self._summarize(summary, torrents)
+
+	def _summarize(self, summary, torrents):
+		table = list()
+		for torrent_id, matched_files in summary.items():
+			torrent_path, name, info_hash = torrents[torrent_id][0:3]
+			files = self.connection.execute('SELECT path, length FROM files WHERE torrent_id = ?', (torrent_id,)).fetchall()
+			matched_bytes = sum(length for path, length in files if path in matched_files)
+			table.append([torrent_path, info_hash.hex(), len(files), len(matched_files), matched_bytes, sum(x[1] for x in files)])
+		table.sort(key=lambda x: x[4], reverse=True)
+		return table
+
+def _perform_library(args):
+	if not args.add and not args.match:
+		cprint('ERROR: nothing to do, use --add and/or --match', 'red')
+		return
+
+	with TorrentLibrary(args.index) as library:
+		if args.add:
+			cprint(f'Indexing torrent files into {args.index}', 'green')
+			added, duplicates, failed = library.add_torrents(args.add, args.silent)
+			cprint(f'Added {added} torrent(s), {duplicates} already indexed, {failed} failed. Index holds {len(library)} torrent(s)', 'green')
+
+		if args.match:
+			if not os.path.isdir(args.match):
+				cprint(f"ERROR: content folder '{args.match}' does not exist", 'red')
+				return
+
+			cprint(f'Matching content {args.match} against {len(library)} indexed torrent(s)', 'green')
+			table, summary = library.match_content(args.match, confirm_pieces=args.confirm_pieces, silent=args.silent,
+				executor=args.executor, workers=args.workers)
+
+			if not args.out:
+				print_table(table, CONTENT_MATCH_HEADER)
+			else:
+				cprint(f'\nWriting table to {args.out}', 'green')
+				with open_sink(args.out, CONTENT_MATCH_HEADER) as sink: sink.write_rows(table)
+
+			print()
+			print_table(summary, TORRENT_MATCH_HEADER)
@@ -0,0 +1,102 @@
+import hashlib
+import functools
+
+from ..utility.threading import READ_SIZE
+
+"""
+SHA-256 Merkle trees of v2 (BEP 52) torrents. The leaves of a file's tree are the digests of its 16 KiB blocks,
+padded with zero digests to a power of two. A piece digest is the root of the subtree over the blocks of one
+piece and the pieces root of a file is the root of the whole tree.
+"""
+
+BLOCK_SIZE = 16 * 1024
+ZERO_HASH = bytes(32)
+
+def get_num_leaves(count):
+	"""
+	:returns: smallest power of two that is at least count (and at least one)
+	"""
+	return 1 << max(0, count - 1).bit_length()
+
+def get_root(hashes, width, pad=ZERO_HASH):
+	"""
+	Root of a tree with width leaves (a power of two), the given hashes followed by pad
+	"""
+	if len(hashes) > width: raise ValueError(f'{len(hashes)} hashes do not fit in a tree of {width} leaves')
+	layer = list(hashes) + [pad] * (width - len(hashes))
+	while len(layer) > 1:
+		layer = [hashlib.sha256(layer[i] + layer[i + 1]).digest() for i in range(0, len(layer), 2)]
+	return layer[0]
+
+@functools.lru_cache(maxsize=None)
+def get_pad_hash(blocks):
+	"""
+	Root of a subtree of blocks zero leaves, used to pad the piece layer
+	"""
+	return get_root((), blocks)
+
+@functools.lru_cache(maxsize=None)
+def get_zero_block_hash(length=BLOCK_SIZE):
+	"""
+	Digest of a block of length zero bytes, blocks that were never written (preallocated or sparse) have it as leaf
+	"""
+	return hashlib.sha256(bytes(length)).digest()
+
+def get_piece_width(file_length, piece_length):
+	"""
+	Number of leaves under a piece digest: a full piece for files longer than one piece, otherwise the blocks of
+	the file rounded up to a power of two
+	"""
+	if file_length > piece_length: return piece_length // BLOCK_SIZE
+	return get_num_leaves(-(-file_length // BLOCK_SIZE))
+
+def get_file_root(piece_hashes, piece_length):
+	"""
+	Pieces root of a file longer than one piece from its piece layer
+	"""
+	return get_root(piece_hashes, get_num_leaves(len(piece_hashes)), get_pad_hash(piece_length // BLOCK_SIZE))
+
+def hash_piece(unit):
+	"""
+	Hash a v2 piece described by a (path, offset, length, width, expected digest, v1 padding) work unit, reading
+	the data in the calling worker. If v1 padding is not None (hybrid torrents), the SHA1 digest of the same data
+	followed by that many zero bytes is computed from the same read.
+	:returns: tuple of (32 byte piece digest, 20 byte v1 digest or None, tuple of the indexes of zero filled blocks
+	in the piece if the digest does not match the expected one, otherwise empty)
+	"""
+	path, offset, length, width, expected, v1_padding = unit
+	sha1 = None if v1_padding is None else hashlib.sha1()
+	leaves = list()
+	total = length
+	with open(path, 'rb') as data_file:
+		data_file.seek(offset)
+		while length > 0:
+			size = min(length, READ_SIZE) # a multiple of BLOCK_SIZE, so only the last block of a file is short
+			chunk = data_file.read(size)
+			if len(chunk) < size: raise ValueError(f"Unexpected end of file '{path}' at offset {offset}")
+			if sha1 is not None: sha1.update(chunk)
+			view = memoryview(chunk)
+			leaves.extend(hashlib.sha256(view[i:i + BLOCK_SIZE]).digest() for i in range(0, size, BLOCK_SIZE))
+			offset += size
+			length -= size
+	if sha1 is not None: sha1.update(bytes(v1_padding))
+	return _get_result(leaves, total, width, expected, sha1)
+
+def hash_piece_data(data, width, expected, v1_padding=None):
+	"""
+	hash_piece for the data of a piece already in memory (bytes, bytearray or memoryview)
+	"""
+	sha1 = None
+	if v1_padding is not None:
+		sha1 = hashlib.sha1(data)
+		sha1.update(bytes(v1_padding))
+	leaves = [hashlib.sha256(data[i:i + BLOCK_SIZE]).digest() for i in range(0, len(data), BLOCK_SIZE)]
+	return _get_result(leaves, len(data), width, expected, sha1)
+
+def _get_result(leaves, length, width, expected, sha1):
+	digest = get_root(leaves, width)
+	zero_blocks = ()
+	if digest != expected: # narrow the mismatch down to the blocks that hold no data
+		last = get_zero_block_hash(length % BLOCK_SIZE or BLOCK_SIZE)
+		zero_blocks = tuple(i for i, x in enumerate(leaves) if x == (last if i == len(leaves) - 1 else get_zero_block_hash()))
+	return digest, None if sha1 is None else sha1.digest(), zero_blocks
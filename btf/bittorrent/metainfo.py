@@ -0,0 +1,239 @@
+import os
+import hashlib
+import collections
+import collections.abc
+
+from . import merkle
+from ..utility import bencode
+
+"""
+Parsing of .torrent (metainfo) files.
+"""
+
+DIGEST_LENGTH = 20
+V2_DIGEST_LENGTH = 32 # SHA-256, used by v2 (BEP 52) torrents
+
+FileTreeEntry = collections.namedtuple('FileTreeEntry', ['path', 'length', 'pieces_root'])
+
+class PieceHashes(collections.abc.Sequence):
+	"""
+	Lazy sequence of 20 byte SHA1 digests over the raw value of the pieces key, digests are only copied
+	out of the underlying buffer when accessed
+	"""
+	__slots__ = ('_view',)
+
+	def __init__(self, view):
+		view = memoryview(view)
+		if len(view) % DIGEST_LENGTH != 0:
+			raise ValueError(f'Length of pieces ({len(view)}) must be a multiple of {DIGEST_LENGTH}')
+		self._view = view
+
+	def __len__(self):
+		return len(self._view) // DIGEST_LENGTH
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self[i] for i in range(*index.indices(len(self)))]
+		if index < 0: index += len(self)
+		if index < 0 or index >= len(self): raise IndexError('piece index out of range')
+		return self._view[index*DIGEST_LENGTH:(index+1)*DIGEST_LENGTH].tobytes()
+
+	def tobytes(self):
+		return self._view.tobytes()
+
+def _decode_text(value):
+	"""
+	Decode a name or path component, keeping undecodable bytes intact so they still map to the file on disk
+	"""
+	return bytes(value).decode('utf-8', errors='surrogateescape')
+
+def _get_bytes(entry, key):
+	value = entry.get(key, b'')
+	return value if isinstance(value, bytes) else b''
+
+class Metainfo:
+	"""
+	Parsed .torrent file. The info dictionary is located by offset so that the info-hash is computed over
+	the exact bytes in the file, and the pieces key is exposed as a PieceHashes view without copying it.
+	v2 (BEP 52) torrents are described by the file tree key of the info dictionary and the piece layers key
+	next to it, hybrid torrents have both the v1 and v2 keys.
+	"""
+	def __init__(self, data):
+		self.data = data
+		self.info_span = None
+		self.info = dict()
+		self.pieces = None
+		self.announce = None
+		self.piece_layers = dict()
+
+		view = memoryview(data)
+		for key, start, end in bencode.iter_dict(data):
+			if key == b'info':
+				self.info_span = (start, end)
+			elif key == b'announce':
+				self.announce = _decode_text(bencode.decode_at(data, start)[0])
+			elif key == b'piece layers':
+				self.piece_layers = bencode.decode_at(data, start)[0]
+
+		if self.info_span is None: raise bencode.BencodeError('info key not found')
+
+		for key, start, end in bencode.iter_dict(data, self.info_span[0]):
+			if key == b'pieces':
+				pieces_start, pieces_end = bencode.string_span(data, start)
+				self.pieces = PieceHashes(view[pieces_start:pieces_end])
+			else:
+				self.info[key] = bencode.decode_at(data, start)[0]
+
+		if b'piece length' not in self.info: raise bencode.BencodeError('piece length key not found')
+
+	@classmethod
+	def from_file(cls, path):
+		"""
+		Read and parse a .torrent file
+		"""
+		with open(path, 'rb') as torrent_file:
+			return cls(torrent_file.read())
+
+	@property
+	def info_bytes(self):
+		"""
+		Raw bencoded info dictionary as it appears in the file
+		"""
+		return memoryview(self.data)[self.info_span[0]:self.info_span[1]]
+
+	@property
+	def info_hash(self):
+		"""
+		v1 info-hash (SHA1 of the raw info dictionary)
+		"""
+		return hashlib.sha1(self.info_bytes).digest()
+
+	@property
+	def info_hash_v2(self):
+		"""
+		v2 info-hash (SHA-256 of the raw info dictionary), clients truncate it to 20 bytes where a v1 info-hash is expected
+		"""
+		return hashlib.sha256(self.info_bytes).digest()
+
+	@property
+	def is_v1(self):
+		return self.pieces is not None
+
+	@property
+	def is_v2(self):
+		return b'file tree' in self.info
+
+	@property
+	def is_hybrid(self):
+		return self.is_v1 and self.is_v2
+
+	@property
+	def piece_length(self):
+		return int(self.info[b'piece length'])
+
+	@property
+	def name(self):
+		return _decode_text(self.info.get(b'name.utf-8', self.info.get(b'name', b'')))
+
+	@property
+	def is_multi_file(self):
+		if b'files' in self.info or b'length' in self.info: return b'files' in self.info
+		tree = self.file_tree
+		return len(tree) != 1 or tree[0].path != (self.name,)
+
+	@property
+	def files(self):
+		"""
+		Files in torrent order, for hybrid torrents this includes the padding files of the v1 layout
+		:returns: list of (path components, length) tuples, a single file torrent has one entry with its name
+		"""
+		if b'files' not in self.info and b'length' not in self.info: # v2 only
+			return [(x.path, x.length) for x in self.file_tree]
+
+		if not self.is_multi_file:
+			return [((self.name,), int(self.info[b'length']))]
+
+		result = list()
+		files = self.info[b'files']
+		if not isinstance(files, list): raise ValueError('files key is not a list')
+		for entry in files:
+			if not isinstance(entry, dict) or not isinstance(entry.get(b'length'), int): raise ValueError(f'Invalid entry {len(result)} of files key')
+			path = entry.get(b'path.utf-8', entry.get(b'path', []))
+			if not isinstance(path, list) or not all(isinstance(x, bytes) for x in path): raise ValueError(f'Invalid path of entry {len(result)} of files key')
+			result.append((tuple(_decode_text(x) for x in path), entry[b'length']))
+		return result
+
+	@property
+	def padding_files(self):
+		"""
+		Indexes in files of the padding files (attr key containing 'p') that align files to pieces in hybrid torrents
+		:returns: set of int
+		"""
+		if not self.is_multi_file or not isinstance(self.info.get(b'files'), list): return set()
+		return {i for i, entry in enumerate(self.info[b'files']) if isinstance(entry, dict) and b'p' in _get_bytes(entry, b'attr')}
+
+	@property
+	def file_tree(self):
+		"""
+		Files of the v2 file tree in tree order. As in files, paths of multi-file torrents are relative to the folder
+		named after the torrent and a single file torrent has one entry with its name. pieces_root is None for empty files.
+		:returns: list of FileTreeEntry
+		"""
+		result = list()
+		stack = [((), self.info.get(b'file tree', dict()))]
+		while stack:
+			path, node = stack.pop()
+			for name in sorted(node, reverse=True): # children are pushed in reverse so they are popped in order
+				if name == b'':
+					entry = node[name]
+					root = entry.get(b'pieces root')
+					if root is not None and len(root) != V2_DIGEST_LENGTH: raise ValueError(f"Invalid pieces root for '{'/'.join(path)}'")
+					result.append(FileTreeEntry(path, int(entry[b'length']), root))
+				else:
+					stack.append((path + (_decode_text(name),), node[name]))
+		return result
+
+	def get_piece_layer(self, entry):
+		"""
+		SHA-256 digests of the pieces of a file of the v2 file tree. Files up to one piece long have no piece layer
+		and their pieces root is the digest of their only piece.
+		:returns: list of 32 byte digests, empty for empty files
+		"""
+		if entry.length == 0: return list()
+		if entry.pieces_root is None: raise ValueError(f"Pieces root of '{'/'.join(entry.path)}' not found")
+		if entry.length <= self.piece_length: return [entry.pieces_root]
+
+		layer = self.piece_layers.get(entry.pieces_root)
+		if layer is None: raise ValueError(f"Piece layer of '{'/'.join(entry.path)}' not found")
+		count = -(-entry.length // self.piece_length)
+		if len(layer) != count * V2_DIGEST_LENGTH:
+			raise ValueError(f"Piece layer of '{'/'.join(entry.path)}' has {len(layer) // V2_DIGEST_LENGTH} digests, expected {count}")
+		digests = [bytes(layer[i:i+V2_DIGEST_LENGTH]) for i in range(0, len(layer), V2_DIGEST_LENGTH)]
+		if merkle.get_file_root(digests, self.piece_length) != entry.pieces_root:
+			raise ValueError(f"Piece layer of '{'/'.join(entry.path)}' does not match its pieces root")
+		return digests
+
+	@property
+	def total_length(self):
+		"""
+		Length of the data the v1 pieces span, including the padding files of hybrid torrents
+		"""
+		return sum(length for _, length in self.files)
+
+	@property
+	def content_length(self):
+		"""
+		Length of the content of the torrent's files, without padding files
+		"""
+		padding = self.padding_files
+		return sum(length for i, (_, length) in enumerate(self.files) if i not in padding)
+
+	def get_file_list(self, data_path):
+		"""
+		Map the torrent's files to paths on disk. For single file torrents data_path is the file itself,
+		for multi-file torrents it is the folder containing the files.
+		:returns: list of (path, expected length) tuples in torrent order
+		"""
+		if not self.is_multi_file:
+			return [(data_path, self.files[0][1])]
+		return [(os.path.join(data_path, *path), length) for path, length in self.files]
@@ -0,0 +1,167 @@
+import os
+import collections
+
+from termcolor import cprint
+
+from .layout import FileLayout
+from .library import iter_torrent_paths
+from .metainfo import Metainfo
+from .pieces import PIECE_ANALYSIS_HEADER, iter_unit_digests
+from .report import PieceResult, RUN_SUMMARY_HEADER
+from ..utility import stats
+from ..utility.io import open_sink, print_table
+from ..utility.prefetch import parse_read_threads
+from ..utility.threading import get_executor
+
+"""
+Verification of many torrents against one content root. Torrents that share content (re-uploads, season packs and
+single episodes) with the same piece length and alignment have pieces made of the same byte ranges of the same
+files; each such piece is read and hashed once on a shared executor and its digest is given to every torrent.
+"""
+
+MULTI_ANALYSIS_HEADER = ['Torrent', 'Info Hash', 'Pieces', 'Verified', 'Failed', 'Unverifiable', 'Shared Pieces']
+
+Torrent = collections.namedtuple('Torrent', ['path', 'metainfo', 'layout'])
+
+def get_unit_key(unit, identities):
+	"""
+	Key of a work unit that is the same for the same byte ranges of the same files, however the files are reached
+	(another torrent's folder holding a hard link or symlink to the file gives the same key)
+	:param identities: dict of path to (device, inode), filled as files are seen
+	"""
+	key = list()
+	for path, offset, length in unit:
+		if path is not None and path not in identities:
+			stat = os.stat(path)
+			identities[path] = (stat.st_dev, stat.st_ino)
+		key.append((identities.get(path), offset, length)) # None for padding
+	return tuple(key)
+
+def get_shared_units(layouts):
+	"""
+	Collect the distinct work units of the verifiable pieces of several FileLayouts
+	:returns: tuple of (list of distinct work units, list with one list of (piece index, unit number) tuples per layout)
+	"""
+	identities = dict()
+	numbers = dict() # unit key to unit number
+	units = list()
+	pieces = list()
+	for layout in layouts:
+		mapping = list()
+		for index in range(layout.num_pieces):
+			if not layout.is_verifiable(index): continue
+			unit = layout.get_work_unit(index)
+			key = get_unit_key(unit, identities)
+			number = numbers.get(key)
+			if number is None:
+				number = numbers[key] = len(units)
+				units.append(unit)
+			mapping.append((index, number))
+		pieces.append(mapping)
+	return units, pieces
+
+def verify_torrents(torrents, executor, *, silent=False, cache=None, prefetch=None, read_threads=None):
+	"""
+	Verify several torrents (Torrent tuples, with FileLayouts of their content) hashing every distinct piece once,
+	see iter_unit_digests for cache, prefetch and read_threads
+	:returns: tuple of (list of PieceResult, one per torrent, list with the number of pieces each torrent shares
+	with another torrent)
+	"""
+	with stats.stage('plan'): units, pieces = get_shared_units([x.layout for x in torrents])
+	total = sum(len(x) for x in pieces)
+	stats.count('pieces_shared', total - len(units))
+	if not silent: cprint(f'{total} verifiable piece(s), {len(units)} distinct, {total - len(units)} shared with another torrent', 'green')
+
+	buffer_size = max(x.layout.piece_length for x in torrents)
+	with stats.stage('hash'):
+		digests = list(iter_unit_digests(units, executor, buffer_size, silent=silent, cache=cache, prefetch=prefetch, read_threads=read_threads))
+
+	uses = collections.Counter(number for mapping in pieces for _, number in mapping)
+	results = [PieceResult(x.metainfo.pieces).update((index, digests[number]) for index, number in mapping) for x, mapping in zip(torrents, pieces)]
+	return results, [sum(1 for _, number in mapping if uses[number] > 1) for mapping in pieces]
+
+def get_content_path(metainfo, root):
+	"""
+	Where a client saving into root keeps a torrent's content: root/name, the file of a single file torrent or the
+	folder of a multi-file torrent
+	"""
+	return os.path.join(root, metainfo.name)
+
+def load_torrents(paths, root, silent=False):
+	"""
+	Parse torrent files and lay out their content under root, torrents without v1 pieces or whose content does not
+	fit them are reported and left out
+	:returns: list of Torrent
+	"""
+	torrents = list()
+	for path in iter_torrent_paths(paths):
+		try:
+			with stats.stage('parse torrent'): metainfo = Metainfo.from_file(path)
+			if not metainfo.is_v1: raise ValueError('v2 only torrent, no v1 pieces key')
+			content_path = get_content_path(metainfo, root)
+			if metainfo.is_multi_file and os.path.isfile(content_path): raise ValueError(f"content '{content_path}' must be a directory")
+			with stats.stage('layout'): layout = FileLayout(metainfo.get_file_list(content_path), metainfo.piece_length, metainfo.padding_files)
+			if layout.num_pieces != len(metainfo.pieces):
+				raise ValueError(f'number of pieces ({layout.num_pieces}) must match number of hashes ({len(metainfo.pieces)})')
+		except (OSError, ValueError) as e:
+			cprint(f"\tCould not load '{path}': {e}", 'red')
+			continue
+
+		torrents.append(Torrent(path, metainfo, layout))
+		if not silent:
+			missing = len(layout.missing_files)
+			cprint(f"\t{path}: {content_path}, {len(layout.files)} file(s){f', {missing} missing' if missing else ''}", 'red' if missing else 'cyan')
+	return torrents
+
+def _perform_multi_analysis(args):
+	if not os.path.isdir(args.root):
+		cprint(f"ERROR: content root '{args.root}' is not a directory", 'red')
+		return
+
+	torrents = load_torrents(args.torrent_file, args.root, args.silent)
+	if not torrents:
+		cprint('ERROR: no torrent files loaded', 'red')
+		return
+	cprint(f'Loaded {len(torrents)} torrent(s) with content under {args.root}', 'green')
+
+	try:
+		read_threads = parse_read_threads(args.read_threads)
+	except ValueError as e:
+		cprint(f'Error: {e}', 'red')
+		return
+
+	summary_out = args.report == 'summary'
+	sink = None
+	if args.out:
+		try: # rows of every torrent in one output, with the torrent file as source
+			sink = open_sink(args.out, RUN_SUMMARY_HEADER if summary_out else PIECE_ANALYSIS_HEADER, format=args.format, source='')
+		except (OSError, ValueError) as e:
+			cprint(f'Error: could not open output: {e}', 'red')
+			return
+
+	cache = None
+	if not args.no_cache:
+		from ..utility.cache import PieceHashCache, DEFAULT_MAX_ENTRIES
+		cache = PieceHashCache(args.cache, args.cache_size or DEFAULT_MAX_ENTRIES)
+	try:
+		piece_length = max(x.layout.piece_length for x in torrents)
+		with get_executor(args.executor, args.workers, args.chunk_size, piece_length=piece_length) as pool:
+			results, shared = verify_torrents(torrents, pool, silent=args.silent, cache=cache, prefetch=args.prefetch, read_threads=read_threads)
+
+		table = list()
+		for torrent, result, shared_pieces in zip(torrents, results, shared):
+			table.append([torrent.path, torrent.metainfo.info_hash.hex(), len(result)] + list(result.get_counts()) + [shared_pieces])
+			if sink is not None:
+				sink.source = torrent.path
+				sink.write_rows(result.get_run_summary(torrent.layout) if summary_out else result.iter_rows())
+			elif args.report != 'auto' and not args.silent:
+				print(f'\n{torrent.path}')
+				if summary_out: print_table(result.get_run_summary(torrent.layout), RUN_SUMMARY_HEADER)
+				else: print_table(result.iter_rows(), PIECE_ANALYSIS_HEADER)
+	finally:
+		if sink is not None: sink.close()
+		if cache is not None: cache.close()
+
+	if sink is not None: cprint(f'\nResults written to {args.out}', 'green')
+	print()
+	print_table(table, MULTI_ANALYSIS_HEADER)
@@ -1,61 +1,501 @@
 import os
 import binascii
-import multiprocessing
+import contextlib
+import collections
 
-import bencode
-import colorama
-from tqdm import tqdm
-from tabulate import tabulate
 from termcolor import colored, cprint
 
-from ..utility.io import write_csv
-from ..utility.threading import compute_sha1
+from .layout import FileLayout, V2Layout, FILE_COVERAGE_HEADER
+from . import merkle, sampling
+from .report import PieceResult, RUN_SUMMARY_HEADER, STATUSES, CLAIM_STATUSES, MATCH, CLAIMED_MISMATCH, CLAIMED_MISSING, UNCLAIMED_PRESENT, \
+	get_states, get_run_summary, get_claim_states, parse_bitfield
+from .metainfo import Metainfo, DIGEST_LENGTH
+from ..utility import stats
+from ..utility.io import open_sink, print_table
+from ..utility.progress import progress
+from ..utility.prefetch import PrefetchReader, DEFAULT_PREFETCH, parse_read_threads
+from ..utility.threading import compute_sha1_bytes, hash_segments, get_executor
 
 """
 Functions for performing piece analysis on .torrent file and related data.
 """
 
 PIECE_ANALYSIS_HEADER = ['Piece #', 'Data Hash', 'Piece Hash', 'Match']
+CLAIMED_PIECE_ANALYSIS_HEADER = PIECE_ANALYSIS_HEADER + ['Claimed'] # with the have bitfield of a resume.dat entry
+V2_PIECE_ANALYSIS_HEADER = ['File', 'File Piece #', 'Piece #', 'Data Hash', 'Piece Hash', 'Match', 'v1 Match', 'Zero Blocks']
+
+CACHE_BATCH_SIZE = 1000 # computed digests are stored in the cache in batches while streaming
 
 def get_table_from_pieces(data_hex, hashes, piece_length, *, silent=False, threaded=True):
 	"""
 	Compute hashes for given hex blob and compare to values from pieces key in .torrent file. 
+	Compatibility wrapper around get_table_from_bytes for hex encoded data, hashes and piece length (in hex characters).
 	:returns: list of lists with header 'Piece #, Data Hash, Piece Hash, Match'
 	"""
 	if data_hex is None or len(data_hex) == 0 or hashes is None or len(hashes) == 0:
 		raise ValueError("ERRROR: Can't perform piece analysis on hex blobs when data or hashes are empty")
+	if piece_length % 2 != 0:
+		raise ValueError('Piece length of hex blob must be a multiple of two')
 
-	if not silent: cprint('Starting piece analysis', 'green')
-	
-	if not silent: cprint('\t\nCutting data into pieces', 'cyan')
-	pieces = [data_hex[i:i+piece_length] for i in tqdm(range(0, len(data_hex), piece_length), disable=silent)]
+	try:
+		with stats.stage('unhexlify'):
+			data = binascii.unhexlify(data_hex)
+			digests = [binascii.unhexlify(x) for x in hashes]
+	except binascii.Error as e:
+		raise ValueError(f'Invalid hex data: {e}')
+
+	return get_table_from_bytes(data, digests, piece_length // 2, silent=silent, threaded=threaded)
+
+def get_table_from_bytes(data, digests, piece_length, *, silent=False, threaded=True, executor='auto', workers=None, chunksize=None):
+	"""
+	Compute hashes for given raw data (bytes or memoryview) and compare to the 20 byte binary digests from pieces
+	key in .torrent file. executor is an executor kind ('auto', 'serial', 'thread', 'process') or an executor
+	instance from btf.utility.threading to reuse, threaded=False forces serial hashing.
+	:returns: list of lists with header 'Piece #, Data Hash, Piece Hash, Match'
+	"""
+	result = get_result_from_bytes(data, digests, piece_length, silent=silent, threaded=threaded, executor=executor, workers=workers, chunksize=chunksize)
+	return _get_table_from_result(result, silent)
+
+def get_result_from_bytes(data, digests, piece_length, *, silent=False, threaded=True, executor='auto', workers=None, chunksize=None):
+	"""
+	Compact form of get_table_from_bytes
+	:returns: PieceResult
+	"""
+	if data is None or len(data) == 0 or digests is None or len(digests) == 0:
+		raise ValueError("ERRROR: Can't perform piece analysis when data or hashes are empty")
+	if piece_length <= 0: raise ValueError('Piece length must be greater than zero')
 
-	pieces_len = len(pieces)
-	hashes_len = len(hashes)
+	view = memoryview(data)
+	pieces_len = -(-len(view) // piece_length)
 
+	_check_piece_count(pieces_len, len(digests), silent)
+
+	executor, owned = _open_executor(executor, threaded, workers, chunksize, piece_length, pieces_len)
+	try:
+		if executor.kind == 'process': # memoryview slices can't be pickled, copy one piece at a time as it is submitted
+			pieces = (bytes(view[i:i+piece_length]) for i in range(0, len(view), piece_length))
+		else:
+			pieces = (view[i:i+piece_length] for i in range(0, len(view), piece_length))
+
+		piece_digests = _hash_pieces(executor, compute_sha1_bytes, pieces, pieces_len, silent)
+		stats.count('bytes_hashed', len(view))
+	finally:
+		if owned: executor.close()
+
+	return PieceResult(digests).update(enumerate(piece_digests))
+
+def _check_piece_count(pieces_len, hashes_len, silent):
 	if pieces_len != hashes_len: raise ValueError(f'Number of pieces ({pieces_len}) must match number of hashes ({hashes_len})')
 
+	if not silent: cprint('Starting piece analysis', 'green')
 	if not silent: cprint(f'\tNumber of pieces from data is {pieces_len}', 'cyan')
 	if not silent: cprint(f'\tNumber of hashes from torrent file is {hashes_len}', 'cyan')
-	
-	table = list()
 
-	if not silent: cprint(f'\n\tComputing hashes', 'cyan')
-	if threaded:
-		with multiprocessing.Pool() as pool:
-			piece_hashes = list(tqdm(pool.imap(compute_sha1, pieces), total=len(pieces), disable=silent))
-	else:
-		piece_hashes = [compute_sha1(x).lower() for x in pieces]
- 
+def _open_executor(executor, threaded, workers, chunksize, piece_length, num_items):
+	"""
+	Resolve an executor kind or instance
+	:returns: tuple of (executor, whether it was created here and must be closed by the caller)
+	"""
+	if executor is not None and not isinstance(executor, str): return executor, False
+	if not threaded: executor = 'serial'
+	return get_executor(executor or 'auto', workers, chunksize, piece_length=piece_length, num_items=num_items), True
+
+@contextlib.contextmanager
+def _use_executor(executor, workers, chunksize, piece_length, num_items=None):
+	"""
+	Executor of a kind or instance for the duration of a with block, an instance (such as the warm pool of the
+	daemon) is left open for its owner
+	"""
+	executor, owned = _open_executor(executor, True, workers, chunksize, piece_length, num_items)
+	try:
+		yield executor
+	finally:
+		if owned: executor.close()
+
+def _hash_pieces(executor, func, units, count, silent):
+	"""
+	Compute binary SHA1 digests for an iterable of work units (piece data or segment descriptors)
+	:returns: list of 20 byte digests
+	"""
+	if not silent: cprint(f'\n\tComputing hashes ({executor.kind}, {executor.workers} worker(s))', 'cyan')
+	with stats.stage('hash'):
+		result = list(progress(executor.map(func, units), total=count, disable=silent))
+	stats.count('hashes', len(result))
+	return result
+
+def _get_table_from_result(result, silent):
+	"""
+	Build the per piece table of a PieceResult, converting digests to hex only for the report.
+	Pieces without a computed digest are reported as unverifiable with empty Data Hash and Match.
+	:returns: list of lists with header 'Piece #, Data Hash, Piece Hash, Match'
+	"""
 	if not silent: cprint(f'\t\nGenerating table', 'cyan')
-	for i in tqdm(range(0, min(hashes_len, pieces_len)), disable=silent):
-		if i >= pieces_len or i >= hashes_len: break
-		torrent_hash = hashes[i].lower()
-		table.append([i + 1, piece_hashes[i], torrent_hash, piece_hashes[i] == torrent_hash])
-	
-	return table
+	with stats.stage('table'):
+		return [result.get_row(i) for i in progress(range(len(result)), disable=silent)]
+
+def get_table_from_layout(layout, digests, *, silent=False, threaded=True, executor='auto', workers=None, chunksize=None, blob_file=None, cache=None,
+		prefetch=None, read_threads=None):
+	"""
+	Compute hashes for the pieces of a FileLayout and compare to the 20 byte binary digests from pieces key in
+	.torrent file. Each piece is handed to the executor as (path, offset, length) segments and read by the worker
+	hashing it, so memory use is bounded by a few pieces per worker regardless of the size of the content.
+	Pieces touching missing or short files are reported as unverifiable without being read.
+	If blob_file is given the data is instead read in order by the caller and also written to it, with unavailable
+	bytes filled with '0's.
+	If a PieceHashCache is given, pieces whose files are unchanged since they were last hashed are not read again.
+	See iter_layout_digests for prefetch and read_threads.
+	:returns: list of lists with header 'Piece #, Data Hash, Piece Hash, Match'
+	"""
+	result = get_result_from_layout(layout, digests, silent=silent, threaded=threaded, executor=executor, workers=workers, chunksize=chunksize,
+		blob_file=blob_file, cache=cache, prefetch=prefetch, read_threads=read_threads)
+	return _get_table_from_result(result, silent)
+
+def get_result_from_layout(layout, digests, *, silent=False, threaded=True, executor='auto', workers=None, chunksize=None, blob_file=None, cache=None,
+		prefetch=None, read_threads=None, select=None):
+	"""
+	Compact form of get_table_from_layout, no per piece rows are built. See iter_layout_digests for select, which
+	can't be combined with blob_file.
+	:returns: PieceResult
+	"""
+	if layout is None or layout.total_length == 0 or digests is None or len(digests) == 0:
+		raise ValueError("ERRROR: Can't perform piece analysis when data or hashes are empty")
+
+	_check_piece_count(layout.num_pieces, len(digests), silent)
+
+	if blob_file is not None and select is not None: raise ValueError('Pieces can only be selected when no blob is written')
+	indexes = [i for i in range(layout.num_pieces) if layout.is_verifiable(i)]
+
+	if not silent and len(indexes) < layout.num_pieces:
+		cprint(f'\t{layout.num_pieces - len(indexes)} piece(s) touch missing data and are unverifiable', 'cyan')
 
-def _perform_piece_analysis(torrent_file_path, data_file_path, out_file_path, silent=False, write_blob=False):
+	result = PieceResult(digests)
+	executor, owned = _open_executor(executor, threaded, workers, chunksize, layout.piece_length, len(indexes))
+	try:
+		if blob_file is not None:
+			units = _tee_to_file(layout, layout.iter_pieces(fill=b'0'), blob_file)
+			if stats.is_enabled(): stats.count('bytes_read', sum(layout.piece_size(i) for i in indexes))
+			result.update(zip(indexes, _hash_pieces(executor, compute_sha1_bytes, units, len(indexes), silent)))
+		else:
+			with stats.stage('hash and compare'):
+				result.update(iter_layout_digests(layout, executor, silent=silent, cache=cache, prefetch=prefetch, read_threads=read_threads, select=select))
+	finally:
+		if owned: executor.close()
+
+	return result
+
+def iter_layout_digests(layout, executor, *, silent=False, cache=None, prefetch=None, read_threads=None, select=None):
+	"""
+	Compute the SHA1 digests of the pieces of a FileLayout on an executor instance in piece order, each digest is
+	produced as soon as its piece is hashed (or found in the PieceHashCache, if one is given). With serial and
+	thread executors up to prefetch pieces (default: 8, 0 to let the hashing workers read their own data) are read
+	ahead of hashing with read_threads readers per device (see prefetch.parse_read_threads), process workers
+	always read their own data.
+	If select is given (a sequence with a true value for every piece to hash, such as a parsed bitfield) other
+	pieces are not read and produced as unverifiable.
+	:returns: generator of (piece index, 20 byte digest or None if the piece is unverifiable) tuples
+	"""
+	indexes = [i for i in range(layout.num_pieces) if (select is None or select[i]) and layout.is_verifiable(i)]
+	wanted = set(indexes)
+	digests = iter_unit_digests([layout.get_work_unit(i) for i in indexes], executor, layout.piece_length, silent=silent, cache=cache,
+		prefetch=prefetch, read_threads=read_threads)
+
+	try:
+		for i in range(layout.num_pieces):
+			yield i, next(digests) if i in wanted else None
+		next(digests, None) # let it store the last digests in the cache
+	finally:
+		digests.close()
+
+def iter_unit_digests(units, executor, buffer_size, *, silent=False, cache=None, prefetch=None, read_threads=None):
+	"""
+	Compute the SHA1 digests of work units of (path, offset, length) segments (see FileLayout.get_work_unit) on an
+	executor instance in order, taking units whose files are unchanged from the PieceHashCache if one is given.
+	With serial and thread executors the units are read ahead by a PrefetchReader into buffers of buffer_size bytes,
+	up to prefetch units (0 to let the hashing workers read their own data) with read_threads readers per device
+	(see prefetch.parse_read_threads).
+	:returns: generator of 20 byte digests
+	"""
+	cached = dict()
+	keys = list()
+	if cache is not None:
+		with stats.stage('cache lookup'):
+			keys = [cache.get_key(x) for x in units]
+			cached = cache.get_many(keys)
+		stats.count('pieces_from_cache', sum(1 for x in keys if x in cached))
+		if not silent: cprint(f'\t{sum(1 for x in keys if x in cached)} piece(s) loaded from cache', 'cyan')
+
+	pending = [x for i, x in enumerate(units) if cache is None or keys[i] not in cached]
+	if stats.is_enabled():
+		stats.count('hashes', len(pending))
+		stats.count('bytes_read', sum(length for x in pending for _, _, length in x))
+	if not silent: cprint(f'\n\tComputing hashes ({executor.kind}, {executor.workers} worker(s))', 'cyan')
+	reader = _open_reader(executor, [(x, ()) for x in pending], buffer_size, prefetch, read_threads)
+	computed = executor.map(hash_segments, pending) if reader is None else executor.map(reader.process(compute_sha1_bytes), reader)
+	computed = iter(progress(computed, total=len(pending), disable=silent))
+
+	try:
+		new_entries = list()
+		for i in range(len(units)):
+			digest = cached.get(keys[i]) if cache is not None else None
+			if digest is None:
+				digest = next(computed)
+				if cache is not None:
+					new_entries.append((keys[i], digest))
+					if len(new_entries) >= CACHE_BATCH_SIZE:
+						with stats.stage('cache store'): cache.put_many(new_entries)
+						new_entries.clear()
+			yield digest
+
+		if new_entries:
+			with stats.stage('cache store'): cache.put_many(new_entries)
+	finally:
+		if reader is not None: _close_reader(reader, silent)
+
+def _open_reader(executor, units, buffer_size, prefetch=None, read_threads=None):
+	"""
+	Start reading (segments, args) work units ahead of an executor, unless its workers are processes (which read
+	their own data) or prefetch is 0
+	:returns: PrefetchReader or None
+	"""
+	if executor.kind == 'process' or prefetch == 0 or not units: return None
+	return PrefetchReader(units, buffer_size, prefetch=prefetch or DEFAULT_PREFETCH, read_threads=read_threads)
+
+def _close_reader(reader, silent):
+	reader.close()
+	if silent: return
+	overlap = reader.get_overlap()
+	share = overlap['overlap_seconds'] / overlap['read_seconds'] if overlap['read_seconds'] > 0 else 0.0
+	cprint(f"\tRead {overlap['read_seconds']:.3f}s, hashed {overlap['hash_seconds']:.3f}s, both at once {overlap['overlap_seconds']:.3f}s "
+		f"({share:.0%} of reading overlapped with hashing)", 'cyan')
+
+def get_layout_digests(layout, indexes, executor, *, silent=False, cache=None):
+	"""
+	Compute binary SHA1 digests for the given verifiable pieces of a FileLayout on an executor instance,
+	taking unchanged pieces from the PieceHashCache if one is given.
+	:returns: dict of piece index to 20 byte digest
+	"""
+	result = dict()
+	pending = list(indexes)
+
+	if cache is not None:
+		with stats.stage('cache lookup'):
+			keys = {i: cache.get_key(layout.get_work_unit(i)) for i in pending}
+			cached = cache.get_many(keys.values())
+			result.update((i, cached[keys[i]]) for i in pending if keys[i] in cached)
+			pending = [i for i in pending if i not in result]
+		stats.count('pieces_from_cache', len(result))
+		if not silent: cprint(f'\t{len(result)} piece(s) loaded from cache', 'cyan')
+
+	if stats.is_enabled(): stats.count('bytes_read', sum(layout.piece_size(i) for i in pending))
+	units = (layout.get_work_unit(i) for i in pending)
+	result.update(zip(pending, _hash_pieces(executor, hash_segments, units, len(pending), silent)))
+
+	if cache is not None and pending:
+		with stats.stage('cache store'): cache.put_many((keys[i], result[i]) for i in pending)
+
+	return result
+
+def get_table_from_files(files, digests, piece_length, *, silent=False, threaded=True, executor='auto', workers=None, chunksize=None, blob_file=None, cache=None):
+	"""
+	Compute hashes for the data described by a list of (path, expected length) entries and compare to the
+	20 byte binary digests from pieces key in .torrent file. See get_table_from_layout.
+	:returns: list of lists with header 'Piece #, Data Hash, Piece Hash, Match'
+	"""
+	if files is None or len(files) == 0:
+		raise ValueError("ERRROR: Can't perform piece analysis when data or hashes are empty")
+
+	return get_table_from_layout(FileLayout(files, piece_length), digests, silent=silent, threaded=threaded,
+		executor=executor, workers=workers, chunksize=chunksize, blob_file=blob_file, cache=cache)
+
+def _tee_to_file(layout, pieces, out_file):
+	"""
+	Write each piece to out_file, passing on only the data of verifiable pieces
+	"""
+	for index, piece in pieces:
+		out_file.write(piece)
+		if layout.is_verifiable(index): yield piece
+
+def iter_table_from_v2_layout(layout, v1_digests, executor, *, silent=False, prefetch=None, read_threads=None):
+	"""
+	Verify the pieces of a V2Layout against the SHA-256 digests of its piece layers on an executor instance, each
+	piece is a work unit of its own. For hybrid torrents the v1 digests (pieces key) are checked from the same read
+	where the v1 piece is made of the same data and padding. For a failed piece, the 16 KiB blocks of the file that
+	are zero filled (never written) are listed as ranges of block indexes. See iter_layout_digests for prefetch
+	and read_threads.
+	:returns: generator of lists with header V2_PIECE_ANALYSIS_HEADER
+	"""
+	pending = [i for i in range(layout.num_pieces) if layout.is_verifiable(i)]
+	if stats.is_enabled():
+		stats.count('hashes', len(pending))
+		stats.count('bytes_read', sum(layout.pieces[i].length for i in pending))
+	if not silent: cprint(f'\n\tComputing hashes ({executor.kind}, {executor.workers} worker(s))', 'cyan')
+	units = [layout.get_work_unit(i) for i in pending]
+	reader = _open_reader(executor, [(((path, offset, length),), args) for path, offset, length, *args in units], layout.piece_length,
+		prefetch, read_threads)
+	computed = executor.map(merkle.hash_piece, units) if reader is None else executor.map(reader.process(merkle.hash_piece_data), reader)
+	computed = iter(progress(computed, total=len(pending), disable=silent))
+
+	try:
+		for i, piece in enumerate(layout.pieces):
+			row = [layout.files[piece.file_index].path, piece.file_piece + 1, piece.piece + 1]
+			if not layout.is_verifiable(i):
+				yield row + [None, piece.digest.hex(), None, None, None]
+				continue
+
+			digest, v1_digest, zero_blocks = next(computed)
+			v1_match = None
+			if v1_digest is not None and v1_digests is not None and piece.piece < len(v1_digests):
+				v1_match = v1_digest == bytes(v1_digests[piece.piece])
+			first = piece.offset // merkle.BLOCK_SIZE
+			yield row + [digest.hex(), piece.digest.hex(), digest == piece.digest, v1_match, _format_ranges(first + x for x in zero_blocks)]
+	finally:
+		if reader is not None: _close_reader(reader, silent)
+
+def _format_ranges(indexes):
+	"""
+	Format ascending integers as ranges, e.g. '3-5,9'
+	"""
+	ranges = list()
+	for index in indexes:
+		if ranges and ranges[-1][1] == index - 1: ranges[-1][1] = index
+		else: ranges.append([index, index])
+	return ','.join(str(a) if a == b else f'{a}-{b}' for a, b in ranges) or None
+
+def get_hashes_from_pieces(pieces_value):
+	"""
+	Split the raw value of the pieces key from a .torrent file into 20 byte binary digests
+	:returns: list of bytes
+	"""
+	if len(pieces_value) % DIGEST_LENGTH != 0:
+		raise ValueError(f'Length of pieces ({len(pieces_value)}) must be a multiple of {DIGEST_LENGTH}')
+	return [bytes(pieces_value[i:i+DIGEST_LENGTH]) for i in range(0, len(pieces_value), DIGEST_LENGTH)]
+
+def _get_data_path(metainfo, data_file_path):
+	"""
+	Check the content given for a torrent, for single file torrents a folder holding the file may be given
+	:returns: path to the content, or None (after printing an error) if it does not fit the torrent
+	"""
+	if not metainfo.is_multi_file:
+		if os.path.isdir(data_file_path): data_file_path = os.path.join(data_file_path, metainfo.name)
+		if not os.path.isfile(data_file_path):
+			cprint(f"ERROR: data file '{data_file_path}' does not exist", 'red')
+			return None
+
+		cprint('Data is file, streaming', 'green')
+	else:
+		if not os.path.isdir(data_file_path):
+			cprint(f"ERROR: torrent contains multiple files, data '{data_file_path}' must be a directory", 'red')
+			return None
+
+		cprint('Data is directory, streaming files in torrent order for analysis', 'green')
+	return data_file_path
+
+def _print_files(layout, data_file_path):
+	"""
+	Print the files of a FileLayout or V2Layout found on disk and their sizes
+	:returns: False if all files are missing
+	"""
+	files = [x for x in layout.files if not x.padding]
+	for file in files:
+		if file.exists:
+			cprint(f'\tFOUND:   {file.path.replace(data_file_path, "")}', 'cyan')
+
+			if file.size == file.length:
+				cprint(f'\t\t   => File size {file.size}b matched expected', 'blue')
+			elif file.size < file.length:
+				cprint(f'\t\t   => File size {file.size}b less than expected {file.length}b', 'red')
+				cprint(f'\t\t   => Pieces touching the missing {file.length-file.size}b are unverifiable', 'cyan')
+			else:
+				cprint(f'\t\t   => File size {file.size}b greater than expected {file.length}b', 'red')
+				cprint(f'\t\t   => Ignoring {file.size-file.length}b at end of file to compensate', 'red')
+		else:
+			cprint(f'\tMISSING: {file.path.replace(data_file_path, "")}', 'red')
+
+	missing_files = len(layout.missing_files)
+	if missing_files > 0:
+		if missing_files == len(files):
+			cprint(f"All files are missing, cannot perform piece analysis", 'red')
+			return False
+		cprint(f"{missing_files} file(s) missing. Pieces touching missing files are marked unverifiable, other pieces are analysed", 'red')
+
+	cprint('Total data size: ' + str(layout.total_length) + ' bytes', 'green')
+	return True
+
+def _print_summary(states, layout, silent, statuses=STATUSES):
+	"""
+	Print the runs of matching, failed and unverifiable pieces per file, or of the states from get_claim_states
+	with statuses CLAIM_STATUSES
+	"""
+	if silent: return
+	print()
+	with stats.stage('summary'): print_table(get_run_summary(states, layout, statuses), RUN_SUMMARY_HEADER)
+
+def _get_have(resume_path, metainfo, count):
+	"""
+	Pieces the client claimed to have, from the have key of the entry of the torrent (by info hash) in a resume.dat file
+	:returns: bytes with 1 for every claimed piece (see report.parse_bitfield), or None (after printing an error)
+	"""
+	from ..utorrent.resume import get_resume_entry
+
+	try:
+		entry = get_resume_entry(resume_path, metainfo.info_hash)
+	except (OSError, ValueError) as e:
+		cprint(f"Error: could not read resume.dat '{resume_path}': {e}", 'red')
+		return None
+	if entry is None:
+		cprint(f"Error: '{resume_path}' has no entry with info hash {metainfo.info_hash.hex()}", 'red')
+		return None
+
+	name, values = entry
+	if b'have' not in values:
+		cprint(f"Error: entry '{name}' of '{resume_path}' has no have key", 'red')
+		return None
+	try:
+		have = parse_bitfield(values[b'have'], count)
+	except ValueError as e:
+		cprint(f"Error: have key of entry '{name}': {e}", 'red')
+		return None
+
+	cprint(f"resume.dat entry '{name}' claims {sum(have)} of {count} piece(s)", 'green')
+	return have
+
+def _print_claims(states, have, layout, check_unclaimed):
+	"""
+	Print how the pieces found compare with the pieces the client claimed to have
+	:param states: states from get_claim_states
+	"""
+	counts = collections.Counter(CLAIM_STATUSES[x] for x in states)
+	claimed = sum(have)
+	print()
+	cprint(f'Claimed {claimed} of {len(have)} piece(s): {counts[MATCH]} verified, {counts[CLAIMED_MISMATCH]} mismatched, '
+		f'{counts[CLAIMED_MISSING]} missing or unreadable', 'red' if counts[CLAIMED_MISMATCH] or counts[CLAIMED_MISSING] else 'green')
+	if check_unclaimed:
+		cprint(f'{counts[UNCLAIMED_PRESENT]} piece(s) present but not claimed', 'red' if counts[UNCLAIMED_PRESENT] else 'green')
+	else:
+		skipped = sum(layout.piece_size(i) for i, x in enumerate(have) if not x)
+		cprint(f'{len(have) - claimed} unclaimed piece(s) ({skipped}b) not read', 'cyan')
+
+def _get_row(result, index, have):
+	"""
+	:returns: list with header PIECE_ANALYSIS_HEADER, or CLAIMED_PIECE_ANALYSIS_HEADER if have is given
+	"""
+	row = result.get_row(index)
+	if have is not None: row.append(bool(have[index]))
+	return row
+
+def _perform_piece_analysis(torrent_file_path, data_file_path, out_file_path, silent=False, write_blob=False, executor='auto', workers=None, chunksize=None, cache=None,
+		sample=None, sample_confidence=None, seed=None, out_format=None, append=False, prefetch=None, read_threads=None, report='auto', metainfo=None,
+		resume=None, check_unclaimed=False):
+	"""
+	Piece analysis of a torrent against its content. report chooses what is printed or written to out_file_path:
+	'pieces' for a row per piece, 'summary' for runs of matching, failed and unverifiable pieces mapped to files
+	and byte offsets (see btf.bittorrent.report), 'auto' prints the summary and writes rows per piece to the output.
+	executor is an executor kind or an instance that is left open. metainfo is the already parsed torrent file,
+	e.g. from the torrent cache of the daemon, otherwise it is parsed from torrent_file_path.
+	If a resume.dat file is given, its entry for the torrent tells which pieces the client had (have bitfield). Only
+	those are read and verified, unless check_unclaimed is set to also find pieces present but not claimed. Runs
+	and rows then report each piece against the claim (see report.CLAIM_STATUSES).
+	"""
 	if not os.path.isfile(torrent_file_path):
 		cprint(f"ERROR: torrent file '{torrent_file_path}' does not exist", 'red')
 		return
@@ -66,110 +506,185 @@ def _perform_piece_analysis(torrent_file_path, data_file_path, out_file_path, si
 	
 	cprint(f'Performing piece analysis on torrent file {torrent_file_path} and content {data_file_path}', 'green')
 
-	with open(torrent_file_path, 'rb') as torrent_file:
-		torrent_file_content = torrent_file.read()
-			
-		if b'pieces' not in torrent_file_content:
-			cprint('Error: pieces key not found', 'red')
+	try:
+		if metainfo is None:
+			with stats.stage('parse torrent'): metainfo = Metainfo.from_file(torrent_file_path)
+	except ValueError as e:
+		cprint(f'Error: could not parse torrent file: {e}', 'red')
+		return
+
+	try:
+		read_threads = parse_read_threads(read_threads) if isinstance(read_threads, list) else read_threads
+	except ValueError as e:
+		cprint(f'Error: {e}', 'red')
+		return
+
+	if sample_confidence is not None:
+		try:
+			sampling.check_confidence(sample_confidence)
+		except ValueError as e:
+			cprint(f'Error: {e}', 'red')
 			return
-		
-		split = torrent_file_content.split(b'e6:pieces')
 
-		binary_data = binascii.hexlify(torrent_file_content)
-		
-	piece_hashes = binary_data[:-4] # trim 6565 off the end
-	piece_hashes = b''.join(piece_hashes.split(b'706965636573')[1:])
-	piece_hashes = b'3a'.join(piece_hashes.split(b'3a')[1:])
+	sampled = sample is not None or sample_confidence is not None
+	if resume is not None and (sampled or write_blob):
+		cprint('Error: a resume.dat bitfield can not be combined with sampling or writing a blob', 'red')
+		return
 
-	piece_hashes = [piece_hashes[i:i+40].decode() for i in range(0, len(piece_hashes), 40)]
-	
+	if metainfo.is_v2 and not sampled and not write_blob and resume is None:
+		_perform_v2_analysis(metainfo, torrent_file_path, data_file_path, out_file_path, silent, executor, workers, chunksize,
+			out_format=out_format, append=append, prefetch=prefetch, read_threads=read_threads, report=report)
+		return
+
+	if metainfo.pieces is None:
+		cprint('Error: pieces key not found' + (', sampling, blobs and resume.dat bitfields need the v1 pieces of a hybrid torrent' if metainfo.is_v2 else ''), 'red')
+		return
+
+	piece_hashes = metainfo.pieces
+	piece_length = metainfo.piece_length
+
+	cprint(f'Info hash: {metainfo.info_hash.hex()}', 'green')
 	cprint(f'Found hashes for {len(piece_hashes)} pieces', 'green')
-	
-	parsed_data = bencode.decode(split[0].decode('utf-8') + 'eee')
-	
-	piece_length = int(parsed_data["info"]["piece length"])
-	
 	cprint(f'Piece length: {piece_length} bytes', 'green')
-	
-	if os.path.isfile(data_file_path):
-		cprint('Data is file, reading', 'green')
-		with open(data_file_path, 'rb') as data_file:
-			table = get_table_from_pieces(binascii.hexlify(data_file.read()), piece_hashes, int(piece_length * 2))
-	elif os.path.isdir(data_file_path):
-		cprint('Data is directory, assembling into hex blob for analysis', 'green')
-		
-		file_list = list()
-		for file_part in parsed_data['info']['files']:
-			file_list.append(os.path.join(data_file_path ,*file_part['path']))
-			
-		hex_data = b''
-
-		fill_queue = list()
-		missing_files = 0
-
-		i = 0
-		for file in file_list:
-			
-			expected_file_size = parsed_data['info']['files'][i]['length']
-
-			if os.path.isfile(file):
-				cprint(f'\tFOUND:   {file.replace(data_file_path, "")}', 'cyan')
-				with open(file, 'rb') as file_bin:
-					cprint(f'\t\t   => Reading file...', 'blue')
-					file_data = binascii.hexlify(file_bin.read())
-					hex_data += file_data
-
-					file_size = int(len(file_data) / 2)
-
-					if file_size == expected_file_size:
-						cprint(f'\t\t   => File size {file_size}b matched expected', 'blue')
-					elif file_size < expected_file_size:
-						cprint(f'\t\t   => File size {file_size}b less than expected {expected_file_size}b', 'red')
-						adjustment = int(expected_file_size-file_size)
-						cprint(f'\t\t   => Queueing hex blob adjustment of size {adjustment}b', 'cyan')
-						fill_queue.append([len(hex_data), adjustment])
-					else:
-						cprint(f'\t\t   => File size {file_size}b greater than expected {expected_file_size}b', 'red')
-						adjustment = int(file_size-expected_file_size)
-						cprint(f'\t\t   => Trimmming {adjustment}b from end of file to compensate', 'red')
-						hex_data = hex_data[:-adjustment]
-			else:
-				cprint(f'\tMISSING: {file.replace(data_file_path, "")}', 'red')
-				missing_files += 1
-				fill_queue.append([len(hex_data), expected_file_size])
-				cprint(f'\t\t   => Queueing hex blob adjustment of size {expected_file_size}b', 'cyan')
-			i += 1
-		
-		if len(fill_queue) > 0:
-			if len(fill_queue) == missing_files:
-				cprint(f"All files are missing, cannot perform piece analysis", 'red')
+
+	data_file_path = _get_data_path(metainfo, data_file_path)
+	if data_file_path is None: return
+
+	with stats.stage('layout'): layout = FileLayout(metainfo.get_file_list(data_file_path), piece_length, metainfo.padding_files)
+	if not _print_files(layout, data_file_path): return
+
+	if len(piece_hashes) != layout.num_pieces:
+		cprint(f'Error: number of pieces ({layout.num_pieces}) must match number of hashes ({len(piece_hashes)})', 'red')
+		return
+
+	have = None
+	if resume is not None:
+		have = _get_have(resume, metainfo, layout.num_pieces)
+		if have is None: return
+	select = None if check_unclaimed else have
+	header = PIECE_ANALYSIS_HEADER if have is None else CLAIMED_PIECE_ANALYSIS_HEADER
+
+	summary_out = report == 'summary' and bool(out_file_path) and not sampled # without --out the summary is printed
+	sink = None
+	if out_file_path:
+		try: # with append, rows of many analyses are consolidated in one output with the torrent as source
+			sink = open_sink(out_file_path, RUN_SUMMARY_HEADER if summary_out else header, format=out_format, append=append,
+				source=torrent_file_path if append else None)
+		except (OSError, ValueError) as e:
+			cprint(f'Error: could not open output: {e}', 'red')
+			return
+
+	result = None
+	try:
+		if sampled:
+			verifiable = sum(1 for i in range(layout.num_pieces) if layout.is_verifiable(i))
+			try:
+				count = None if sample is None else sampling.get_sample_size(sample, verifiable)
+			except ValueError as e:
+				cprint(f'Error: {e}', 'red')
 				return
-			cprint(f"{len(fill_queue)} file(s) missing. Filling missing data with '30's to allow chance at partial piece analysis for other files", 'red')
-			
-			for missing_file in fill_queue:
-				cprint('\tGenerating fill data...', 'cyan')
-				fill_data = binascii.hexlify(b'0' * missing_file[1])
-				
-				cprint(f'\tCurrent hex blob size is {int(len(hex_data) / 2)} bytes', 'green')
-				cprint(f'\tInserting {int(len(fill_data) / 2)} bytes at index {int(missing_file[0] / 2)}', 'green')
-
-				hex_data = hex_data[:missing_file[0]] + fill_data + hex_data[missing_file[0]:]
-
-				cprint(f'\tInserted, new hex blob size is {int(len(hex_data) / 2)} bytes', 'green')
-	
-		cprint('Assembled hex blob of size: ' + str(int(len(hex_data) / 2)) + ' bytes', 'green')
 
-		if write_blob:
-			cprint('Writing blob to blob.txt', 'red')
+			cprint(f'Sampling {"up to " if sample_confidence is not None else ""}{count or verifiable} of {verifiable} verifiable piece(s)', 'green')
+			with _use_executor(executor, workers, chunksize, piece_length) as pool:
+				sample_result = sampling.sample_layout(layout, piece_hashes, pool, count=count, confidence=sample_confidence, seed=seed, cache=cache)
+			if sink is None:
+				with stats.stage('print table'): print_table(sample_result.table, PIECE_ANALYSIS_HEADER)
+			else:
+				cprint(f'\nWriting table to {out_file_path}', 'green')
+				sink.write_rows(sample_result.table)
+			print()
+			cprint(str(sample_result), 'green')
+			return
+		elif write_blob:
+			cprint('Writing blob to blob.txt while reading', 'red')
 			with open('blob.txt', 'wb') as blob_out:
-				blob_out.write(binascii.unhexlify(hex_data))
-			cprint('Done', 'red')
-				
+				result = get_result_from_layout(layout, piece_hashes, executor=executor, workers=workers, chunksize=chunksize, blob_file=blob_out)
+		elif sink is not None and not summary_out:
+			_check_piece_count(layout.num_pieces, len(piece_hashes), False)
+			cprint(f'\nStreaming table to {out_file_path}', 'green')
+			result = PieceResult(piece_hashes)
+			with _use_executor(executor, workers, chunksize, piece_length, layout.num_pieces) as pool:
+				with stats.stage('hash and write'):
+					for index, digest in iter_layout_digests(layout, pool, cache=cache, prefetch=prefetch, read_threads=read_threads, select=select):
+						if digest is not None: result.set(index, digest)
+						sink.write(_get_row(result, index, have))
+		else:
+			result = get_result_from_layout(layout, piece_hashes, executor=executor, workers=workers, chunksize=chunksize, cache=cache,
+				prefetch=prefetch, read_threads=read_threads, select=select)
 
-		table = get_table_from_pieces(hex_data, piece_hashes, int(piece_length * 2))
-		
-	if not out_file_path:
-		print(tabulate(table, header=PIECE_ANALYSIS_HEADER))
-	else:
-		cprint('\nWriting table to csv', 'green')
-		write_csv(out_file_path, table, PIECE_ANALYSIS_HEADER)
\ No newline at end of file
+		states, statuses = result.get_states(), STATUSES
+		if have is not None: states, statuses = get_claim_states(states, have), CLAIM_STATUSES
+
+		if summary_out:
+			cprint(f'\nWriting summary to {out_file_path}', 'green')
+			with stats.stage('summary'): sink.write_rows(get_run_summary(states, layout, statuses))
+		elif sink is None and report == 'pieces':
+			with stats.stage('print table'): print_table((_get_row(result, i, have) for i in range(len(result))), header)
+		elif sink is not None and write_blob:
+			cprint(f'\nWriting table to {out_file_path}', 'green')
+			sink.write_rows(result.iter_rows())
+	finally:
+		if sink is not None: sink.close()
+
+	if have is not None: _print_claims(states, have, layout, check_unclaimed)
+	if not summary_out and report != 'pieces': _print_summary(states, layout, silent, statuses)
+	print()
+	print_table(layout.get_file_coverage(result), FILE_COVERAGE_HEADER)
+
+def _perform_v2_analysis(metainfo, torrent_file_path, data_file_path, out_file_path, silent=False, executor='auto', workers=None, chunksize=None,
+		out_format=None, append=False, prefetch=None, read_threads=None, report='auto'):
+	"""
+	Piece analysis of a v2 or hybrid torrent against the SHA-256 Merkle trees of its files, see iter_table_from_v2_layout.
+	Piece digests are not taken from the PieceHashCache, which holds v1 digests. See _perform_piece_analysis for report.
+	"""
+	cprint(f'Info hash (v2): {metainfo.info_hash_v2.hex()}', 'green')
+	if metainfo.is_hybrid: cprint(f'Info hash (v1): {metainfo.info_hash.hex()}, hybrid torrent, v1 pieces are checked from the same read', 'green')
+	cprint(f'Piece length: {metainfo.piece_length} bytes', 'green')
+
+	data_file_path = _get_data_path(metainfo, data_file_path)
+	if data_file_path is None: return
+
+	try:
+		with stats.stage('layout'): layout = V2Layout(metainfo, data_file_path)
+	except ValueError as e:
+		cprint(f'Error: {e}', 'red')
+		return
+	cprint(f'Found hashes for {layout.num_pieces} pieces in {len(layout.files)} file(s)', 'green')
+	if not _print_files(layout, data_file_path): return
+
+	summary_out = report == 'summary' and bool(out_file_path)
+	sink = None
+	if out_file_path:
+		try:
+			sink = open_sink(out_file_path, RUN_SUMMARY_HEADER if summary_out else V2_PIECE_ANALYSIS_HEADER, format=out_format, append=append,
+				source=torrent_file_path if append else None)
+		except (OSError, ValueError) as e:
+			cprint(f'Error: could not open output: {e}', 'red')
+			return
+
+	matches = list()
+	try:
+		with _use_executor(executor, workers, chunksize, metainfo.piece_length, layout.num_pieces) as pool:
+			rows = iter_table_from_v2_layout(layout, metainfo.pieces, pool, silent=silent, prefetch=prefetch, read_threads=read_threads)
+			if sink is not None and not summary_out:
+				cprint(f'\nStreaming table to {out_file_path}', 'green')
+				with stats.stage('hash and write'):
+					for row in rows:
+						sink.write(row)
+						matches.append(row[5])
+			elif report == 'pieces':
+				with stats.stage('hash and compare'): table = list(rows)
+				with stats.stage('print table'): print_table(table, V2_PIECE_ANALYSIS_HEADER)
+				matches = [x[5] for x in table]
+			else:
+				with stats.stage('hash and compare'): matches = [x[5] for x in rows]
+
+		if summary_out:
+			cprint(f'\nWriting summary to {out_file_path}', 'green')
+			with stats.stage('summary'): sink.write_rows(get_run_summary(get_states(matches), layout))
+	finally:
+		if sink is not None: sink.close()
+
+	if not summary_out and report != 'pieces': _print_summary(get_states(matches), layout, silent)
+	print()
+	print_table(layout.get_file_coverage(matches), FILE_COVERAGE_HEADER)
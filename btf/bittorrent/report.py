@@ -0,0 +1,175 @@
+import re
+import functools
+import collections.abc
+
+from .metainfo import DIGEST_LENGTH
+
+"""
+Compact results of piece analyses and run-length summaries of them. A PieceResult keeps the computed digests
+of all pieces in one buffer and the outcome of each piece in two bitmaps; per piece rows are only built when
+asked for. Summaries report consecutive pieces with the same outcome as runs, mapped to files and byte offsets.
+"""
+
+RUN_SUMMARY_HEADER = ['Status', 'First Piece', 'Last Piece', 'Pieces', 'File', 'Offset', 'Length']
+
+MATCH = 'match'
+MISMATCH = 'mismatch'
+UNVERIFIABLE = 'unverifiable'
+
+STATUSES = (UNVERIFIABLE, MISMATCH, MATCH) # by state, see get_states
+
+# outcome of a piece compared with the client's claim to have it, see get_claim_states
+NOT_CLAIMED = 'not claimed'
+UNCLAIMED_PRESENT = 'unclaimed present'
+CLAIMED_MISSING = 'claimed missing'
+CLAIMED_MISMATCH = 'claimed mismatch'
+CLAIM_STATUSES = (NOT_CLAIMED, UNCLAIMED_PRESENT, CLAIMED_MISSING, CLAIMED_MISMATCH, MATCH)
+
+_CLAIM_STATES = (0, 0, 1, 2, 3, 4) # index into CLAIM_STATUSES by state + 3 * claimed
+_BITS = tuple(bytes((x >> (7 - i)) & 1 for i in range(8)) for x in range(256))
+_RUN = re.compile(rb'(.)\1*', re.DOTALL)
+
+@functools.lru_cache(maxsize=None)
+def _expand(hashed, matched):
+	"""
+	States of the 8 pieces of a byte of each bitmap
+	"""
+	return bytes(((hashed >> i) & 1) + ((matched >> i) & 1) for i in range(8))
+
+def get_states(matches):
+	"""
+	Encode the outcome of each piece, None (unverifiable), False or True, as one byte 0, 1 or 2
+	:returns: bytes
+	"""
+	return bytes(0 if x is None else 2 if x else 1 for x in matches)
+
+def parse_bitfield(data, count):
+	"""
+	Decode a BitTorrent bitfield of count pieces, the first piece is the high bit of the first byte (such as the
+	have key of a resume.dat entry)
+	:returns: bytes with 1 for every piece that is set and 0 otherwise
+	"""
+	if len(data) != -(-count // 8): raise ValueError(f'Bitfield of {len(data)} bytes does not hold {count} pieces')
+	return b''.join(_BITS[x] for x in data)[:count]
+
+def get_claim_states(states, have):
+	"""
+	Combine the state of every piece (see get_states) with whether the client claimed to have it (see parse_bitfield)
+	:returns: bytes with one index into CLAIM_STATUSES per piece
+	"""
+	if len(states) != len(have): raise ValueError(f'Bitfield of {len(have)} pieces does not match {len(states)} pieces')
+	return bytes(_CLAIM_STATES[x + 3 * y] for x, y in zip(states, have))
+
+def iter_runs(states, statuses=STATUSES):
+	"""
+	Runs of consecutive pieces with the same state (see get_states)
+	:returns: generator of (status, first index, last index) tuples, status is the item of statuses for the state
+	(MATCH, MISMATCH or UNVERIFIABLE by default)
+	"""
+	for run in _RUN.finditer(states):
+		yield statuses[states[run.start()]], run.start(), run.end() - 1
+
+def get_run_summary(states, layout, statuses=STATUSES):
+	"""
+	Runs of pieces with the same outcome mapped to the files of a FileLayout or V2Layout, a run spanning several
+	files gives one row per file with the pieces and bytes of that file. For states from get_claim_states pass
+	CLAIM_STATUSES as statuses.
+	:returns: list of lists with header RUN_SUMMARY_HEADER
+	"""
+	table = list()
+	for status, first, last in iter_runs(states, statuses):
+		for first_piece, last_piece, path, offset, length in layout.get_extents(first, last):
+			table.append([status, first_piece, last_piece, last_piece - first_piece + 1, path, offset, length])
+	return table
+
+class PieceResult(collections.abc.Sequence):
+	"""
+	Result of a v1 piece analysis against the 20 byte digests of a torrent's pieces key. As a sequence it holds
+	the outcome of every piece, True (verified), False (failed) or None (unverifiable), like the Match column of
+	the per piece table, which is only built by get_row and iter_rows.
+	"""
+	__slots__ = ('expected', 'digests', 'hashed', 'matched')
+
+	def __init__(self, expected):
+		count = len(expected)
+		self.expected = expected
+		self.digests = bytearray(count * DIGEST_LENGTH)
+		self.hashed = bytearray(-(-count // 8))
+		self.matched = bytearray(-(-count // 8))
+
+	def set(self, index, digest):
+		"""
+		Record the computed digest of a piece
+		"""
+		self.digests[index * DIGEST_LENGTH:(index + 1) * DIGEST_LENGTH] = digest
+		bit = 1 << (index & 7)
+		self.hashed[index >> 3] |= bit
+		if digest == bytes(self.expected[index]): self.matched[index >> 3] |= bit
+		else: self.matched[index >> 3] &= ~bit
+
+	def update(self, items):
+		"""
+		Record (index, digest) pairs, pieces with digest None are left unverifiable
+		:returns: self
+		"""
+		for index, digest in items:
+			if digest is not None: self.set(index, digest)
+		return self
+
+	def __len__(self):
+		return len(self.expected)
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self[i] for i in range(*index.indices(len(self)))]
+		if index < 0: index += len(self)
+		if index < 0 or index >= len(self): raise IndexError('piece index out of range')
+		bit = 1 << (index & 7)
+		if not self.hashed[index >> 3] & bit: return None
+		return bool(self.matched[index >> 3] & bit)
+
+	def __sizeof__(self):
+		return object.__sizeof__(self) + sum(getattr(self, x).__sizeof__() for x in ('digests', 'hashed', 'matched'))
+
+	def get_digest(self, index):
+		"""
+		:returns: 20 byte computed digest of a piece, None if it was not hashed
+		"""
+		if self[index] is None: return None
+		return bytes(self.digests[index * DIGEST_LENGTH:(index + 1) * DIGEST_LENGTH])
+
+	def get_counts(self):
+		"""
+		:returns: tuple of the number of verified, failed and unverifiable pieces
+		"""
+		hashed = bin(int.from_bytes(self.hashed, 'little')).count('1')
+		verified = bin(int.from_bytes(self.matched, 'little')).count('1')
+		return verified, hashed - verified, len(self) - hashed
+
+	def get_states(self):
+		"""
+		State of every piece as in get_states, expanded a byte of the bitmaps at a time
+		:returns: bytes
+		"""
+		return b''.join(_expand(h, m) for h, m in zip(self.hashed, self.matched))[:len(self)]
+
+	def get_run_summary(self, layout):
+		"""
+		:returns: list of lists with header RUN_SUMMARY_HEADER, see get_run_summary
+		"""
+		return get_run_summary(self.get_states(), layout)
+
+	def get_row(self, index):
+		"""
+		:returns: list with header 'Piece #, Data Hash, Piece Hash, Match'
+		"""
+		digest = self.get_digest(index)
+		expected = bytes(self.expected[index])
+		if digest is None: return [index + 1, None, expected.hex(), None]
+		return [index + 1, digest.hex(), expected.hex(), digest == expected]
+
+	def iter_rows(self):
+		"""
+		:returns: generator of lists with header 'Piece #, Data Hash, Piece Hash, Match'
+		"""
+		return map(self.get_row, range(len(self)))
@@ -0,0 +1,161 @@
+import math
+import random
+import statistics
+
+from termcolor import cprint
+
+"""
+Statistical sampling of pieces for quick triage of content against a .torrent file.
+"""
+
+MATCH = 'match'
+MISMATCH = 'mismatch'
+PARTIAL = 'partial'
+INCONCLUSIVE = 'inconclusive'
+
+DEFAULT_CONFIDENCE = 0.95
+DEFAULT_MATCH_THRESHOLD = 0.9
+
+def get_stratified_order(layout, seed=None):
+	"""
+	Order the verifiable pieces of a FileLayout for sampling. Pieces are drawn at random from each file in turn,
+	so any prefix of the result is spread across all files that have data on disk.
+	:returns: list of piece indexes
+	"""
+	rng = random.Random(seed)
+
+	per_file = list()
+	for file_index in range(len(layout.files)):
+		file_pieces = [i for i in layout.piece_range(file_index) if layout.is_verifiable(i)]
+		rng.shuffle(file_pieces)
+		if file_pieces: per_file.append(file_pieces)
+
+	order = list()
+	seen = set()
+	while per_file:
+		for file_pieces in list(per_file):
+			while file_pieces and file_pieces[-1] in seen: file_pieces.pop() # pieces spanning files are drawn once
+			if not file_pieces:
+				per_file.remove(file_pieces)
+				continue
+			piece = file_pieces.pop()
+			seen.add(piece)
+			order.append(piece)
+	return order
+
+def get_wilson_interval(successes, total, confidence=DEFAULT_CONFIDENCE, population=None):
+	"""
+	Wilson score confidence interval for a proportion. If the size of the population sampled (without
+	replacement) is given, the finite population correction is applied.
+	:returns: tuple of (lower bound, upper bound)
+	"""
+	if total == 0: return 0.0, 1.0
+	p = successes / total
+	if population is not None and total >= population: return p, p
+
+	z = statistics.NormalDist().inv_cdf(1 - (1 - confidence) / 2)
+	if population is not None and population > 1: z *= math.sqrt((population - total) / (population - 1))
+	denominator = 1 + z * z / total
+	center = (p + z * z / (2 * total)) / denominator
+	margin = z * math.sqrt(p * (1 - p) / total + z * z / (4 * total * total)) / denominator
+	return max(0.0, center - margin), min(1.0, center + margin)
+
+def check_confidence(confidence):
+	"""
+	:raises ValueError: if confidence is not a level strictly between 0 and 1
+	"""
+	if not 0 < confidence < 1: raise ValueError(f'Invalid confidence level {confidence}, must be between 0 and 1 (exclusive)')
+
+def get_verdict(low, high, match_threshold=DEFAULT_MATCH_THRESHOLD):
+	"""
+	Classify a confidence interval of the piece match rate
+	"""
+	if low >= match_threshold: return MATCH
+	if high <= 1 - match_threshold: return MISMATCH
+	if low > 1 - match_threshold and high < match_threshold: return PARTIAL
+	return INCONCLUSIVE
+
+def get_sample_size(spec, population):
+	"""
+	Parse a sample size given as a number of pieces ('200') or a percentage ('5%')
+	:returns: int, at least 1 and at most population
+	"""
+	spec = str(spec).strip()
+	try:
+		if spec.endswith('%'):
+			count = math.ceil(population * float(spec[:-1]) / 100)
+		else:
+			count = int(spec)
+	except ValueError:
+		raise ValueError(f"Invalid sample size '{spec}', must be a number of pieces or a percentage")
+	if count <= 0: raise ValueError('Sample size must be greater than zero')
+	return min(count, population)
+
+class SampleResult:
+	"""
+	Outcome of a sampled piece analysis. When the verdict is tested after each of up to looks batches, every
+	interval is computed at confidence 1 - (1 - confidence) / looks (Bonferroni), so that the chance of any of
+	the looks giving a wrong verdict stays within the stated confidence.
+	"""
+	def __init__(self, table, population, confidence, match_threshold, looks=1):
+		self.table = table
+		self.population = population
+		self.confidence = confidence
+		self.match_threshold = match_threshold
+		self.looks = looks
+
+	@property
+	def checked(self):
+		return len(self.table)
+
+	@property
+	def matched(self):
+		return sum(1 for x in self.table if x[3])
+
+	@property
+	def interval(self):
+		return get_wilson_interval(self.matched, self.checked, 1 - (1 - self.confidence) / self.looks, self.population)
+
+	@property
+	def verdict(self):
+		return get_verdict(*self.interval, self.match_threshold)
+
+	def __str__(self):
+		low, high = self.interval
+		return (f'Matched {self.matched}/{self.checked} sampled pieces (of {self.population} verifiable), '
+			f'match rate {self.confidence * 100:g}% CI{f" (over {self.looks} looks)" if self.looks > 1 else ""} [{low:.4f}, {high:.4f}], '
+			f'verdict: {self.verdict}')
+
+def sample_layout(layout, digests, executor, *, count=None, confidence=None, match_threshold=DEFAULT_MATCH_THRESHOLD,
+		seed=None, batch_size=None, silent=False, cache=None):
+	"""
+	Verify a stratified random sample of pieces. If confidence is given, pieces are checked in batches and
+	sampling stops as soon as the verdict is clear at that confidence level, with count (default: all verifiable
+	pieces) as the upper limit; the confidence is split across the planned batches, see SampleResult. Without
+	confidence exactly count pieces are checked.
+	:returns: SampleResult, its table has header 'Piece #, Data Hash, Piece Hash, Match' with rows in sample order
+	"""
+	from .pieces import get_layout_digests
+
+	if confidence is not None: check_confidence(confidence)
+	order = get_stratified_order(layout, seed)
+	limit = len(order) if count is None else min(count, len(order))
+	if batch_size is None: batch_size = max(16, 4 * executor.workers)
+	if confidence is None: batch_size = limit
+
+	looks = max(1, -(-limit // batch_size))
+	result = SampleResult(list(), len(order), DEFAULT_CONFIDENCE if confidence is None else confidence, match_threshold, looks)
+	position = 0
+	while position < limit:
+		batch = order[position:min(limit, position + batch_size)]
+		computed = get_layout_digests(layout, batch, executor, silent=True, cache=cache)
+		for index in batch:
+			expected = bytes(digests[index])
+			result.table.append([index + 1, computed[index].hex(), expected.hex(), computed[index] == expected])
+		position += len(batch)
+
+		if confidence is None: break
+		if not silent: cprint(f'\t{result}', 'cyan')
+		if result.verdict != INCONCLUSIVE: break
+
+	return result
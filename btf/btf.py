@@ -15,21 +15,33 @@ You should have received a copy of the GNU General Public License along with
 this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import os
+import sys
 import argparse
-import colorama
 
-from btf.utorrent import resume, dht
-from btf.bittorrent import pieces
-from btf.utility.threading import compute_sha1
+from btf.utility import stats
+from btf.utility.io import SINK_FORMATS
+from btf.utility.threading import EXECUTOR_KINDS
+
+# subcommand implementations and their dependencies are only imported by _run once a subcommand is chosen
+
+REPORT_MODES = ['auto', 'summary', 'pieces'] # see bittorrent.report, kept here so --help does not load it
 
 __version__ = "0.0.0.1"
 
 def main():
-	colorama.init() # initialize colorama so terminal colors work
+	if sys.stdout.isatty():
+		import colorama
+		colorama.init() # initialize colorama so terminal colors work, output to files and pipes is left untouched
 
 	parser = argparse.ArgumentParser()
 
 	parser.add_argument('--version', action='version', version='BitTorrent Forensics {version}'.format(version=__version__))
+	parser.add_argument('--stats', help='Print per stage timings, counters and worker utilization when done', action='store_true', default=False)
+	parser.add_argument('--stats-json', help='Write the --stats report to a JSON file', default=None)
+	parser.add_argument('--profile', help='Run the subcommand under cProfile and write the profile to this file', default=None)
+	parser.add_argument('--daemon', help='Run torrent-piece-analysis, uTorrent-dht-nodes and uTorrent-resume-peers on the daemon listening on '
+		'this socket, see the daemon subcommand (default: $BTF_DAEMON if set)', metavar='SOCKET', default=os.environ.get('BTF_DAEMON'))
 
 	subparsers = parser.add_subparsers(help='Options')
 
@@ -37,38 +49,204 @@ def main():
 	torrent_piece.set_defaults(which='torrent_piece_analysis')
 	torrent_piece.add_argument('-t', '--torrent-file', help='Torrent file', required=True)
 	torrent_piece.add_argument('-d', '--data-file', help='File to check against torrent file', required=True)
-	torrent_piece.add_argument('-o', '--out', help='File to write results to', required=False)
+	torrent_piece.add_argument('-o', '--out', help='File to stream results to (.csv, .jsonl or .sqlite)', required=False)
+	torrent_piece.add_argument('--format', help='Output format (default: from the extension of --out)', choices=SINK_FORMATS, default=None)
+	torrent_piece.add_argument('--append', help='Append to --out with the torrent file as source, to consolidate many analyses', action='store_true', default=False)
 	torrent_piece.add_argument('--silent', help='Do not print results to terminal', action='store_true', default=False)
+	torrent_piece.add_argument('--report', help='Rows per piece, or runs of matching/failed pieces per file and byte range '
+		'(default: auto, prints the runs and writes rows per piece to --out)', choices=REPORT_MODES, default='auto')
 	torrent_piece.add_argument('--write-blob', help='Write assembled hex blob to disk', action='store_true', default=False)
-
-	dht_nodes = subparsers.add_parser('uTorrent-dht-nodes', help='Parse hex from dht.dat nodes key')
+	torrent_piece.add_argument('--executor', help='Hashing backend, auto picks one from piece size and core count', choices=EXECUTOR_KINDS, default='auto')
+	torrent_piece.add_argument('--workers', help='Number of hashing workers (default: number of cores)', type=int, default=None)
+	torrent_piece.add_argument('--chunk-size', help='Number of pieces sent to a process worker at a time', type=int, default=None)
+	torrent_piece.add_argument('--prefetch', help='Number of pieces read ahead of hashing by the serial and thread backends, 0 to let workers read (default: 8)', type=int, default=None)
+	torrent_piece.add_argument('--read-threads', help='Reader threads, N for every device and/or PATH=N for the device holding PATH '
+		'(default: 1 for spinning drives, 4 for SSDs)', nargs='+', default=None)
+	torrent_piece.add_argument('--cache', help='Piece hash cache file (default: $BTF_CACHE_DIR or ~/.cache/bittorrent-forensics)', default=None)
+	torrent_piece.add_argument('--cache-size', help='Maximum number of cached piece hashes (default: 2000000)', type=int, default=None)
+	torrent_piece.add_argument('--no-cache', help='Ignore the piece hash cache and hash all data (strict mode)', action='store_true', default=False)
+	torrent_piece.add_argument('--clear-cache', help='Invalidate all cached piece hashes before analysis', action='store_true', default=False)
+	torrent_piece.add_argument('--sample', help='Only verify a stratified random sample of N pieces or P%% of pieces (triage)', default=None)
+	torrent_piece.add_argument('--sample-confidence', help='Stop sampling once the verdict is clear at this confidence level, e.g. 0.99', type=float, default=None)
+	torrent_piece.add_argument('--seed', help='Random seed for --sample, for reproducible samples', type=int, default=None)
+	torrent_piece.add_argument('--resume', help='uTorrent resume.dat, only the pieces its entry for the torrent (by info hash) claims to have are verified', default=None)
+	torrent_piece.add_argument('--check-unclaimed', help='With --resume, also verify unclaimed pieces to find data the client did not report', action='store_true', default=False)
+
+	torrent_multi = subparsers.add_parser('torrent-multi-analysis', help='Verify many .torrent files against one content root, hashing pieces they share once')
+	torrent_multi.set_defaults(which='torrent_multi_analysis')
+	torrent_multi.add_argument('-t', '--torrent-file', help='Torrent file(s) or folder(s) of torrent files', nargs='+', required=True)
+	torrent_multi.add_argument('-r', '--root', help='Folder holding the content of every torrent under its name, as a client saves it', required=True)
+	torrent_multi.add_argument('-o', '--out', help='File to write the results of all torrents to, with the torrent file as source (.csv, .jsonl or .sqlite)', required=False)
+	torrent_multi.add_argument('--format', help='Output format (default: from the extension of --out)', choices=SINK_FORMATS, default=None)
+	torrent_multi.add_argument('--report', help='Rows per piece, or runs of matching/failed pieces per file and byte range '
+		'(default: auto, prints only the table of torrents and writes rows per piece to --out)', choices=REPORT_MODES, default='auto')
+	torrent_multi.add_argument('--silent', help='Do not print progress and results per torrent to terminal', action='store_true', default=False)
+	torrent_multi.add_argument('--executor', help='Hashing backend, auto picks one from piece size and core count', choices=EXECUTOR_KINDS, default='auto')
+	torrent_multi.add_argument('--workers', help='Number of hashing workers (default: number of cores)', type=int, default=None)
+	torrent_multi.add_argument('--chunk-size', help='Number of pieces sent to a process worker at a time', type=int, default=None)
+	torrent_multi.add_argument('--prefetch', help='Number of pieces read ahead of hashing by the serial and thread backends, 0 to let workers read (default: 8)', type=int, default=None)
+	torrent_multi.add_argument('--read-threads', help='Reader threads, N for every device and/or PATH=N for the device holding PATH '
+		'(default: 1 for spinning drives, 4 for SSDs)', nargs='+', default=None)
+	torrent_multi.add_argument('--cache', help='Piece hash cache file (default: $BTF_CACHE_DIR or ~/.cache/bittorrent-forensics)', default=None)
+	torrent_multi.add_argument('--cache-size', help='Maximum number of cached piece hashes (default: 2000000)', type=int, default=None)
+	torrent_multi.add_argument('--no-cache', help='Ignore the piece hash cache and hash all data (strict mode)', action='store_true', default=False)
+
+	torrent_library = subparsers.add_parser('torrent-library', help='Index many .torrent files and match a content folder against them')
+	torrent_library.set_defaults(which='torrent_library')
+	torrent_library.add_argument('-i', '--index', help='Index database file (created if missing)', required=True)
+	torrent_library.add_argument('-a', '--add', help='Torrent file(s) or folder(s) of torrent files to add to the index', nargs='+')
+	torrent_library.add_argument('-m', '--match', help='Content folder to match against the index')
+	torrent_library.add_argument('-o', '--out', help='File to write match results to', required=False)
+	torrent_library.add_argument('--confirm-pieces', help='Number of pieces hashed to confirm a file matched by size', type=int, default=3)
+	torrent_library.add_argument('--executor', help='Hashing backend', choices=EXECUTOR_KINDS, default='auto')
+	torrent_library.add_argument('--workers', help='Number of hashing workers (default: number of cores)', type=int, default=None)
+	torrent_library.add_argument('--silent', help='Do not print progress to terminal', action='store_true', default=False)
+
+	torrent_carve = subparsers.add_parser('torrent-carve', help='Locate torrent pieces at any aligned offset of a raw disk image')
+	torrent_carve.set_defaults(which='torrent_carve')
+	torrent_carve.add_argument('-t', '--torrent-file', help='Torrent file(s) or folder(s) of torrent files', nargs='+', required=True)
+	torrent_carve.add_argument('-i', '--image', help='Raw disk image, device or carved blob to scan', required=True)
+	torrent_carve.add_argument('-o', '--out', help='File to write hits to', required=False)
+	torrent_carve.add_argument('--alignment', help='Offset alignment in bytes, e.g. 512 or 4096', type=int, default=512)
+	torrent_carve.add_argument('--chunk-size', help='Size of the image chunks handed to workers, in MiB', type=int, default=64)
+	torrent_carve.add_argument('--state', help='Progress file, an interrupted scan is resumed from it', default=None)
+	torrent_carve.add_argument('--executor', help='Hashing backend', choices=EXECUTOR_KINDS, default='process')
+	torrent_carve.add_argument('--workers', help='Number of hashing workers (default: number of cores)', type=int, default=None)
+	torrent_carve.add_argument('--silent', help='Do not print progress to terminal', action='store_true', default=False)
+
+	case_scan = subparsers.add_parser('scan', help='Find and process every uTorrent artifact under a folder into one case database')
+	case_scan.set_defaults(which='scan')
+	case_scan.add_argument('-r', '--root', help='Evidence root to search, e.g. a mounted image', required=True)
+	case_scan.add_argument('-o', '--out', help='SQLite database to write the case results to', required=True)
+	case_scan.add_argument('--mount', help='Folder that drive paths recorded in resume.dat are relative to (default: root)', default=None)
+	case_scan.add_argument('--workers', help='Total number of worker processes (default: number of cores)', type=int, default=None)
+	case_scan.add_argument('--analysis-workers', help='Maximum number of workers running piece analyses at a time (default: half)', type=int, default=None)
+	case_scan.add_argument('--no-verify', help='Only parse artifacts, do not run piece analyses against found content', action='store_true', default=False)
+	case_scan.add_argument('--sample', help='Only verify a stratified random sample of N pieces or P%% of pieces of each torrent', default=None)
+	case_scan.add_argument('--seed', help='Random seed for --sample', type=int, default=None)
+	case_scan.add_argument('--cache', help='Piece hash cache file (default: $BTF_CACHE_DIR or ~/.cache/bittorrent-forensics)', default=None)
+	case_scan.add_argument('--no-cache', help='Ignore the piece hash cache', action='store_true', default=False)
+	case_scan.add_argument('--silent', help='Do not print progress to terminal', action='store_true', default=False)
+
+	dht_nodes = subparsers.add_parser('uTorrent-dht-nodes', help='Parse nodes key of dht.dat')
 	dht_nodes.set_defaults(which='uTorrent_dht_nodes')
 	dht_nodes_group = dht_nodes.add_mutually_exclusive_group(required=True)
 	dht_nodes_group.add_argument('-s', '--hex_str', type=str, help='String starting with 0x to decode')
 	dht_nodes_group.add_argument('-f', '--file', help='File containing string(s) starting with 0x to decode, one per line')
+	dht_nodes_group.add_argument('-d', '--dat', help='dht.dat file to read the nodes key from directly')
 	dht_nodes.add_argument('-c', '--csv', help='Folder to write csv file to')
+	dht_nodes.add_argument('-o', '--out', help='Single output for all inputs with a source column (.csv, .jsonl or .sqlite)')
+	dht_nodes.add_argument('--format', help='Output format (default: from the extension of --out)', choices=SINK_FORMATS, default=None)
+	dht_nodes.add_argument('--append', help='Append to --out instead of replacing it', action='store_true', default=False)
 	dht_nodes.add_argument('--silent', help='Do not print results to terminal', action='store_true', default=False)
 	
-	resume_peers = subparsers.add_parser('uTorrent-resume-peers', help='Parse hex from resume.dat peers6 key')
+	resume_peers = subparsers.add_parser('uTorrent-resume-peers', help='Parse peers6 and peers keys of resume.dat')
 	resume_peers.set_defaults(which='uTorrent_resume_peers')
 	resume_peers_group = resume_peers.add_mutually_exclusive_group(required=True)
 	resume_peers_group.add_argument('-s', '--hex_str', type=str, help='String starting with 0x to decode')
 	resume_peers_group.add_argument('-f', '--file', help='File containing string(s) starting with 0x to decode, one per line')
+	resume_peers_group.add_argument('-d', '--dat', help='resume.dat file to read the peers6 and peers keys of every torrent from directly')
 	resume_peers.add_argument('-c', '--csv', help='Folder to write csv file to')
+	resume_peers.add_argument('-o', '--out', help='Single output for all inputs with a source column (.csv, .jsonl or .sqlite)')
+	resume_peers.add_argument('--format', help='Output format (default: from the extension of --out)', choices=SINK_FORMATS, default=None)
+	resume_peers.add_argument('--append', help='Append to --out instead of replacing it', action='store_true', default=False)
 	
 	resume_peers.add_argument('--silent', help='Do not print results to terminal', action='store_true', default=False)
+
+	peer_query = subparsers.add_parser('peer-query', help='Load peers of many dht.dat and resume.dat files into a store and query it by IP, CIDR range and port')
+	peer_query.set_defaults(which='peer_query')
+	peer_query.add_argument('-i', '--index', help='Peer store database file (created if missing)', required=True)
+	peer_query.add_argument('-a', '--add', help='dht.dat/resume.dat file(s) or folder(s) searched for them to load into the store', nargs='+')
+	peer_query.add_argument('--label', help='Label of the loaded artifacts, e.g. the machine they come from', default=None)
+	peer_query.add_argument('--ip', help='IP address(es) or CIDR range(s) to find, e.g. 203.0.113.0/24', nargs='+')
+	peer_query.add_argument('--port', help='Port(s) to find', type=int, nargs='+')
+	peer_query.add_argument('--artifact', help='Only peers of artifacts whose path contains one of these strings', nargs='+')
+	peer_query.add_argument('--by-artifact', help='List the matching artifacts with peer counts instead of the peers', action='store_true', default=False)
+	peer_query.add_argument('--limit', help='Maximum number of peers (or artifacts with --by-artifact) listed', type=int, default=None)
+	peer_query.add_argument('-o', '--out', help='File to write results to (.csv, .jsonl or .sqlite)', required=False)
+	peer_query.add_argument('--format', help='Output format (default: from the extension of --out)', choices=SINK_FORMATS, default=None)
+	peer_query.add_argument('--silent', help='Do not print results to terminal', action='store_true', default=False)
+
+	daemon = subparsers.add_parser('daemon', help='Serve jobs on a Unix socket with a warm hashing pool and cached torrent files, see --daemon')
+	daemon.set_defaults(which='daemon')
+	daemon.add_argument('-s', '--socket', help='Socket to listen on (default: $BTF_DAEMON or daemon.sock in the cache folder)', default=None)
+	daemon.add_argument('--executor', help='Hashing backend of the pool shared by all jobs', choices=EXECUTOR_KINDS, default='auto')
+	daemon.add_argument('--workers', help='Number of hashing workers (default: number of cores)', type=int, default=None)
+	daemon.add_argument('--jobs', help='Number of jobs run at a time, others wait (default: 2)', type=int, default=None)
+	daemon.add_argument('--cache', help='Piece hash cache file used when a job does not give one (default: $BTF_CACHE_DIR or ~/.cache/bittorrent-forensics)', default=None)
+	daemon.add_argument('--cache-size', help='Maximum number of cached piece hashes (default: 2000000)', type=int, default=None)
+	daemon.add_argument('--torrents', help='Number of parsed torrent files kept in memory (default: 256)', type=int, default=None)
+	daemon.add_argument('--status', help='Print the status of the running daemon and exit', action='store_true', default=False)
+	daemon.add_argument('--stop', help='Stop the running daemon', action='store_true', default=False)
+	daemon.add_argument('--silent', help='Do not print finished jobs to terminal', action='store_true', default=False)
 	args = parser.parse_args()
 
 	if 'which' not in args:
 		parser.print_help()
 		parser.exit()
 
+	if args.stats or args.stats_json: stats.enable()
+
+	profiler = None
+	if args.profile:
+		import cProfile
+		profiler = cProfile.Profile()
+		profiler.enable()
+
+	try:
+		with stats.stage(args.which):
+			_run(args)
+	finally:
+		if profiler is not None:
+			profiler.disable()
+			profiler.dump_stats(args.profile)
+			print(f'Profile written to {args.profile}')
+		if args.stats: print('\n' + stats.get_collector().format_report())
+		if args.stats_json: stats.write_json(args.stats_json)
+
+def _run(args):
+	if args.daemon and args.which != 'daemon':
+		from btf import daemon
+		if daemon._perform_client(args): return
+
 	if args.which == 'torrent_piece_analysis':
+		from btf.bittorrent import pieces
+		from btf.utility.cache import PieceHashCache, DEFAULT_MAX_ENTRIES
+
 		print(args.data_file)
-		pieces._perform_piece_analysis(args.torrent_file, args.data_file, args.out, args.silent, args.write_blob)
+		if args.clear_cache:
+			with PieceHashCache(args.cache) as cache: cache.clear()
+		cache = None if args.no_cache else PieceHashCache(args.cache, args.cache_size or DEFAULT_MAX_ENTRIES)
+		try:
+			pieces._perform_piece_analysis(args.torrent_file, args.data_file, args.out, args.silent, args.write_blob,
+				args.executor, args.workers, args.chunk_size, cache,
+				sample=args.sample, sample_confidence=args.sample_confidence, seed=args.seed, out_format=args.format, append=args.append,
+				prefetch=args.prefetch, read_threads=args.read_threads, report=args.report, resume=args.resume, check_unclaimed=args.check_unclaimed)
+		finally:
+			if cache is not None: cache.close()
+	elif args.which == 'torrent_multi_analysis':
+		from btf.bittorrent import multi
+		multi._perform_multi_analysis(args)
+	elif args.which == 'torrent_library':
+		from btf.bittorrent import library
+		library._perform_library(args)
+	elif args.which == 'torrent_carve':
+		from btf.bittorrent import carve
+		carve._perform_carve(args)
+	elif args.which == 'scan':
+		from btf.utorrent import scan
+		scan._perform_scan(args)
 	elif args.which == 'uTorrent_dht_nodes':
+		from btf.utorrent import dht
 		dht._parse_dht_nodes(args)
 	elif args.which == 'uTorrent_resume_peers':
+		from btf.utorrent import resume
 		resume._parse_resume_peers(args)
+	elif args.which == 'peer_query':
+		from btf.utorrent import correlation
+		correlation._perform_peer_query(args)
+	elif args.which == 'daemon':
+		from btf import daemon
+		daemon._perform_daemon(args)
 
 if __name__ == '__main__': main()
\ No newline at end of file
@@ -0,0 +1,457 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import contextlib
+import collections
+
+from termcolor import cprint
+
+# the thin client only needs request, the modules used to run jobs (sqlite3 for the cache among them) are imported by the daemon
+
+"""
+Local analysis service. A daemon listening on a Unix socket keeps a hashing pool, parsed torrent files and open
+piece hash cache connections between jobs, so automation that runs the command line for every artifact does not
+pay for interpreter startup, pool creation and torrent parsing each time. Jobs are JSON requests, one per line:
+
+	{"job": "torrent-piece-analysis", "args": {"torrent_file": "/case/a.torrent", "data_file": "/case/a", "out": "/case/a.csv"}}
+
+args are the options of the subcommand of the same name (see JOB_OPTIONS). The output of a job is streamed back as
+{"stdout": text} and {"stderr": text} lines followed by {"ok": true} or {"ok": false, "error": message, "code": n}.
+With --daemon the command line is a thin client: the options of the subcommand are sent as a job, with relative
+paths made absolute, and its output is printed, so scripts get the same results and files as when running locally.
+"""
+
+DEFAULT_JOBS = 2 # jobs run at the same time, further jobs wait for a slot
+DEFAULT_TORRENTS = 256 # parsed torrent files kept
+
+# job name: options of the subcommand and their defaults, the hashing backend is the daemon's pool
+JOB_OPTIONS = {
+	'torrent-piece-analysis': {'torrent_file': None, 'data_file': None, 'out': None, 'format': None, 'append': False, 'silent': False,
+		'report': 'auto', 'prefetch': None, 'read_threads': None, 'cache': None, 'cache_size': None, 'no_cache': False, 'clear_cache': False,
+		'sample': None, 'sample_confidence': None, 'seed': None, 'resume': None, 'check_unclaimed': False},
+	'uTorrent-dht-nodes': {'hex_str': None, 'file': None, 'dat': None, 'csv': None, 'out': None, 'format': None, 'append': False, 'silent': False},
+	'uTorrent-resume-peers': {'hex_str': None, 'file': None, 'dat': None, 'csv': None, 'out': None, 'format': None, 'append': False, 'silent': False}
+}
+CONTROL_JOBS = ('ping', 'status', 'shutdown')
+
+# subcommand (args.which) to job name, for the thin client
+COMMAND_JOBS = {
+	'torrent_piece_analysis': 'torrent-piece-analysis',
+	'uTorrent_dht_nodes': 'uTorrent-dht-nodes',
+	'uTorrent_resume_peers': 'uTorrent-resume-peers'
+}
+
+PATH_OPTIONS = ('torrent_file', 'data_file', 'out', 'cache', 'csv', 'file', 'dat', 'resume') # resolved by the client, the daemon has its own working directory
+
+STATUS_HEADER = ['Key', 'Value']
+
+def get_default_socket_path():
+	"""
+	Socket location, $BTF_DAEMON or daemon.sock next to the piece hash cache
+	"""
+	from btf.utility.cache import get_default_cache_path
+	return os.environ.get('BTF_DAEMON') or os.path.join(os.path.dirname(get_default_cache_path()), 'daemon.sock')
+
+class TorrentCache:
+	"""
+	Parsed torrent files by path. An entry is parsed again once its file changes, at most size entries are kept
+	and the least recently used one is dropped first.
+	"""
+	def __init__(self, size=DEFAULT_TORRENTS):
+		self.size = size
+		self.hits = 0
+		self.misses = 0
+		self._entries = collections.OrderedDict() # path to (file identity, Metainfo)
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._entries)
+
+	def get(self, path):
+		"""
+		:returns: Metainfo of the torrent file at path
+		:raises: OSError if the file can't be read, ValueError if it is not a torrent file
+		"""
+		from btf.bittorrent.metainfo import Metainfo
+		from btf.utility.cache import get_file_identity
+
+		identity = get_file_identity(path)
+		with self._lock:
+			entry = self._entries.get(identity[0])
+			if entry is not None and entry[0] == identity:
+				self._entries.move_to_end(identity[0])
+				self.hits += 1
+				return entry[1]
+
+		metainfo = Metainfo.from_file(path)
+		with self._lock:
+			self.misses += 1
+			self._entries[identity[0]] = (identity, metainfo)
+			self._entries.move_to_end(identity[0])
+			while len(self._entries) > self.size: self._entries.popitem(last=False)
+		return metainfo
+
+class CachePool:
+	"""
+	Open PieceHashCache connections by cache file, each used by one job at a time and kept open between jobs
+	"""
+	def __init__(self, path=None, max_entries=None):
+		from btf.utility.cache import DEFAULT_MAX_ENTRIES
+		self.path = path
+		self.max_entries = max_entries or DEFAULT_MAX_ENTRIES
+		self._free = dict() # absolute cache path to list of idle caches
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		with self._lock: return sum(len(x) for x in self._free.values())
+
+	@contextlib.contextmanager
+	def use(self, path=None, max_entries=None):
+		"""
+		Take an idle cache of path (default: the daemon's cache) or open one, for the duration of a with block
+		"""
+		from btf.utility.cache import PieceHashCache, get_default_cache_path
+		path = os.path.abspath(path or self.path or get_default_cache_path())
+		with self._lock:
+			free = self._free.setdefault(path, list())
+			cache = free.pop() if free else None
+		if cache is None: cache = PieceHashCache(path, self.max_entries, check_same_thread=False)
+		cache.max_entries = max_entries or self.max_entries
+		cache.forget_files() # files may have changed since the last job
+		try:
+			yield cache
+		finally:
+			with self._lock: self._free[path].append(cache)
+
+	def close(self):
+		with self._lock:
+			for caches in self._free.values():
+				for cache in caches: cache.close()
+			self._free.clear()
+
+_local = threading.local() # connection of the job running in the current thread
+
+class _Output:
+	"""
+	Stand-in for sys.stdout or sys.stderr that sends what a job writes to the client of that job, writes from
+	other threads (the daemon itself, hashing workers) go to the original stream
+	"""
+	def __init__(self, stream, name):
+		self.stream = stream
+		self.name = name
+
+	def write(self, text):
+		job = getattr(_local, 'job', None)
+		if job is None: return self.stream.write(text)
+		job.send({self.name: text})
+		return len(text)
+
+	def flush(self):
+		if getattr(_local, 'job', None) is None: self.stream.flush()
+
+	def isatty(self):
+		job = getattr(_local, 'job', None)
+		return self.stream.isatty() if job is None else job.tty.get(self.name, False)
+
+	def __getattr__(self, name):
+		return getattr(self.stream, name)
+
+class _Job:
+	"""
+	Connection of a running job, messages are JSON lines
+	"""
+	def __init__(self, connection, tty):
+		self.connection = connection
+		self.tty = tty or dict()
+
+	def send(self, message):
+		self.connection.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+class Daemon:
+	"""
+	Analysis service listening on a Unix socket, see the module documentation. Jobs are run on a thread per
+	connection, at most jobs of them at a time, and share one hashing executor created at startup.
+	"""
+	def __init__(self, socket_path, *, executor='auto', workers=None, jobs=DEFAULT_JOBS, cache=None, cache_size=None, torrents=DEFAULT_TORRENTS,
+			silent=False):
+		import socketserver
+		from btf.utility.threading import get_executor
+
+		if jobs < 1: raise ValueError('Number of jobs must be at least 1')
+		self.socket_path = os.path.abspath(socket_path)
+		self.silent = silent
+		self.jobs = jobs
+		self.started = time.time()
+		self.counts = collections.Counter()
+		self.torrents = TorrentCache(torrents)
+		self.caches = CachePool(cache, cache_size)
+		self._slots = threading.BoundedSemaphore(jobs)
+		self._lock = threading.Lock()
+		self._streams = None
+
+		if os.path.exists(self.socket_path):
+			if is_running(self.socket_path): raise ValueError(f"A daemon is already listening on '{self.socket_path}'")
+			os.remove(self.socket_path) # left behind by a daemon that was killed
+
+		self.executor = get_executor(executor, workers) # the pool is started before any job thread exists
+		daemon = self
+
+		class Handler(socketserver.StreamRequestHandler):
+			def handle(self):
+				daemon._handle(self.connection, self.rfile)
+
+		class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+			daemon_threads = True
+
+		os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+		umask = os.umask(0o177) # jobs read and write files as the user running the daemon, so only that user may connect
+		try:
+			self.server = Server(self.socket_path, Handler)
+		except OSError:
+			self.executor.close()
+			raise
+		finally:
+			os.umask(umask)
+
+	def serve_forever(self):
+		"""
+		Handle jobs until shutdown is called or a shutdown job is received, output of jobs is redirected to their
+		clients meanwhile
+		"""
+		self._streams = (sys.stdout, sys.stderr)
+		sys.stdout, sys.stderr = _Output(sys.stdout, 'stdout'), _Output(sys.stderr, 'stderr')
+		try:
+			self.server.serve_forever()
+		finally:
+			sys.stdout, sys.stderr = self._streams
+
+	def shutdown(self):
+		"""
+		Stop serve_forever from another thread
+		"""
+		threading.Thread(target=self.server.shutdown, daemon=True).start()
+
+	def close(self):
+		self.server.server_close()
+		self.executor.close()
+		self.caches.close()
+		if os.path.exists(self.socket_path): os.remove(self.socket_path)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def get_status(self):
+		"""
+		:returns: dict describing the daemon, its pool, caches and the jobs handled so far
+		"""
+		with self._lock: counts = dict(self.counts)
+		return {'pid': os.getpid(), 'socket': self.socket_path, 'uptime_seconds': round(time.time() - self.started, 3),
+			'executor': self.executor.kind, 'workers': self.executor.workers, 'jobs': self.jobs, 'running': counts.get('running', 0),
+			'waiting': counts.get('waiting', 0), 'completed': counts.get('completed', 0), 'failed': counts.get('failed', 0),
+			'torrents_cached': len(self.torrents), 'torrent_cache_hits': self.torrents.hits, 'torrent_cache_misses': self.torrents.misses,
+			'idle_cache_connections': len(self.caches)}
+
+	def _count(self, name, value=1):
+		with self._lock: self.counts[name] += value
+
+	def _handle(self, connection, lines):
+		"""
+		Run the jobs sent on a connection, one per line
+		"""
+		for line in lines:
+			job = _Job(connection, None)
+			try:
+				request = json.loads(line)
+				if not isinstance(request, dict): raise ValueError('request must be a JSON object')
+				job.tty = request.get('tty')
+				reply = self._run(request, job)
+			except ValueError as e:
+				reply = {'ok': False, 'error': f'Error: invalid request: {e}', 'code': 1}
+			try:
+				job.send(reply)
+			except OSError:
+				return # the client went away
+
+	def _run(self, request, job):
+		"""
+		Run a job with its output sent to the client
+		:returns: final reply
+		"""
+		name = request.get('job')
+		if name == 'ping': return {'ok': True}
+		if name == 'status': return {'ok': True, 'result': self.get_status()}
+		if name == 'shutdown':
+			self.shutdown()
+			return {'ok': True}
+		if name not in JOB_OPTIONS: raise ValueError(f"unknown job '{name}', must be one of {', '.join(list(JOB_OPTIONS) + list(CONTROL_JOBS))}")
+
+		options = request.get('args') or dict()
+		if not isinstance(options, dict): raise ValueError('args must be a JSON object')
+		args = argparse.Namespace(**{key: options.get(key, default) for key, default in JOB_OPTIONS[name].items()})
+
+		self._count('waiting')
+		with self._slots:
+			self._count('waiting', -1)
+			self._count('running')
+			started = time.perf_counter()
+			_local.job = job
+			try:
+				reply = self._run_job(name, args)
+			except OSError: # the client went away while the job was writing to it
+				reply = {'ok': False, 'error': 'Error: connection lost', 'code': 1}
+			except Exception as e:
+				reply = {'ok': False, 'error': f'Error: {type(e).__name__}: {e}', 'code': 1}
+			finally:
+				_local.job = None
+				self._count('running', -1)
+		self._count('completed' if reply['ok'] else 'failed')
+		if not self.silent: cprint(f"{name} {'done' if reply['ok'] else 'failed'} in {time.perf_counter() - started:.3f}s", 'cyan' if reply['ok'] else 'red')
+		return reply
+
+	def _run_job(self, name, args):
+		"""
+		Call the implementation of a subcommand, sys.exit in it ends the job with that code or error message
+		"""
+		try:
+			if name == 'torrent-piece-analysis':
+				self._run_piece_analysis(args)
+			elif name == 'uTorrent-dht-nodes':
+				from btf.utorrent import dht
+				dht._parse_dht_nodes(args)
+			elif name == 'uTorrent-resume-peers':
+				from btf.utorrent import resume
+				resume._parse_resume_peers(args)
+		except SystemExit as e:
+			if e.code is None or e.code == 0: return {'ok': True}
+			if isinstance(e.code, int): return {'ok': False, 'code': e.code}
+			return {'ok': False, 'error': str(e.code), 'code': 1}
+		return {'ok': True}
+
+	def _run_piece_analysis(self, args):
+		"""
+		torrent-piece-analysis on the daemon's pool, with the torrent file from the torrent cache
+		"""
+		from btf.bittorrent import pieces
+
+		metainfo = None
+		try:
+			metainfo = self.torrents.get(args.torrent_file)
+		except (OSError, ValueError):
+			pass # reported by the analysis as when running locally
+
+		with contextlib.ExitStack() as stack:
+			cache = None
+			if args.clear_cache or not args.no_cache: cache = stack.enter_context(self.caches.use(args.cache, args.cache_size))
+			if args.clear_cache: cache.clear()
+			pieces._perform_piece_analysis(args.torrent_file, args.data_file, args.out, args.silent, False, self.executor,
+				cache=None if args.no_cache else cache, sample=args.sample, sample_confidence=args.sample_confidence, seed=args.seed,
+				out_format=args.format, append=args.append, prefetch=args.prefetch, read_threads=args.read_threads, report=args.report,
+				metainfo=metainfo, resume=args.resume, check_unclaimed=args.check_unclaimed)
+
+def request(socket_path, job, args=None, *, out=None, err=None, timeout=None):
+	"""
+	Send a job to the daemon listening on socket_path and copy its output to out and err (default: sys.stdout
+	and sys.stderr)
+	:returns: final reply, a dict with key ok and error, code or result
+	:raises: OSError if no daemon is listening, ValueError if the daemon closed the connection before replying
+	"""
+	out = sys.stdout if out is None else out
+	err = sys.stderr if err is None else err
+	message = {'job': job, 'args': args or dict(), 'tty': {'stdout': out.isatty(), 'stderr': err.isatty()}}
+
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+		connection.settimeout(timeout)
+		connection.connect(socket_path)
+		connection.sendall(json.dumps(message).encode('utf-8') + b'\n')
+		with connection.makefile('rb') as lines:
+			for line in lines:
+				reply = json.loads(line)
+				if 'stdout' in reply: out.write(reply['stdout'])
+				elif 'stderr' in reply: err.write(reply['stderr'])
+				else:
+					out.flush()
+					return reply
+	raise ValueError('the daemon closed the connection before the job finished')
+
+def is_running(socket_path):
+	"""
+	:returns: True if a daemon answers on socket_path
+	"""
+	try:
+		return request(socket_path, 'ping', timeout=5).get('ok', False)
+	except (OSError, ValueError):
+		return False
+
+def _get_options(args, job):
+	"""
+	Options of a subcommand sent with a job, paths made absolute
+	"""
+	options = dict()
+	for key in JOB_OPTIONS[job]:
+		value = getattr(args, key, None)
+		if value is not None and key in PATH_OPTIONS: value = os.path.abspath(value)
+		elif value is not None and key == 'read_threads': # PATH=N settings
+			value = [f'{os.path.abspath(x.rpartition("=")[0])}={x.rpartition("=")[2]}' if '=' in x else x for x in value]
+		options[key] = value
+	return options
+
+def _perform_client(args):
+	"""
+	Run a subcommand on the daemon given with --daemon
+	:returns: False if the subcommand must be run locally instead, as the daemon is not running or does not
+	support its options
+	"""
+	job = COMMAND_JOBS.get(args.which)
+	if job is None: return False
+	if getattr(args, 'write_blob', False):
+		cprint('--write-blob writes to the working directory, running locally', 'yellow', file=sys.stderr)
+		return False
+
+	if args.which == 'torrent_piece_analysis': print(args.data_file)
+	try:
+		reply = request(args.daemon, job, _get_options(args, job))
+	except ValueError as e:
+		sys.exit(f'Error: {e}')
+	except OSError as e:
+		cprint(f"Daemon not reachable at '{args.daemon}' ({e}), running locally", 'yellow', file=sys.stderr)
+		return False
+
+	if not reply.get('ok'): sys.exit(reply.get('error') or reply.get('code') or 1)
+	return True
+
+def _perform_daemon(args):
+	socket_path = args.socket or get_default_socket_path()
+	if args.status or args.stop:
+		try:
+			reply = request(socket_path, 'status' if args.status else 'shutdown')
+		except (OSError, ValueError) as e:
+			sys.exit(f"Error: no daemon listening on '{socket_path}': {e}")
+		if args.status:
+			from btf.utility.io import print_table
+			print_table(list(reply['result'].items()), STATUS_HEADER)
+		else:
+			cprint(f'Daemon on {socket_path} stopping', 'green')
+		return
+
+	try:
+		daemon = Daemon(socket_path, executor=args.executor, workers=args.workers, jobs=args.jobs or DEFAULT_JOBS, cache=args.cache, cache_size=args.cache_size,
+			torrents=args.torrents or DEFAULT_TORRENTS, silent=args.silent)
+	except (OSError, ValueError) as e:
+		sys.exit(f'Error: could not start daemon: {e}')
+
+	import signal
+	signal.signal(signal.SIGTERM, lambda *_: daemon.shutdown())
+	with daemon:
+		cprint(f'Listening on {daemon.socket_path} ({daemon.executor.kind} pool, {daemon.executor.workers} worker(s), {daemon.jobs} job(s) at a time)', 'green')
+		try:
+			daemon.serve_forever()
+		except KeyboardInterrupt:
+			pass
+	cprint('Daemon stopped', 'green')
@@ -0,0 +1,74 @@
+import os
+import tempfile
+import unittest
+
+from ..benchmarks import synthetic, run, startup
+from ..bittorrent.layout import FileLayout
+from ..bittorrent.metainfo import Metainfo
+from ..bittorrent.pieces import get_table_from_layout
+from ..utorrent import dht, resume
+
+class TestSynthetic(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def analyse(self, torrent_path, content_path):
+		metainfo = Metainfo.from_file(torrent_path)
+		layout = FileLayout(metainfo.get_file_list(content_path), metainfo.piece_length)
+		return [x[3] for x in get_table_from_layout(layout, metainfo.pieces, silent=True, executor='serial')]
+
+	def test_file_sizes(self):
+		self.assertListEqual(synthetic.get_file_sizes(10, 3), [4, 3, 3])
+
+	def test_single_file(self):
+		matches = self.analyse(*synthetic.make_torrent(self.tmp.name, size=100000, piece_length=16384))
+		self.assertEqual(len(matches), 7)
+		self.assertTrue(all(matches))
+
+	def test_multi_file_missing_truncated(self):
+		torrent_path, content_path = synthetic.make_torrent(self.tmp.name, size=200000, piece_length=16384, files=4, missing=1, truncated=1)
+		matches = self.analyse(torrent_path, content_path)
+		self.assertTrue(matches[0])
+		self.assertIsNone(matches[-1])
+
+	def test_dat_files(self):
+		synthetic.make_dht_dat(os.path.join(self.tmp.name, 'dht.dat'), 50)
+		synthetic.make_resume_dat(os.path.join(self.tmp.name, 'resume.dat'), 10, 2, 3)
+		self.assertEqual(len(dht.get_nodes_from_dat(os.path.join(self.tmp.name, 'dht.dat'))), 50)
+		self.assertEqual(len(resume.get_peers_from_dat(os.path.join(self.tmp.name, 'resume.dat'))), 50)
+
+class TestCompare(unittest.TestCase):
+	def test_regression(self):
+		baseline = {'benchmarks': {'a': {'parameters': {'size': 1}, 'mb_per_second': 100.0}}}
+		self.assertListEqual(run.compare({'benchmarks': {'a': {'parameters': {'size': 1}, 'mb_per_second': 90.0}}}, baseline), [])
+		self.assertListEqual(run.compare({'benchmarks': {'a': {'parameters': {'size': 1}, 'mb_per_second': 70.0}}}, baseline),
+			[('a', 'mb_per_second', 100.0, 70.0)])
+
+	def test_different_parameters(self):
+		baseline = {'benchmarks': {'a': {'parameters': {'size': 1}, 'mb_per_second': 100.0}}}
+		self.assertListEqual(run.compare({'benchmarks': {'a': {'parameters': {'size': 2}, 'mb_per_second': 1.0}}}, baseline), [])
+
+class TestStartup(unittest.TestCase):
+	def test_parse_importtime(self):
+		text = 'import time: self [us] | cumulative | imported package\nimport time:       120 |        120 |   _io\nimport time:      2000 |       2500 | btf.btf\n'
+		self.assertListEqual(startup.parse_importtime(text), [('_io', 120, 120), ('btf.btf', 2000, 2500)])
+
+	def test_regression(self):
+		baseline = {'subcommands': {'help': {'import_seconds': 0.05, 'wall_seconds': 0.1}}}
+		self.assertListEqual(startup.compare({'subcommands': {'help': {'import_seconds': 0.055, 'wall_seconds': 0.1}}}, baseline), [])
+		self.assertListEqual(startup.compare({'subcommands': {'help': {'import_seconds': 0.2, 'wall_seconds': 0.1}}}, baseline),
+			[('help', 'import_seconds', 0.05, 0.2)])
+
+	def test_lazy_entry_point(self):
+		with tempfile.TemporaryDirectory() as directory:
+			startup._setup(directory)
+			result = startup.run_startup('uTorrent-dht-nodes', directory)
+		self.assertListEqual(result['heavy_modules'], [])
+		self.assertGreater(result['modules'], 0)
+
+	def test_lazy_help(self): # --help only loads the utilities the options of the entry point (run as __main__) come from
+		with tempfile.TemporaryDirectory() as directory: result = startup.run_startup('help', directory)
+		self.assertListEqual([x for x in result['package_modules'] if not x.startswith('btf.utility')], [])
@@ -1,7 +1,21 @@
+import io
+import os
+import sys
+import hashlib
 import unittest
 import binascii
+import tempfile
+import contextlib
+import unittest.mock
 
-from ..bittorrent import pieces
+from .. import btf
+from ..benchmarks import synthetic
+from ..bittorrent import pieces, library, sampling, carve, merkle, report, multi
+from ..bittorrent.layout import FileLayout, V2Layout
+from ..bittorrent.metainfo import Metainfo
+from ..utility import bencode
+from ..utility.cache import PieceHashCache
+from ..utility.threading import SerialExecutor
 
 class TestPiecesValid(unittest.TestCase): # test file with content 'hello world'
 	def setUp(self):
@@ -31,6 +45,27 @@ class TestPiecesValid(unittest.TestCase): # test file with content 'hello world'
 	def test_list_eq(self):
 		self.assertListEqual(self.result, self.expected)
 
+class TestPiecesFromBytes(unittest.TestCase):
+	def setUp(self):
+		self.digests = [
+			binascii.unhexlify('C4D871AD13AD00FDE9A7BB7FF7ED2543AEC54241'),
+			binascii.unhexlify('9591818C07E900DB7E1E0BC4B884C945E6A61B24')
+		]
+
+	def test_matches_hex_api(self):
+		expected = pieces.get_table_from_pieces(b'68656c6c6f20776f726c640a',
+			[x.hex() for x in self.digests], 12, silent=True, threaded=False)
+		result = pieces.get_table_from_bytes(memoryview(b'hello world\n'), self.digests, 6, silent=True, threaded=False)
+		self.assertListEqual(result, expected)
+
+	def test_mismatch(self):
+		result = pieces.get_table_from_bytes(b'hello World\n', self.digests, 6, silent=True, threaded=False)
+		self.assertListEqual([x[3] for x in result], [True, False])
+
+	def test_hashes_from_pieces_value(self):
+		self.assertListEqual(pieces.get_hashes_from_pieces(b''.join(self.digests)), self.digests)
+		self.assertRaises(ValueError, pieces.get_hashes_from_pieces, b'\x00' * 21)
+
 class TestPiecesWrongPieceLength(unittest.TestCase):
 	def setUp(self):
 		self.hashes = [
@@ -42,3 +77,520 @@ class TestPiecesWrongPieceLength(unittest.TestCase):
 	def test_list_eq(self):
 		self.assertRaises(ValueError,
 			pieces.get_table_from_pieces, self.data, self.hashes, 24, silent=True, threaded=False)
+
+class TestPiecesFromFilesValid(unittest.TestCase): # 'hello world' split so that a piece spans both files
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.files = list()
+		for name, content in [('a', b'hel'), ('b', b'lo world\n')]:
+			path = os.path.join(self.tmp.name, name)
+			with open(path, 'wb') as f: f.write(content)
+			self.files.append((path, len(content)))
+
+		self.hashes = [
+			'C4D871AD13AD00FDE9A7BB7FF7ED2543AEC54241',
+			'9591818C07E900DB7E1E0BC4B884C945E6A61B24'
+		]
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def test_iter_pieces(self):
+		self.assertListEqual(list(FileLayout(self.files, 6).iter_pieces()), [(0, b'hello '), (1, b'world\n')])
+
+	def test_table_matches_hex_blob(self):
+		expected = pieces.get_table_from_pieces(b'68656c6c6f20776f726c640a', self.hashes, 12, silent=True, threaded=False)
+		digests = [binascii.unhexlify(x) for x in self.hashes]
+		result = pieces.get_table_from_files(self.files, digests, 6, silent=True, threaded=False)
+		self.assertListEqual(result, expected)
+
+	def test_missing_file_unverifiable(self):
+		files = [(os.path.join(self.tmp.name, 'missing'), 3), self.files[1]]
+		digests = [binascii.unhexlify(x) for x in self.hashes]
+		result = pieces.get_table_from_files(files, digests, 6, silent=True, threaded=False)
+		self.assertListEqual([x[3] for x in result], [None, True])
+		self.assertIsNone(result[0][1])
+
+	def test_missing_file_filled(self):
+		files = [(os.path.join(self.tmp.name, 'missing'), 3), self.files[1]]
+		self.assertEqual(FileLayout(files, 6).read_piece(0, fill=b'0'), b'000lo ')
+		self.assertRaises(ValueError, FileLayout(files, 6).read_piece, 0)
+
+	def test_cache(self):
+		digests = [binascii.unhexlify(x) for x in self.hashes]
+		with PieceHashCache(os.path.join(self.tmp.name, 'cache.sqlite')) as cache:
+			first = pieces.get_table_from_files(self.files, digests, 6, silent=True, threaded=False, cache=cache)
+			self.assertEqual(len(cache), 2)
+			second = pieces.get_table_from_files(self.files, digests, 6, silent=True, threaded=False, cache=cache)
+		self.assertListEqual(first, second)
+
+	def test_wrong_piece_count(self):
+		self.assertRaises(ValueError,
+			pieces.get_table_from_files, self.files, [b'\x00' * 20] * 2, 4, silent=True, threaded=False)
+
+class TestFileLayout(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.files = list()
+		for name, length, size in [('a', 10, 10), ('empty', 0, 0), ('b', 4, None), ('c', 7, 3)]:
+			path = os.path.join(self.tmp.name, name)
+			if size is not None:
+				with open(path, 'wb') as f: f.write(b'x' * size)
+			self.files.append((path, length))
+		self.layout = FileLayout(self.files, 4)
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def test_segments(self):
+		self.assertEqual(self.layout.num_pieces, 6)
+		self.assertListEqual(self.layout.piece_segments(2), [(0, 8, 2), (2, 0, 2)])
+		self.assertListEqual(self.layout.piece_segments(5), [(3, 6, 1)])
+		self.assertEqual(self.layout.piece_size(5), 1)
+
+	def test_verifiable(self):
+		self.assertListEqual([self.layout.is_verifiable(i) for i in range(6)], [True, True, False, False, False, False])
+
+	def test_coverage(self):
+		coverage = self.layout.get_file_coverage([True, False, None, None, None, None])
+		self.assertListEqual([x[3:] for x in coverage], [[3, 1, 1, 1], [0, 0, 0, 0], [2, 0, 0, 2], [3, 0, 0, 3]])
+
+class TestReport(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.files = list()
+		for name, content in [('a', b'hello '), ('b', b'world, '), ('c', b'again\n')]:
+			path = os.path.join(self.tmp.name, name)
+			with open(path, 'wb') as f: f.write(content)
+			self.files.append((path, len(content)))
+		data = b'hello world, again\n'
+		self.digests = [hashlib.sha1(data[i:i + 4]).digest() for i in range(0, len(data), 4)]
+		self.layout = FileLayout(self.files, 4)
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def test_piece_result(self):
+		result = report.PieceResult(self.digests).update([(0, self.digests[0]), (1, b'\x00' * 20), (3, None), (4, self.digests[4])])
+		self.assertListEqual(list(result), [True, False, None, None, True])
+		self.assertEqual(result[-1], True)
+		self.assertListEqual(result[1:3], [False, None])
+		self.assertRaises(IndexError, result.__getitem__, 5)
+		self.assertEqual(result.get_counts(), (2, 1, 2))
+		self.assertEqual(result.get_states(), report.get_states(list(result)))
+		self.assertIsNone(result.get_digest(2))
+		result.set(1, self.digests[1]) # a later digest replaces the earlier outcome
+		self.assertEqual(result[1], True)
+
+	def test_rows_match_table(self):
+		expected = pieces.get_table_from_layout(self.layout, self.digests, silent=True, executor='serial')
+		result = pieces.get_result_from_layout(self.layout, self.digests, silent=True, executor='serial')
+		self.assertListEqual(list(result.iter_rows()), expected)
+
+	def test_runs(self):
+		states = report.get_states([True, True, None, False, False, True])
+		self.assertListEqual(list(report.iter_runs(states)),
+			[(report.MATCH, 0, 1), (report.UNVERIFIABLE, 2, 2), (report.MISMATCH, 3, 4), (report.MATCH, 5, 5)])
+		self.assertListEqual(list(report.iter_runs(b'')), [])
+
+	def test_run_summary(self):
+		os.remove(self.files[1][0])
+		self.layout = FileLayout(self.files, 4)
+		result = pieces.get_result_from_layout(self.layout, self.digests, silent=True, executor='serial')
+		self.assertListEqual(list(result), [True, None, None, None, True])
+		names = lambda table: [[os.path.basename(x) if i == 4 else x for i, x in enumerate(row)] for row in table]
+		self.assertListEqual(names(result.get_run_summary(self.layout)), [
+			[report.MATCH, 1, 1, 1, 'a', 0, 4],
+			[report.UNVERIFIABLE, 2, 2, 1, 'a', 4, 2], # a run spanning files gives one row per file
+			[report.UNVERIFIABLE, 2, 4, 3, 'b', 0, 7],
+			[report.UNVERIFIABLE, 4, 4, 1, 'c', 0, 3],
+			[report.MATCH, 5, 5, 1, 'c', 3, 3]])
+
+	def test_summary_csv(self):
+		torrent_path, content_path = synthetic.make_torrent(self.tmp.name, size=100000, piece_length=16384, files=2, truncated=1)
+		out_path = os.path.join(self.tmp.name, 'summary.csv')
+		pieces._perform_piece_analysis(torrent_path, content_path, out_path, silent=True, report='summary')
+		with open(out_path, 'r') as f: rows = [x.strip().split(',') for x in f]
+		self.assertListEqual(rows[0], report.RUN_SUMMARY_HEADER)
+		self.assertEqual(sum(int(x[3]) for x in rows[1:]), len(Metainfo.from_file(torrent_path).pieces) + 1) # a piece spans both files
+		self.assertEqual(rows[1][0], report.MATCH)
+		self.assertEqual(rows[-1][0], report.UNVERIFIABLE)
+
+	def test_bitfield(self):
+		self.assertEqual(report.parse_bitfield(b'\xa0\x80', 9), bytes([1, 0, 1, 0, 0, 0, 0, 0, 1]))
+		self.assertRaises(ValueError, report.parse_bitfield, b'\xff', 9)
+		states = report.get_claim_states(report.get_states([True, False, None, True, False, None]), bytes([1, 1, 1, 0, 0, 0]))
+		self.assertListEqual([report.CLAIM_STATUSES[x] for x in states], [report.MATCH, report.CLAIMED_MISMATCH, report.CLAIMED_MISSING,
+			report.UNCLAIMED_PRESENT, report.NOT_CLAIMED, report.NOT_CLAIMED])
+
+	def test_select(self):
+		result = pieces.get_result_from_layout(self.layout, self.digests, silent=True, executor='serial', select=bytes([1, 0, 1, 0, 1]))
+		self.assertListEqual(list(result), [True, None, True, None, True])
+
+	def test_resume_claims(self):
+		torrent_path, content_path = synthetic.make_torrent(self.tmp.name, size=8 * 16384, piece_length=16384)
+		with open(content_path, 'r+b') as f: f.write(b'x') # piece 1 fails
+		metainfo = Metainfo.from_file(torrent_path)
+		resume_path = os.path.join(self.tmp.name, 'resume.dat')
+		with open(resume_path, 'wb') as f: # claims pieces 1 to 4 and 8
+			f.write(bencode.encode({'.fileguard': 'x', 'other.torrent': {'info': bytes(20), 'have': b'\xff'},
+				'synthetic.torrent': {'info': metainfo.info_hash, 'have': b'\xf1'}}))
+
+		for check_unclaimed, expected in ((False, [report.CLAIMED_MISMATCH, report.MATCH, report.NOT_CLAIMED, report.MATCH]),
+				(True, [report.CLAIMED_MISMATCH, report.MATCH, report.UNCLAIMED_PRESENT, report.MATCH])):
+			out_path = os.path.join(self.tmp.name, 'claims.csv')
+			with contextlib.redirect_stdout(io.StringIO()):
+				pieces._perform_piece_analysis(torrent_path, content_path, out_path, silent=True, executor='serial', report='summary',
+					resume=resume_path, check_unclaimed=check_unclaimed)
+			with open(out_path, 'r') as f: rows = [x.strip().split(',') for x in f][1:]
+			self.assertListEqual([x[0] for x in rows], expected)
+			self.assertListEqual([int(x[3]) for x in rows], [1, 3, 3, 1])
+
+class TestMetainfo(unittest.TestCase):
+	def setUp(self):
+		self.digests = [hashlib.sha1(b'hello ').digest(), hashlib.sha1(b'world\n').digest()]
+		self.info = {
+			'files': [
+				{'length': 3, 'path': [b'dir', b'caf\xe9']}, # latin-1 name, not valid UTF-8
+				{'length': 9, 'path': ['b']}
+			],
+			'name': 'test',
+			'piece length': 6,
+			'pieces': b''.join(self.digests),
+			'private': 1 # sorts after pieces
+		}
+		self.metainfo = Metainfo(bencode.encode({'announce': 'http://tracker', 'info': self.info}))
+
+	def test_pieces(self):
+		self.assertEqual(len(self.metainfo.pieces), 2)
+		self.assertListEqual(list(self.metainfo.pieces), self.digests)
+		self.assertEqual(self.metainfo.pieces[-1], self.digests[1])
+
+	def test_info_hash(self):
+		self.assertEqual(self.metainfo.info_hash, hashlib.sha1(bencode.encode(self.info)).digest())
+
+	def test_keys_after_pieces(self):
+		self.assertEqual(self.metainfo.info[b'private'], 1)
+		self.assertEqual(self.metainfo.piece_length, 6)
+
+	def test_files(self):
+		files = self.metainfo.get_file_list('root')
+		self.assertEqual(files[0][0].encode('utf-8', errors='surrogateescape'), os.path.join(b'root', b'dir', b'caf\xe9'))
+		self.assertListEqual([x[1] for x in files], [3, 9])
+		self.assertEqual(self.metainfo.total_length, 12)
+
+	def test_invalid_files(self): # structurally wrong entries are reported as invalid, not as a crash
+		for files in (b'l' + b'l' * 3000 + b'e' * 3000 + b'e', b'ld6:lengthi3e4:pathi1eee', b'i1e'):
+			metainfo = Metainfo(b'd4:infod5:files' + files + b'12:piece lengthi6e6:pieces0:ee')
+			self.assertRaises(ValueError, lambda: metainfo.files)
+			self.assertSetEqual(metainfo.padding_files, set())
+
+class TestTorrentLibrary(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		content = {'a': b'0123456789' * 3, 'b': b'abcdefghij'}
+		data = content['a'] + content['b']
+		info = {
+			'files': [{'length': len(content[x]), 'path': [x]} for x in ['a', 'b']],
+			'name': 'test',
+			'piece length': 8,
+			'pieces': b''.join(hashlib.sha1(data[i:i+8]).digest() for i in range(0, len(data), 8))
+		}
+		self.torrent_path = os.path.join(self.tmp.name, 'test.torrent')
+		with open(self.torrent_path, 'wb') as f: f.write(bencode.encode({'info': info}))
+
+		self.content = os.path.join(self.tmp.name, 'content')
+		os.mkdir(self.content)
+		with open(os.path.join(self.content, 'a'), 'wb') as f: f.write(content['a'])
+		with open(os.path.join(self.content, 'b'), 'wb') as f: f.write(content['b'])
+		with open(os.path.join(self.content, 'other'), 'wb') as f: f.write(b'x' * 30) # same size as a
+
+		self.library = library.TorrentLibrary(':memory:')
+
+	def tearDown(self):
+		self.library.close()
+		self.tmp.cleanup()
+
+	def test_contained_pieces(self):
+		self.assertEqual(library.get_contained_pieces(0, 30, 8, 40), range(0, 3))
+		self.assertEqual(library.get_contained_pieces(30, 10, 8, 40), range(4, 5)) # last, short piece
+		self.assertEqual(library.get_contained_pieces(3, 4, 8, 40), range(1, 0))
+
+	def test_add_duplicate(self):
+		self.assertTupleEqual(self.library.add_torrents([self.tmp.name], silent=True), (1, 0, 0))
+		self.assertTupleEqual(self.library.add_torrents([self.torrent_path], silent=True), (0, 1, 0))
+
+	def test_match(self):
+		self.library.add_torrents([self.torrent_path], silent=True)
+		table, summary = self.library.match_content(self.content, silent=True, executor='serial')
+		status = {os.path.basename(x[0]): x[6] for x in table}
+		self.assertDictEqual(status, {'a': library.MATCH, 'b': library.MATCH, 'other': library.MISMATCH})
+		self.assertListEqual(summary[0][2:], [2, 2, 40, 40])
+
+	def test_match_hybrid(self): # padding files count in the offsets of the pieces but are not matched as content
+		torrent_path, content_path = synthetic.make_torrent(self.tmp.name, 'hybrid', size=250000, piece_length=32768, files=5, version='hybrid')
+		metainfo = Metainfo.from_file(torrent_path)
+		self.assertEqual(metainfo.total_length, 4 * 65536 + 50000) # 5 files of 50000 bytes, padded to 2 pieces but the last
+		self.assertEqual(metainfo.content_length, 250000)
+		self.library.add_torrents([torrent_path], silent=True)
+		table, summary = self.library.match_content(content_path, silent=True, executor='serial')
+		matches = [(os.path.basename(x[0]), os.path.basename(x[3]), x[4]) for x in table if x[6] == library.MATCH] # files have equal sizes
+		self.assertListEqual(sorted(matches), [(f'file{i:05d}.bin', f'file{i:05d}.bin', 2 if i == 4 else 1) for i in range(5)])
+		self.assertListEqual(summary[0][2:], [5, 5, 250000, 250000])
+
+class TestSampling(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.files = list()
+		data = b''
+		for name, size in [('a', 400), ('b', 40), ('c', 400)]:
+			path = os.path.join(self.tmp.name, name)
+			content = bytes([len(self.files)]) * size
+			with open(path, 'wb') as f: f.write(content)
+			self.files.append((path, size))
+			data += content
+		self.layout = FileLayout(self.files, 8)
+		self.digests = [hashlib.sha1(data[i:i+8]).digest() for i in range(0, len(data), 8)]
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def test_stratified_order(self):
+		order = sampling.get_stratified_order(self.layout, seed=1)
+		self.assertListEqual(sorted(order), list(range(self.layout.num_pieces)))
+		self.assertEqual(len({self.layout.piece_segments(i)[0][0] for i in order[:3]}), 3) # one piece from each file first
+
+	def test_sample_size(self):
+		self.assertEqual(sampling.get_sample_size('10', 105), 10)
+		self.assertEqual(sampling.get_sample_size('10%', 105), 11)
+		self.assertEqual(sampling.get_sample_size('500', 105), 105)
+		self.assertRaises(ValueError, sampling.get_sample_size, 'many', 105)
+
+	def test_interval(self):
+		low, high = sampling.get_wilson_interval(40, 40, 0.95)
+		self.assertGreater(low, 0.9)
+		self.assertAlmostEqual(high, 1.0)
+		self.assertTupleEqual(sampling.get_wilson_interval(5, 10, 0.95, population=10), (0.5, 0.5))
+
+	def test_count(self):
+		result = sampling.sample_layout(self.layout, self.digests, SerialExecutor(), count=10, seed=1, silent=True)
+		self.assertEqual(result.checked, 10)
+		self.assertEqual(result.matched, 10)
+
+	def test_early_stop(self):
+		wrong = [b'\x00' * 20] * len(self.digests)
+		result = sampling.sample_layout(self.layout, wrong, SerialExecutor(), confidence=0.95, batch_size=16, silent=True)
+		self.assertEqual(result.verdict, sampling.MISMATCH)
+		self.assertLess(result.checked, self.layout.num_pieces)
+		self.assertEqual(result.looks, -(-self.layout.num_pieces // 16))
+		self.assertIn(f'over {result.looks} looks', str(result))
+
+	def test_looks(self): # the interval of each look is wider than a single test at the same confidence
+		result = sampling.SampleResult([[1, '', '', True]] * 20, 105, 0.95, sampling.DEFAULT_MATCH_THRESHOLD, looks=5)
+		self.assertLess(result.interval[0], sampling.get_wilson_interval(20, 20, 0.95, 105)[0])
+
+	def test_invalid_confidence(self):
+		for confidence in (0, 1, 1.5, -1):
+			self.assertRaises(ValueError, sampling.sample_layout, self.layout, self.digests, SerialExecutor(), confidence=confidence, silent=True)
+
+class TestCommandLine(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def run_main(self, *argv):
+		out = io.StringIO()
+		with unittest.mock.patch.object(sys, 'argv', ['btf'] + list(argv)), contextlib.redirect_stdout(out): btf.main()
+		return out.getvalue()
+
+	def test_summary_without_out(self): # the run summary is printed when there is no output to write it to
+		for version in (1, 2):
+			torrent_path, content_path = synthetic.make_torrent(self.tmp.name, f'v{version}', size=100000, piece_length=16384, files=2,
+				truncated=1, version=version)
+			output = self.run_main('torrent-piece-analysis', '-t', torrent_path, '-d', content_path, '--report', 'summary', '--no-cache',
+				'--executor', 'serial')
+			self.assertIn('First Piece', output)
+			self.assertIn(report.UNVERIFIABLE, output)
+
+	def test_invalid_sample_confidence(self):
+		torrent_path, content_path = synthetic.make_torrent(self.tmp.name, size=100000, piece_length=16384)
+		output = self.run_main('torrent-piece-analysis', '-t', torrent_path, '-d', content_path, '--sample-confidence', '1.5', '--no-cache')
+		self.assertIn('Invalid confidence level 1.5', output)
+		self.assertNotIn('Sampling', output)
+
+class TestMultiAnalysis(unittest.TestCase): # a pack of files a and b and a single file torrent of a, saved as a hard link
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		content = {'a': b'0123456789' * 3, 'b': b'abcdefghij'}
+		data = content['a'] + content['b']
+		os.mkdir(os.path.join(self.tmp.name, 'pack'))
+		for name in ['a', 'b']:
+			with open(os.path.join(self.tmp.name, 'pack', name), 'wb') as f: f.write(content[name])
+		os.link(os.path.join(self.tmp.name, 'pack', 'a'), os.path.join(self.tmp.name, 'a'))
+		with open(os.path.join(self.tmp.name, 'pack', 'b'), 'r+b') as f: f.write(b'X') # first piece of b fails
+
+		def digests(data):
+			return b''.join(hashlib.sha1(data[i:i+8]).digest() for i in range(0, len(data), 8))
+		infos = [
+			{'files': [{'length': len(content[x]), 'path': [x]} for x in ['a', 'b']], 'name': 'pack', 'piece length': 8, 'pieces': digests(data)},
+			{'length': len(content['a']), 'name': 'a', 'piece length': 8, 'pieces': digests(content['a'])},
+		]
+		self.torrent_paths = list()
+		for i, info in enumerate(infos):
+			self.torrent_paths.append(os.path.join(self.tmp.name, f'{i}.torrent'))
+			with open(self.torrent_paths[-1], 'wb') as f: f.write(bencode.encode({'info': info}))
+		self.torrents = multi.load_torrents(self.torrent_paths, self.tmp.name, silent=True)
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def test_shared_units(self):
+		units, mapping = multi.get_shared_units([x.layout for x in self.torrents])
+		self.assertEqual(len(units), 6) # 5 pieces of the pack and the short last piece of a
+		self.assertListEqual([x for _, x in mapping[1]], [0, 1, 2, 5])
+
+	def test_verify(self):
+		results, shared = multi.verify_torrents(self.torrents, SerialExecutor(), silent=True)
+		self.assertListEqual(shared, [3, 3])
+		self.assertListEqual(list(results[0]), [True, True, True, False, True])
+		self.assertListEqual(list(results[1]), [True] * 4)
+		for torrent, result in zip(self.torrents, results): # same digests as analysing each torrent alone
+			single = pieces.get_result_from_layout(torrent.layout, torrent.metainfo.pieces, silent=True, executor='serial')
+			self.assertEqual(result.digests, single.digests)
+
+class TestCarve(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		content = b'0123456789abcdefXYZ' # pieces '01234567', '89abcdef', 'XYZ'
+		info = {
+			'length': len(content),
+			'name': 'test',
+			'piece length': 8,
+			'pieces': b''.join(hashlib.sha1(content[i:i+8]).digest() for i in range(0, len(content), 8))
+		}
+		self.index = carve.PieceHashIndex()
+		self.index.add('test.torrent', Metainfo(bencode.encode({'info': info})))
+
+		self.image = os.path.join(self.tmp.name, 'image')
+		with open(self.image, 'wb') as f: f.write(b'\xff' * 12 + content + b'\xff' * 9)
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def test_carve(self):
+		table, stats = carve.carve_image(self.image, self.index, alignment=4, chunk_size=8, executor='serial', silent=True)
+		self.assertListEqual([x[2:] for x in table], [[1, 12, 8], [2, 20, 8], [3, 28, 3]])
+		self.assertEqual(stats['bytes_scanned'], 40)
+
+	def test_misaligned(self):
+		table, _ = carve.carve_image(self.image, self.index, alignment=8, chunk_size=8, executor='serial', silent=True)
+		self.assertListEqual(table, [])
+
+	def test_resume(self):
+		state = os.path.join(self.tmp.name, 'state.json')
+		first, _ = carve.carve_image(self.image, self.index, alignment=4, chunk_size=8, state_path=state, executor='serial', silent=True)
+		second, stats = carve.carve_image(self.image, self.index, alignment=4, chunk_size=8, state_path=state, executor='serial', silent=True)
+		self.assertListEqual(first, second)
+		self.assertEqual(stats['bytes_scanned'], 0)
+		self.assertRaises(ValueError,
+			carve.carve_image, self.image, self.index, alignment=2, chunk_size=8, state_path=state, executor='serial', silent=True)
+
+	def test_hybrid(self): # the last piece of every file but the last is completed by padding, only the last piece is short
+		torrent_path, content_path = synthetic.make_torrent(self.tmp.name, 'hybrid', size=250000, piece_length=32768, files=5, version='hybrid')
+		index = carve.PieceHashIndex()
+		index.add(torrent_path)
+		self.assertListEqual(sorted(index.get_windows()), [50000 % 32768, 32768])
+
+		image = os.path.join(self.tmp.name, 'hybrid.img')
+		with open(image, 'wb') as f, open(os.path.join(content_path, '000', 'file00001.bin'), 'rb') as data:
+			f.write(bytes(4096) + data.read() + bytes(32768 - 50000 % 32768)) # second file and its padding
+		table, _ = carve.carve_image(image, index, alignment=4096, chunk_size=1, executor='serial', silent=True)
+		self.assertListEqual([x[2:] for x in table], [[3, 4096, 32768], [4, 36864, 32768]])
+
+class TestMerkle(unittest.TestCase):
+	def test_num_leaves(self):
+		self.assertListEqual([merkle.get_num_leaves(x) for x in (0, 1, 2, 3, 4, 5, 17)], [1, 1, 2, 4, 4, 8, 32])
+
+	def test_file_root_from_piece_layer(self): # the root over the piece layer is the root over all blocks of the file
+		leaves = [hashlib.sha256(bytes([i])).digest() for i in range(11)]
+		piece_length = 4 * merkle.BLOCK_SIZE
+		layer = [merkle.get_root(leaves[i:i + 4], 4) for i in range(0, len(leaves), 4)]
+		self.assertEqual(merkle.get_file_root(layer, piece_length), merkle.get_root(leaves, 16))
+
+	def test_pad_hash(self):
+		self.assertEqual(merkle.get_pad_hash(2), hashlib.sha256(bytes(64)).digest())
+
+class TestV2(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def analyse(self, version, **kwargs):
+		torrent_path, content_path = synthetic.make_torrent(self.tmp.name, size=300000, piece_length=32768, version=version, **kwargs)
+		metainfo = Metainfo.from_file(torrent_path)
+		layout = V2Layout(metainfo, content_path)
+		with SerialExecutor() as executor:
+			return metainfo, layout, list(pieces.iter_table_from_v2_layout(layout, metainfo.pieces, executor, silent=True))
+
+	def test_v2(self):
+		metainfo, layout, table = self.analyse(2, files=3)
+		self.assertTrue(metainfo.is_v2)
+		self.assertFalse(metainfo.is_hybrid)
+		self.assertTrue(metainfo.is_multi_file)
+		self.assertEqual(metainfo.total_length, 300000)
+		self.assertEqual(len(table), 12) # 100000 bytes per file, 4 pieces each
+		self.assertTrue(all(x[5] for x in table))
+		self.assertTrue(all(x[6] is None for x in table))
+
+	def test_hybrid(self):
+		metainfo, layout, table = self.analyse('hybrid', files=3, truncated=1)
+		self.assertTrue(metainfo.is_hybrid)
+		self.assertEqual(len(metainfo.pieces), 12) # files are padded to whole pieces
+		self.assertListEqual([x[2] for x in table], list(range(1, 13)))
+		self.assertListEqual([x[6] for x in table], [True] * 9 + [None] * 3) # the truncated file keeps one of its pieces
+		self.assertListEqual([x[5] for x in table], [True] * 9 + [None] * 3)
+		extents = layout.get_extents(0, 11)
+		self.assertListEqual([x[:2] + x[3:] for x in extents], [(1, 4, 0, 100000), (5, 8, 0, 100000), (9, 12, 0, 100000)])
+
+	def test_prefetch(self):
+		torrent_path, content_path = synthetic.make_torrent(self.tmp.name, size=300000, piece_length=32768, files=3, version='hybrid')
+		metainfo = Metainfo.from_file(torrent_path)
+		layout = FileLayout(metainfo.get_file_list(content_path), metainfo.piece_length, metainfo.padding_files)
+		tables = [pieces.get_table_from_layout(layout, metainfo.pieces, silent=True, executor=executor, prefetch=count, read_threads=2)
+			for executor, count in (('serial', 0), ('serial', 2), ('thread', 4))]
+		self.assertListEqual(tables[0], tables[1])
+		self.assertListEqual(tables[0], tables[2])
+		v2_layout = V2Layout(metainfo, content_path)
+		with SerialExecutor() as executor:
+			tables = [list(pieces.iter_table_from_v2_layout(v2_layout, metainfo.pieces, executor, silent=True, prefetch=x)) for x in (0, 2)]
+		self.assertListEqual(tables[0], tables[1])
+
+	def test_hybrid_v1_padding(self):
+		torrent_path, content_path = synthetic.make_torrent(self.tmp.name, size=300000, piece_length=32768, files=3, version='hybrid')
+		metainfo = Metainfo.from_file(torrent_path)
+		self.assertEqual(len(metainfo.padding_files), 2)
+		layout = FileLayout(metainfo.get_file_list(content_path), metainfo.piece_length, metainfo.padding_files)
+		table = pieces.get_table_from_layout(layout, metainfo.pieces, silent=True, executor='serial')
+		self.assertTrue(all(x[3] for x in table))
+
+	def test_zero_blocks(self):
+		torrent_path, content_path = synthetic.make_torrent(self.tmp.name, size=100000, piece_length=32768, version=2)
+		with open(content_path, 'r+b') as f:
+			f.seek(3 * merkle.BLOCK_SIZE)
+			f.write(bytes(merkle.BLOCK_SIZE))
+		metainfo = Metainfo.from_file(torrent_path)
+		with SerialExecutor() as executor:
+			table = list(pieces.iter_table_from_v2_layout(V2Layout(metainfo, content_path), None, executor, silent=True))
+		self.assertListEqual([x[5] for x in table], [True, False, True, True])
+		self.assertEqual(table[1][7], '3')
+
+	def test_invalid_piece_layer(self):
+		torrent_path, content_path = synthetic.make_torrent(self.tmp.name, size=100000, piece_length=32768, version=2)
+		metainfo = Metainfo.from_file(torrent_path)
+		root = next(iter(metainfo.piece_layers))
+		metainfo.piece_layers[root] = bytes(len(metainfo.piece_layers[root]))
+		self.assertRaises(ValueError, V2Layout, metainfo, content_path)
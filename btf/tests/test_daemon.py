@@ -0,0 +1,78 @@
+import io
+import os
+import unittest
+import tempfile
+import threading
+import contextlib
+
+from .. import daemon
+from ..benchmarks import synthetic
+from ..bittorrent import pieces
+
+class TestDaemon(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.torrent_path, self.content_path = synthetic.make_torrent(self.tmp.name, size=200000, piece_length=16384, files=2, truncated=1)
+		self.socket_path = os.path.join(self.tmp.name, 'd.sock')
+		self.daemon = daemon.Daemon(self.socket_path, executor='thread', workers=2, cache=os.path.join(self.tmp.name, 'cache.sqlite'), silent=True)
+		self.thread = threading.Thread(target=self.daemon.serve_forever)
+		self.thread.start()
+
+	def tearDown(self):
+		self.daemon.shutdown()
+		self.thread.join()
+		self.daemon.close()
+		self.tmp.cleanup()
+
+	def request(self, job, args=None):
+		out, err = io.StringIO(), io.StringIO()
+		reply = daemon.request(self.socket_path, job, args, out=out, err=err)
+		return reply, out.getvalue()
+
+	def test_piece_analysis(self):
+		remote_path = os.path.join(self.tmp.name, 'remote.csv')
+		reply, output = self.request('torrent-piece-analysis', {'torrent_file': self.torrent_path, 'data_file': self.content_path, 'out': remote_path})
+		self.assertTrue(reply['ok'])
+		self.assertIn('Starting piece analysis', output)
+
+		local_path = os.path.join(self.tmp.name, 'local.csv')
+		with contextlib.redirect_stdout(io.StringIO()):
+			pieces._perform_piece_analysis(self.torrent_path, self.content_path, local_path, silent=True, executor='serial')
+		with open(remote_path, 'rb') as remote, open(local_path, 'rb') as local: self.assertEqual(remote.read(), local.read())
+
+		reply, _ = self.request('torrent-piece-analysis', {'torrent_file': self.torrent_path, 'data_file': self.content_path, 'silent': True})
+		status = self.request('status')[0]['result']
+		self.assertEqual((status['torrent_cache_misses'], status['torrent_cache_hits']), (1, 1))
+		self.assertEqual((status['completed'], status['failed']), (2, 0))
+		self.assertEqual(status['idle_cache_connections'], 1)
+
+	def test_concurrent_jobs(self):
+		results = list()
+		def run(i):
+			results.append(self.request('torrent-piece-analysis', {'torrent_file': self.torrent_path, 'data_file': self.content_path, 'no_cache': True,
+				'out': os.path.join(self.tmp.name, f'{i}.csv')})[0]['ok'])
+		threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+		for thread in threads: thread.start()
+		for thread in threads: thread.join()
+		self.assertListEqual(results, [True] * 4)
+		contents = set()
+		for i in range(4):
+			with open(os.path.join(self.tmp.name, f'{i}.csv'), 'rb') as f: contents.add(f.read())
+		self.assertEqual(len(contents), 1)
+
+	def test_decode_jobs(self):
+		dat_path = os.path.join(self.tmp.name, 'dht.dat')
+		synthetic.make_dht_dat(dat_path, 20)
+		out_path = os.path.join(self.tmp.name, 'nodes.csv')
+		reply, output = self.request('uTorrent-dht-nodes', {'dat': dat_path, 'out': out_path, 'silent': True})
+		self.assertTrue(reply['ok'])
+		with open(out_path, 'r') as f: self.assertEqual(len(f.readlines()), 21)
+
+		reply, _ = self.request('uTorrent-resume-peers', {'dat': os.path.join(self.tmp.name, 'missing.dat')})
+		self.assertEqual((reply['ok'], reply['error']), (False, 'Invalid file')) # sys.exit of the subcommand
+
+	def test_invalid_job(self):
+		reply, _ = self.request('carve')
+		self.assertFalse(reply['ok'])
+		self.assertTrue(daemon.is_running(self.socket_path))
+		self.assertRaises(ValueError, daemon.Daemon, self.socket_path)
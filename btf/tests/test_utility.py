@@ -0,0 +1,276 @@
+import os
+import csv
+import json
+import mmap
+import sqlite3
+import io
+import hashlib
+import argparse
+import tempfile
+import unittest
+
+from ..utility import bencode
+from ..utility import threading
+from ..utility import stats
+from ..utility import progress
+from ..utility import prefetch
+from ..utility.cache import PieceHashCache
+from ..utility.io import open_sink, open_args_sink, write_args_table, CsvSink, JsonLinesSink, SqliteSink
+
+class TestBencodeDecode(unittest.TestCase):
+	def setUp(self):
+		self.data = b'd3:agei42e4:listli-1e3:fooe4:name5:helloe'
+
+	def test_decode(self):
+		self.assertDictEqual(bencode.decode(self.data), {b'age': 42, b'list': [-1, b'foo'], b'name': b'hello'})
+
+	def test_round_trip(self):
+		self.assertEqual(bencode.encode(bencode.decode(self.data)), self.data)
+
+	def test_iter_dict_spans(self):
+		spans = {key: self.data[start:end] for key, start, end in bencode.iter_dict(self.data)}
+		self.assertDictEqual(spans, {b'age': b'i42e', b'list': b'li-1e3:fooe', b'name': b'5:hello'})
+
+	def test_string_with_colon_and_delimiters(self):
+		self.assertEqual(bencode.decode(b'6:a:e:d:'), b'a:e:d:')
+
+	def test_mmap(self):
+		with tempfile.TemporaryFile() as f:
+			f.write(self.data)
+			f.flush()
+			with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+				self.assertEqual(bencode.skip(buffer, 0), len(self.data))
+				self.assertEqual(bencode.decode(buffer)[b'age'], 42)
+
+	def test_memoryview(self): # views of a whole buffer use it directly, slices are read in place
+		data = b'xx' + self.data + b'yy'
+		view = memoryview(data)[2:-2]
+		self.assertDictEqual(bencode.decode(view), bencode.decode(self.data))
+		self.assertListEqual(list(bencode.iter_dict(view)), list(bencode.iter_dict(self.data)))
+		self.assertIs(bencode._buffer(memoryview(self.data)), self.data)
+		self.assertRaises(bencode.BencodeError, bencode.decode, memoryview(b'xx1')[2:])
+		self.assertRaisesRegex(bencode.BencodeError, 'exceeds end', bencode.decode, memoryview(b'x1' + b'0' * 100 + b':abc')[1:]) # delimiter beyond the first window
+
+class TestBencodeInvalid(unittest.TestCase):
+	def test_truncated(self):
+		self.assertRaises(bencode.BencodeError, bencode.decode, b'd3:agei42e')
+
+	def test_string_too_long(self):
+		self.assertRaises(bencode.BencodeError, bencode.decode, b'10:abc')
+
+	def test_trailing_data(self):
+		self.assertRaises(bencode.BencodeError, bencode.decode, b'i1ei2e')
+
+	def test_invalid_byte(self):
+		self.assertRaises(bencode.BencodeError, bencode.decode, b'x')
+
+	def test_non_string_key(self):
+		self.assertRaises(bencode.BencodeError, bencode.decode, b'di1ei2ee')
+
+	def test_non_canonical(self):
+		for data in (b'i03e', b'i-0e', b'i 3e', b'i3 e', b'i+3e', b'ie', b'03:abc', b'-1:', b' 3:abc', b'+3:abc'):
+			self.assertRaises(bencode.BencodeError, bencode.decode, data)
+			self.assertRaises(bencode.BencodeError, bencode.skip, data)
+		self.assertListEqual(bencode.decode(b'li0ei-3e0:e'), [0, -3, b''])
+
+	def test_deep_nesting(self): # nesting far beyond the recursion limit is decoded or rejected as bencode
+		self.assertRaises(bencode.BencodeError, bencode.decode, b'd4:infod5:filesl' + b'l' * 3000 + b'e' * 2999 + b'ee')
+		value = bencode.decode(b'l' * 3000 + b'e' * 3000)
+		for _ in range(2999): value = value[0]
+		self.assertListEqual(value, [])
+		self.assertRaises(bencode.BencodeError, bencode.decode, b'd3:fooe')
+
+class TestExecutors(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.tmp.name, 'data')
+		with open(self.path, 'wb') as f: f.write(b'hello world\n')
+		self.units = [((self.path, 0, 6),), ((self.path, 6, 3), (self.path, 9, 3))]
+		self.expected = [hashlib.sha1(b'hello ').digest(), hashlib.sha1(b'world\n').digest()]
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def test_hash_segments_past_end(self):
+		self.assertRaises(ValueError, threading.hash_segments, ((self.path, 10, 6),))
+
+	def test_backends(self):
+		for kind in ['serial', 'thread', 'process']:
+			with threading.get_executor(kind, 2) as executor:
+				self.assertEqual(executor.kind, kind)
+				self.assertListEqual(list(executor.map(threading.hash_segments, self.units)), self.expected)
+
+	def test_bounded_submission(self): # items are pulled as results are consumed, not all up front
+		pulled = list()
+		def units():
+			for i in range(2000):
+				pulled.append(i)
+				yield self.units[i % 2]
+		for kind in ['thread', 'process']:
+			pulled.clear()
+			with threading.get_executor(kind, 2, 4) as executor:
+				results = executor.map(threading.hash_segments, units())
+				self.assertEqual(next(results), self.expected[0])
+				self.assertLessEqual(len(pulled), 4 * 2 * 4)
+				self.assertEqual(sum(1 for _ in results), 1999)
+			self.assertEqual(len(pulled), 2000)
+
+	def test_auto(self):
+		with threading.get_executor('auto', 1) as executor: self.assertEqual(executor.kind, 'serial')
+		with threading.get_executor('auto', 2, piece_length=4 * 1024 * 1024) as executor: self.assertEqual(executor.kind, 'thread')
+		with threading.get_executor('auto', 2, piece_length=16 * 1024) as executor: self.assertEqual(executor.kind, 'process')
+
+	def test_invalid_kind(self):
+		self.assertRaises(ValueError, threading.get_executor, 'gpu')
+
+class TestPieceHashCache(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.tmp.name, 'data')
+		with open(self.path, 'wb') as f: f.write(b'hello world\n')
+		self.cache = PieceHashCache(os.path.join(self.tmp.name, 'cache', 'hashes.sqlite'), max_entries=10)
+
+	def tearDown(self):
+		self.cache.close()
+		self.tmp.cleanup()
+
+	def test_round_trip(self):
+		key = self.cache.get_key(((self.path, 0, 6),))
+		self.assertDictEqual(self.cache.get_many([key]), {})
+		self.cache.put_many([(key, b'd' * 20)])
+		self.assertDictEqual(self.cache.get_many([key]), {key: b'd' * 20})
+
+	def test_key_changes_with_range_and_file(self):
+		key = self.cache.get_key(((self.path, 0, 6),))
+		self.assertNotEqual(key, self.cache.get_key(((self.path, 6, 6),)))
+		os.utime(self.path, ns=(0, 0))
+		with PieceHashCache(self.cache.path) as cache:
+			self.assertNotEqual(key, cache.get_key(((self.path, 0, 6),)))
+
+	def test_eviction(self):
+		self.cache.put_many((bytes([i]) * 20, b'd' * 20) for i in range(20))
+		self.assertLessEqual(len(self.cache), 10)
+
+	def test_clear(self):
+		self.cache.put_many([(b'k' * 20, b'd' * 20)])
+		self.cache.clear()
+		self.assertEqual(len(self.cache), 0)
+
+class TestResultSinks(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.header = ['#', 'IPv4']
+		self.rows = [[1, '10.0.0.1'], [2, '10.0.0.2']]
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def path(self, name):
+		return os.path.join(self.tmp.name, name)
+
+	def test_format_from_extension(self):
+		for name, kind in [('a.csv', CsvSink), ('a.jsonl', JsonLinesSink), ('a.sqlite', SqliteSink), ('a.txt', CsvSink)]:
+			with open_sink(self.path(name), self.header) as sink: self.assertIsInstance(sink, kind)
+
+	def test_invalid_format(self):
+		self.assertRaises(ValueError, open_sink, self.path('a.csv'), self.header, format='xml')
+
+	def test_csv_append_with_source(self):
+		for source in ['first', 'second']:
+			with open_sink(self.path('a.csv'), self.header, append=True, source=source) as sink: sink.write_rows(self.rows)
+		with open(self.path('a.csv'), newline='') as csv_file:
+			rows = list(csv.reader(csv_file))
+		self.assertListEqual(rows[0], ['Source', '#', 'IPv4'])
+		self.assertEqual(len(rows), 5)
+		self.assertListEqual(rows[3], ['second', '1', '10.0.0.1'])
+
+	def test_args_sink(self): # --out consolidates the inputs with their source, --csv writes one file per input
+		args = argparse.Namespace(out=self.path('out.csv'), format=None, append=False, csv=self.tmp.name)
+		with open_args_sink(args, self.header) as sink:
+			write_args_table(args, sink, 'hex', self.rows, 'one.csv', self.header)
+		with open(self.path('out.csv'), newline='') as csv_file: self.assertListEqual(list(csv.reader(csv_file))[1], ['hex', '1', '10.0.0.1'])
+		with open(self.path('one.csv'), newline='') as csv_file: self.assertListEqual(next(csv.reader(csv_file)), self.header)
+		self.assertIsNone(open_args_sink(argparse.Namespace(out=None), self.header))
+
+	def test_jsonl(self):
+		with open_sink(self.path('a.jsonl'), self.header) as sink: self.assertEqual(sink.write_rows(self.rows), 2)
+		with open(self.path('a.jsonl')) as jsonl_file:
+			self.assertDictEqual(json.loads(jsonl_file.readline()), {'#': 1, 'IPv4': '10.0.0.1'})
+
+	def test_sqlite_replace_and_append(self):
+		for append in [False, False, True]:
+			with open_sink(self.path('a.sqlite'), self.header, append=append) as sink: sink.write_rows(self.rows)
+		connection = sqlite3.connect(self.path('a.sqlite'))
+		self.assertEqual(connection.execute('SELECT COUNT(*) FROM results').fetchone()[0], 4)
+		connection.close()
+
+	def test_sqlite_append_column_mismatch(self):
+		with open_sink(self.path('a.sqlite'), self.header) as sink: sink.write_rows(self.rows)
+		self.assertRaises(ValueError, open_sink, self.path('a.sqlite'), self.header, append=True, source='x')
+
+class TestStats(unittest.TestCase):
+	def tearDown(self):
+		stats.disable()
+
+	def test_disabled(self):
+		with stats.stage('x'): pass
+		stats.count('y')
+		self.assertIsNone(stats.get_collector())
+
+	def test_stages_and_executor(self):
+		collector = stats.enable()
+		with stats.stage('x'): pass
+		with stats.stage('x'): pass
+		stats.count('bytes_read', 10)
+		with threading.SerialExecutor() as executor: list(executor.map(len, [b'a', b'bc']))
+		report = collector.get_report()
+		self.assertEqual(report['stages']['x']['calls'], 2)
+		self.assertEqual(report['counters']['bytes_read'], 10)
+		self.assertEqual(report['executors'][0]['tasks'], 2)
+		self.assertIn('x', collector.format_report())
+
+class TestProgress(unittest.TestCase):
+	def test_not_a_terminal(self):
+		self.assertFalse(progress.is_terminal(io.StringIO()))
+
+	def test_null_progress(self):
+		with progress.progress(range(3), total=3, disable=True) as bar:
+			self.assertListEqual(list(bar), [0, 1, 2])
+			bar.update(2)
+			bar.set_postfix(errors=0)
+			bar.total += 1
+		self.assertEqual(bar.n, 2)
+		self.assertEqual(bar.total, 4)
+
+class TestPrefetch(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.tmp.name, 'data')
+		self.data = bytes(range(256)) * 40
+		with open(self.path, 'wb') as f: f.write(self.data)
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def test_order_and_padding(self):
+		units = [(((self.path, i * 100, 100), (None, 0, 10)), (i,)) for i in range(50)]
+		reader = prefetch.PrefetchReader(units, 110, prefetch=3, read_threads=4)
+		with threading.ThreadExecutor(2) as executor, reader:
+			results = list(executor.map(reader.process(lambda data, i: (i, bytes(data))), reader))
+		self.assertListEqual([x[0] for x in results], list(range(50)))
+		self.assertTrue(all(data == self.data[i * 100:(i + 1) * 100] + bytes(10) for i, data in results))
+		self.assertLessEqual(reader._allocated, 3)
+		overlap = reader.get_overlap()
+		self.assertLessEqual(overlap['overlap_seconds'], min(overlap['read_seconds'], overlap['hash_seconds']) + 1e-9)
+
+	def test_short_file(self):
+		reader = prefetch.PrefetchReader([(((self.path, len(self.data) - 5, 10),), ())], 10)
+		with reader: self.assertRaises(ValueError, list, reader)
+
+	def test_parse_read_threads(self):
+		self.assertDictEqual(prefetch.parse_read_threads(['2', f'{self.tmp.name}=1']), {None: 2, prefetch.get_device(self.tmp.name): 1})
+		self.assertRaises(ValueError, prefetch.parse_read_threads, ['x'])
+		self.assertRaises(ValueError, prefetch.parse_read_threads, ['0'])
+
+	def test_overlap(self):
+		self.assertTupleEqual(prefetch.get_overlap([(0, 2), (1, 3), (5, 6)], [(2.5, 5.5)]), (4, 3, 1.0))
@@ -1,6 +1,14 @@
+import os
+import sys
+import hashlib
+import ipaddress
+import pickle
+import sqlite3
 import unittest
+import tempfile
 
-from ..utorrent import resume, dht
+from ..utorrent import resume, dht, peers, scan, correlation
+from ..utility import bencode
 
 class TestResumePeersFromHexValid(unittest.TestCase):
 	def setUp(self):
@@ -19,7 +27,7 @@ class TestResumePeersFromHexValid(unittest.TestCase):
 		self.assertCountEqual(self.result, self.expected)
 
 	def test_list_eq(self):
-		self.assertListEqual(self.result, self.expected)
+		self.assertListEqual(list(self.result), self.expected)
 
 class TestResumePeersFromHexInvalid(unittest.TestCase):
 	def test_missing_start(self):
@@ -66,7 +74,7 @@ class TestDhtPeersFromHexValid(unittest.TestCase):
 		self.assertCountEqual(self.result, self.expected)
 
 	def test_list_eq(self):
-		self.assertListEqual(self.result, self.expected)
+		self.assertListEqual(list(self.result), self.expected)
 
 class TestDhtPeersFromHexInvalid(unittest.TestCase):
 	def test_missing_start(self):
@@ -95,4 +103,226 @@ class TestDhtPeersFromHexInvalid(unittest.TestCase):
 
 	def test_invalid_length_with_whitespace_begin(self):
 		self.assertRaises(ValueError,
-			dht.get_peers_from_hex, '       1234567898765432112345678987654321234567A1B2', True)
\ No newline at end of file
+			dht.get_peers_from_hex, '       1234567898765432112345678987654321234567A1B2', True)
+
+class TestPeerColumns(unittest.TestCase):
+	def test_format_ipv4(self):
+		self.assertEqual(peers.format_ipv4(0xA1B2C3D4), '161.178.195.212')
+
+	def test_dht_columns(self):
+		data = bytes.fromhex('1234567898765432112345678987654321234567A1B2C3D405A9' * 2)
+		columns = peers.decode_dht_nodes(data)
+		self.assertEqual(list(columns.ips), [0xA1B2C3D4] * 2)
+		self.assertEqual(list(columns.ports), [1449] * 2)
+		self.assertEqual(peers.DhtNodeTable(data)[1], [2, '1234567898765432112345678987654321234567', '161.178.195.212', 1449])
+
+	def test_resume_columns(self):
+		data = bytes.fromhex('00000000000000000000FFFFA1B2C3D4A905')
+		columns = peers.decode_resume_peers(data)
+		self.assertEqual(list(columns.ips), [0xA1B2C3D4])
+		self.assertEqual(list(peers.ResumePeerTable(data)), [[1, '00000000000000000000', 65535, '161.178.195.212', 1449]])
+
+	def test_empty(self):
+		self.assertEqual(len(peers.decode_dht_nodes(b'').ips), 0)
+
+	def test_partial_record(self):
+		self.assertRaises(ValueError, peers.decode_resume_peers, bytes(17))
+
+class TestPeerTables(unittest.TestCase):
+	def setUp(self):
+		self.data = bytes.fromhex('1234567898765432112345678987654321234567A1B2C3D405A9') + bytes(range(20)) + bytes.fromhex('0A0000011AE1')
+		self.table = peers.DhtNodeTable(self.data)
+
+	def test_rows(self):
+		self.assertEqual(len(self.table), 2)
+		self.assertListEqual(self.table[-1], [2, bytes(range(20)).hex(), '10.0.0.1', 6881])
+		self.assertListEqual(self.table[1:], [self.table[1]])
+		self.assertEqual(self.table, list(self.table))
+		self.assertNotEqual(self.table, list(self.table)[:1])
+		self.assertRaises(IndexError, self.table.__getitem__, 2)
+
+	def test_records(self):
+		records = list(self.table.records())
+		self.assertEqual(records[1], peers.DhtNode(bytes(range(20)), 0x0A000001, 6881))
+		self.assertEqual(records[1].ipv4, '10.0.0.1')
+		self.assertRaises(AttributeError, setattr, records[1], 'extra', 1)
+
+	def test_resume_dat_table(self):
+		table = peers.ResumeDatPeerTable()
+		self.assertEqual(table.add('a.torrent', 'ab', 'peers6', bytes.fromhex('00000000000000000000FFFFA1B2C3D4A905')), 1)
+		self.assertEqual(table.add('a.torrent', 'ab', 'peers', bytes.fromhex('0A00000106A9' * 2)), 2)
+		self.assertEqual(len(table.torrents), 1)
+		self.assertListEqual(table[0], [1, 'a.torrent', 'ab', 'peers6', '00000000000000000000', 65535, '161.178.195.212', 1449])
+		self.assertListEqual(table[2], [3, 'a.torrent', 'ab', 'peers', None, None, '10.0.0.1', 1705])
+		self.assertEqual(table.get_record(2), peers.ResumePeer(None, None, 0x0A000001, 1705, 'a.torrent', 'ab', 'peers'))
+		self.assertRaises(ValueError, table.add, 'a.torrent', 'ab', 'nodes', b'')
+
+	def test_memory(self):
+		table = peers.DhtNodeTable(bytes(range(26)) * 1000)
+		rows = list(table)
+		size = sys.getsizeof(rows) + sum(sys.getsizeof(row) + sum(sys.getsizeof(x) for x in row) for row in rows)
+		self.assertLess(sys.getsizeof(table) * 8, size)
+
+	def test_pickle(self):
+		self.assertEqual(pickle.loads(pickle.dumps(self.table)), self.table)
+
+class TestDatFiles(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.resume_path = os.path.join(self.tmp.name, 'resume.dat')
+		self.dht_path = os.path.join(self.tmp.name, 'dht.dat')
+		with open(self.resume_path, 'wb') as dat_file:
+			dat_file.write(bencode.encode({
+				'.fileguard': 'ABCDEF',
+				'a.torrent': {
+					'info': bytes(range(20)),
+					'peers6': bytes.fromhex('00000000000000000000FFFFA1B2C3D4A905'),
+					'peers': bytes.fromhex('0A00000106A9'),
+					'trackers': ['http://tracker/announce'],
+					'added_on': 1
+				},
+				'b.torrent': {'peers6': bytes(17)},
+				'rec': {'x': 1}
+			}))
+		with open(self.dht_path, 'wb') as dat_file:
+			dat_file.write(bencode.encode({'id': bytes(20), 'nodes': bytes.fromhex('1234567898765432112345678987654321234567A1B2C3D405A9'), 'port': 1}))
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def test_resume_peers(self):
+		info_hash = bytes(range(20)).hex()
+		self.assertListEqual(list(resume.get_peers_from_dat(self.resume_path)), [
+			[1, 'a.torrent', info_hash, 'peers6', '00000000000000000000', 65535, '161.178.195.212', 1449],
+			[2, 'a.torrent', info_hash, 'peers', None, None, '10.0.0.1', 1705]
+		])
+
+	def test_dht_nodes(self):
+		self.assertListEqual(list(dht.get_nodes_from_dat(self.dht_path)),
+			[[1, '1234567898765432112345678987654321234567', '161.178.195.212', 1449]])
+
+	def test_missing_nodes(self):
+		self.assertRaises(ValueError, dht.get_nodes_from_dat, self.resume_path)
+
+	def test_empty_file(self):
+		open(self.dht_path, 'wb').close()
+		self.assertRaises(ValueError, dht.get_nodes_from_dat, self.dht_path)
+
+class TestCaseScan(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		root = self.tmp.name
+		profile = os.path.join(root, 'Users', 'bob', 'AppData', 'Roaming', 'uTorrent')
+		downloads = os.path.join(root, 'Users', 'bob', 'Downloads')
+		os.makedirs(profile)
+		os.makedirs(downloads)
+
+		data = bytes(range(256)) * 100
+		with open(os.path.join(downloads, 'file.bin'), 'wb') as data_file: data_file.write(data)
+		info = {'length': len(data), 'name': 'file.bin', 'piece length': 4096,
+			'pieces': b''.join(hashlib.sha1(data[i:i+4096]).digest() for i in range(0, len(data), 4096))}
+		self.info_hash = hashlib.sha1(bencode.encode(info)).hexdigest()
+
+		with open(os.path.join(profile, 'file.torrent'), 'wb') as torrent_file: torrent_file.write(bencode.encode({'info': info}))
+		with open(os.path.join(profile, 'broken.torrent'), 'wb') as torrent_file: torrent_file.write(b'not bencode')
+		with open(os.path.join(profile, 'resume.dat'), 'wb') as dat_file:
+			dat_file.write(bencode.encode({'file.torrent': {'info': bytes.fromhex(self.info_hash),
+				'path': 'C:\\Users\\bob\\Downloads\\file.bin', 'peers': bytes.fromhex('0A00000106A9')}}))
+
+		self.out = os.path.join(root, 'case.sqlite')
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def test_mounted_path(self):
+		self.assertEqual(scan.get_mounted_path('C:\\Users\\bob\\x', '/mnt'), os.path.join('/mnt', 'Users', 'bob', 'x'))
+
+	def test_scan(self):
+		with scan.CaseScan(self.tmp.name, self.out, silent=True) as case:
+			self.assertEqual(case.discover(), {'resume': 1, 'torrent': 2})
+			case.run(workers=1)
+		self.assertEqual(case.errors, 1)
+
+		connection = sqlite3.connect(self.out)
+		verification = connection.execute('SELECT "Info Hash", Verified, Failed, Verdict FROM verification').fetchall()
+		peers = connection.execute('SELECT IPv4, "IPv4 Port" FROM resume_peers').fetchall()
+		connection.close()
+		self.assertListEqual(verification, [(self.info_hash, 7, 0, 'match')])
+		self.assertListEqual(peers, [('10.0.0.1', 1705)])
+
+class TestPeerStore(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.dht_path = os.path.join(self.tmp.name, 'm1', 'dht.dat')
+		self.resume_path = os.path.join(self.tmp.name, 'm2', 'resume.dat')
+		os.makedirs(os.path.dirname(self.dht_path))
+		os.makedirs(os.path.dirname(self.resume_path))
+
+		node = lambda i, ip, port: bytes([i]) * 20 + bytes(map(int, ip.split('.'))) + port.to_bytes(2, 'big')
+		with open(self.dht_path, 'wb') as dat_file:
+			dat_file.write(bencode.encode({'nodes': node(1, '203.0.113.5', 6881) + node(2, '198.51.100.1', 51413) + node(3, '203.0.113.200', 80)}))
+		peer6 = lambda ip, port: ipaddress.ip_address(ip).packed + port.to_bytes(2, 'little')
+		with open(self.resume_path, 'wb') as dat_file:
+			dat_file.write(bencode.encode({'.fileguard': 'x', 'a.torrent': {'info': bytes(range(20)),
+				'peers6': peer6('2001:db8::1', 6881) + peer6('::ffff:203.0.113.9', 6882), 'peers': bytes.fromhex('0A0000011AE1')}}))
+
+		self.store = correlation.PeerStore(os.path.join(self.tmp.name, 'peers.db'))
+		self.assertTupleEqual(self.store.add_paths([self.tmp.name], label='case', silent=True), (2, 6, 0))
+
+	def tearDown(self):
+		self.store.close()
+		self.tmp.cleanup()
+
+	def _query(self, *args, **kwargs):
+		return sorted((x[0], x[7], x[8]) for x in self.store.query(*args, **kwargs))
+
+	def test_query(self):
+		self.assertListEqual(self._query(['203.0.113.0/24']),
+			[(self.dht_path, '203.0.113.200', 80), (self.dht_path, '203.0.113.5', 6881), (self.resume_path, '203.0.113.9', 6882)])
+		self.assertListEqual(self._query(['203.0.113.0/24'], [6881]), [(self.dht_path, '203.0.113.5', 6881)])
+		self.assertListEqual(self._query(['203.0.113.9']), [(self.resume_path, '203.0.113.9', 6882)])
+		self.assertListEqual(self._query(['::ffff:203.0.113.9']), [(self.resume_path, '203.0.113.9', 6882)])
+		self.assertListEqual(self._query(['2001:db8::/32']), [(self.resume_path, '2001:db8::1', 6881)])
+		self.assertListEqual(self._query(ports=[6881]),
+			[(self.dht_path, '203.0.113.5', 6881), (self.resume_path, '10.0.0.1', 6881), (self.resume_path, '2001:db8::1', 6881)])
+		self.assertListEqual(self._query(['10.0.0.1'], artifacts=['m2']), [(self.resume_path, '10.0.0.1', 6881)])
+		self.assertListEqual(self._query(['10.0.0.1'], artifacts=['m1']), [])
+		self.assertRaises(ValueError, self._query, ['203.0.113.0/33'])
+
+		row = next(self.store.query(['2001:db8::1']))
+		self.assertListEqual(row, [self.resume_path, 'case', 'resume', 'a.torrent', bytes(range(20)).hex(), 'peers6', None, '2001:db8::1', 6881])
+
+	def test_query_artifacts(self):
+		self.assertListEqual(self.store.query_artifacts(['203.0.113.0/24']), [[self.dht_path, 'case', 'dht', 2, 2, 2], [self.resume_path, 'case', 'resume', 1, 1, 1]])
+		self.assertListEqual(self.store.query_artifacts(['203.0.113.0/24'], artifacts=['resume']), [[self.resume_path, 'case', 'resume', 1, 1, 1]])
+		self.assertListEqual(self.store.query_artifacts(artifacts=[self.dht_path, self.resume_path], limit=1), [[self.dht_path, 'case', 'dht', 3, 3, 3]])
+
+	def test_reload_and_tables(self):
+		self.assertEqual(self.store.add_dat(self.dht_path), 3)
+		self.assertEqual(len(self.store), 6)
+
+		table = dht.get_nodes_from_dat(self.dht_path)
+		self.assertEqual(self.store.add_table('hex', table, dht.DHT_NODES_HEADER), 3)
+		table = resume.get_peers_from_dat(self.resume_path)
+		self.assertEqual(self.store.add_table('table', table, resume.RESUME_DAT_PEERS_HEADER), 3)
+		self.assertListEqual(sorted(x[1:] for x in self._query(['2001:db8::1', '203.0.113.5'])), [('2001:db8::1', 6881)] * 2 + [('203.0.113.5', 6881)] * 2)
+
+	def test_failed_artifact(self):
+		broken = os.path.join(self.tmp.name, 'm3', 'resume.dat')
+		os.makedirs(os.path.dirname(broken))
+		with open(broken, 'wb') as dat_file: dat_file.write(b'd1:a')
+		self.assertTupleEqual(self.store.add_paths([broken], silent=True), (0, 0, 1))
+		self.assertEqual(self.store.get_artifact_count(), 2)
+
+	def test_single_transaction(self): # loaded artifacts are only committed together at the end
+		store = correlation.PeerStore(os.path.join(self.tmp.name, 'other.db'))
+		seen = list()
+		add_dat = store.add_dat
+		def add_and_count(path, label=None):
+			with sqlite3.connect(store.path) as other: seen.append(other.execute('SELECT COUNT(*) FROM artifacts').fetchone()[0])
+			return add_dat(path, label)
+		store.add_dat = add_and_count
+		self.assertTupleEqual(store.add_paths([self.dht_path, self.resume_path], silent=True), (2, 6, 0))
+		self.assertListEqual(seen, [0, 0])
+		self.assertEqual(store.get_artifact_count(), 2)
+		store.close()
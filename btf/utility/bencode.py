@@ -0,0 +1,227 @@
+"""
+Offset based bencode decoder that works directly on bytes, bytearray, mmap or memoryview buffers.
+
+Values can be decoded fully with decode, or walked without building them using skip, iter_dict and
+iter_list, which only return offsets into the buffer. Combined with memoryview slices this allows pulling
+large values (such as the pieces key of a .torrent file) out of a buffer without copying them.
+"""
+
+import re
+import mmap
+
+_DIGITS = frozenset(b'0123456789')
+_INT = ord('i')
+_LIST = ord('l')
+_DICT = ord('d')
+_END = ord('e')
+
+# canonical forms only: no leading zeros, no negative zero, no signs or whitespace in string lengths
+_INTEGER = re.compile(rb'0|-?[1-9][0-9]*')
+_LENGTH = re.compile(rb'0|[1-9][0-9]*')
+
+class BencodeError(ValueError):
+	"""
+	Raised when data is not valid bencode
+	"""
+
+class _View:
+	"""
+	find, int indexing and slicing to bytes over a memoryview, without copying the buffer. find only looks for the
+	delimiters of string lengths and integers, which are a few bytes away, so it scans small windows.
+	"""
+	__slots__ = ('view',)
+	_WINDOW = 64
+
+	def __init__(self, view):
+		self.view = view
+
+	def __len__(self):
+		return len(self.view)
+
+	def __getitem__(self, index):
+		if isinstance(index, slice): return self.view[index].tobytes()
+		return self.view[index]
+
+	def find(self, sub, start=0):
+		size = len(self.view)
+		while start < size:
+			end = min(size, start + self._WINDOW)
+			found = self.view[start:end].tobytes().find(sub)
+			if found >= 0: return start + found
+			start = end
+		return -1
+
+def _buffer(data):
+	"""
+	Return an object supporting find and int indexing for data. A memoryview of a whole bytes or mmap object
+	is replaced by that object (slices of those are bytes, like the values decoded from other buffers), other memoryviews are wrapped without copying them.
+	"""
+	if not isinstance(data, memoryview): return data
+	if isinstance(data.obj, (bytes, mmap.mmap)) and data.format == 'B' and data.ndim == 1 and len(data) == len(data.obj): return data.obj
+	return _View(data if data.format == 'B' else data.cast('B'))
+
+def _string_span(data, offset):
+	colon = data.find(b':', offset)
+	if colon < 0: raise BencodeError(f'Unterminated string length at offset {offset}')
+	digits = data[offset:colon]
+	if not _LENGTH.fullmatch(digits): raise BencodeError(f'Invalid string length at offset {offset}')
+	end = colon + 1 + int(digits)
+	if end > len(data): raise BencodeError(f'String at offset {offset} exceeds end of data')
+	return colon + 1, end
+
+def _int_end(data, offset):
+	end = data.find(b'e', offset)
+	if end < 0: raise BencodeError(f'Unterminated integer at offset {offset}')
+	if not _INTEGER.fullmatch(data[offset+1:end]): raise BencodeError(f'Invalid integer at offset {offset}')
+	return end
+
+def string_span(data, offset=0):
+	"""
+	Locate the payload of the bencoded string starting at offset
+	:returns: tuple of (payload start, payload end) offsets
+	"""
+	data = _buffer(data)
+	if offset >= len(data) or data[offset] not in _DIGITS: raise BencodeError(f'Expected string at offset {offset}')
+	return _string_span(data, offset)
+
+def skip(data, offset=0):
+	"""
+	Find the end of the bencoded value starting at offset without decoding it
+	:returns: offset one past the end of the value
+	"""
+	data = _buffer(data)
+	size = len(data)
+	depth = 0
+	while True:
+		if offset >= size: raise BencodeError('Unexpected end of data')
+		c = data[offset]
+		if c in _DIGITS:
+			offset = _string_span(data, offset)[1]
+		elif c == _INT:
+			offset = _int_end(data, offset) + 1
+		elif c == _LIST or c == _DICT:
+			depth += 1
+			offset += 1
+			continue
+		elif c == _END and depth > 0:
+			depth -= 1
+			offset += 1
+		else:
+			raise BencodeError(f'Unexpected byte {c!r} at offset {offset}')
+		if depth == 0: return offset
+
+def decode_at(data, offset=0):
+	"""
+	Decode the bencoded value starting at offset. Strings and dict keys are returned as bytes. Lists and
+	dictionaries are built on an explicit stack, so deeply nested input can not exhaust the Python stack.
+	:returns: tuple of (value, offset one past the end of the value)
+	"""
+	data = _buffer(data)
+	size = len(data)
+	stack = list() # [list or dict, key of the dict value being decoded or None]
+	while True:
+		if offset >= size:
+			if not stack: raise BencodeError('Unexpected end of data')
+			raise BencodeError('Unterminated list' if isinstance(stack[-1][0], list) else 'Unterminated dictionary')
+		c = data[offset]
+		if stack and c == _END and stack[-1][1] is None:
+			value = stack.pop()[0]
+			offset += 1
+		elif stack and stack[-1][1] is None and isinstance(stack[-1][0], dict):
+			if c not in _DIGITS: raise BencodeError(f'Expected string key at offset {offset}')
+			start, offset = _string_span(data, offset)
+			stack[-1][1] = bytes(data[start:offset])
+			continue
+		elif c in _DIGITS:
+			start, end = _string_span(data, offset)
+			value, offset = data[start:end], end
+		elif c == _INT:
+			end = _int_end(data, offset)
+			value, offset = int(data[offset+1:end]), end + 1
+		elif c == _LIST or c == _DICT:
+			stack.append([list() if c == _LIST else dict(), None])
+			offset += 1
+			continue
+		else:
+			raise BencodeError(f'Unexpected byte {c!r} at offset {offset}')
+
+		if not stack: return value, offset
+		container, key = stack[-1]
+		if key is None:
+			container.append(value)
+		else:
+			container[key] = value
+			stack[-1][1] = None
+
+def decode(data):
+	"""
+	Decode a complete bencoded buffer. Strings and dict keys are returned as bytes.
+	"""
+	data = _buffer(data)
+	value, end = decode_at(data, 0)
+	if end != len(data): raise BencodeError(f'Trailing data after offset {end}')
+	return value
+
+def iter_dict(data, offset=0):
+	"""
+	Walk the bencoded dictionary starting at offset without decoding its values
+	:returns: generator of (key, value start, value end) tuples
+	"""
+	data = _buffer(data)
+	if offset >= len(data) or data[offset] != _DICT: raise BencodeError(f'Expected dictionary at offset {offset}')
+	offset += 1
+	while True:
+		if offset >= len(data): raise BencodeError('Unterminated dictionary')
+		if data[offset] == _END: return
+		if data[offset] not in _DIGITS: raise BencodeError(f'Expected string key at offset {offset}')
+		start, offset = _string_span(data, offset)
+		key = bytes(data[start:offset])
+		end = skip(data, offset)
+		yield key, offset, end
+		offset = end
+
+def iter_list(data, offset=0):
+	"""
+	Walk the bencoded list starting at offset without decoding its values
+	:returns: generator of (value start, value end) tuples
+	"""
+	data = _buffer(data)
+	if offset >= len(data) or data[offset] != _LIST: raise BencodeError(f'Expected list at offset {offset}')
+	offset += 1
+	while True:
+		if offset >= len(data): raise BencodeError('Unterminated list')
+		if data[offset] == _END: return
+		end = skip(data, offset)
+		yield offset, end
+		offset = end
+
+def encode(value):
+	"""
+	Bencode an int, bytes, str, list or dict (keys are sorted as required by the specification)
+	:returns: bytes
+	"""
+	out = list()
+	_encode(value, out)
+	return b''.join(out)
+
+def _encode(value, out):
+	if isinstance(value, bool) or not isinstance(value, (int, bytes, bytearray, memoryview, str, list, tuple, dict)):
+		raise TypeError(f'Cannot bencode value of type {type(value).__name__}')
+	if isinstance(value, int):
+		out.append(b'i%de' % value)
+	elif isinstance(value, str):
+		_encode(value.encode('utf-8'), out)
+	elif isinstance(value, (bytes, bytearray, memoryview)):
+		out.append(b'%d:' % len(value))
+		out.append(bytes(value))
+	elif isinstance(value, (list, tuple)):
+		out.append(b'l')
+		for item in value: _encode(item, out)
+		out.append(b'e')
+	else:
+		keys = {(k.encode('utf-8') if isinstance(k, str) else bytes(k)): v for k, v in value.items()}
+		out.append(b'd')
+		for key in sorted(keys):
+			_encode(key, out)
+			_encode(keys[key], out)
+		out.append(b'e')
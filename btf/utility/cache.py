@@ -0,0 +1,129 @@
+import os
+import time
+import sqlite3
+import hashlib
+
+"""
+Persistent cache of piece hash results, shared by concurrent processes through SQLite.
+"""
+
+DEFAULT_MAX_ENTRIES = 2000000 # roughly 200 MB on disk
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS piece_hashes (
+	key BLOB PRIMARY KEY,
+	digest BLOB NOT NULL,
+	last_used INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS piece_hashes_last_used ON piece_hashes(last_used);
+'''
+
+_BATCH_SIZE = 500 # stay below SQLite's host parameter limit
+
+def get_default_cache_path():
+	"""
+	Cache location, $BTF_CACHE_DIR or ~/.cache/bittorrent-forensics
+	"""
+	cache_dir = os.environ.get('BTF_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'bittorrent-forensics')
+	return os.path.join(cache_dir, 'piece-hashes.sqlite')
+
+def get_file_identity(path):
+	"""
+	Identity of a file on disk, any change to it (rewrite, touch, replacement) invalidates cached hashes
+	:returns: tuple of (absolute path, size, mtime in ns, inode, device)
+	"""
+	stat = os.stat(path)
+	return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_dev)
+
+class PieceHashCache:
+	"""
+	On-disk cache of SHA1 digests keyed by the identity of the files read and the byte ranges hashed.
+	Size is bounded by max_entries, least recently used entries are evicted first.
+	:param check_same_thread: False to allow using the cache from other threads than the one that opened it, one
+	at a time (see the daemon)
+	"""
+	def __init__(self, path=None, max_entries=DEFAULT_MAX_ENTRIES, *, check_same_thread=True):
+		self.path = path or get_default_cache_path()
+		self.max_entries = max_entries
+		self._identities = dict()
+
+		directory = os.path.dirname(os.path.abspath(self.path))
+		os.makedirs(directory, exist_ok=True)
+
+		self.connection = sqlite3.connect(self.path, timeout=60, check_same_thread=check_same_thread)
+		self.connection.execute('PRAGMA journal_mode=WAL') # readers don't block the writer of another process
+		self.connection.execute('PRAGMA synchronous=NORMAL')
+		with self.connection: self.connection.executescript(_SCHEMA)
+
+	def close(self):
+		self.connection.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def __len__(self):
+		return self.connection.execute('SELECT COUNT(*) FROM piece_hashes').fetchone()[0]
+
+	def forget_files(self):
+		"""
+		Forget the identities of the files seen so far, so that a long lived cache notices files changed since
+		"""
+		self._identities.clear()
+
+	def get_key(self, unit):
+		"""
+		Cache key for a work unit of (path, offset, length) segments
+		"""
+		parts = list()
+		for path, offset, length in unit:
+			if path not in self._identities: self._identities[path] = None if path is None else get_file_identity(path) # None is padding
+			parts.append((self._identities[path], offset, length))
+		return hashlib.sha1(repr(parts).encode('utf-8', errors='surrogateescape')).digest()
+
+	def get_many(self, keys):
+		"""
+		Look up cached digests
+		:returns: dict of key to digest for the keys found
+		"""
+		found = dict()
+		keys = list(keys)
+		for i in range(0, len(keys), _BATCH_SIZE):
+			batch = keys[i:i+_BATCH_SIZE]
+			rows = self.connection.execute(
+				f'SELECT key, digest FROM piece_hashes WHERE key IN ({",".join("?" * len(batch))})', batch).fetchall()
+			found.update((bytes(key), bytes(digest)) for key, digest in rows)
+
+		if found:
+			now = time.time_ns()
+			with self.connection:
+				self.connection.executemany('UPDATE piece_hashes SET last_used = ? WHERE key = ?', ((now, x) for x in found))
+		return found
+
+	def put_many(self, items):
+		"""
+		Store (key, digest) pairs and evict old entries if the cache grew past max_entries
+		"""
+		now = time.time_ns()
+		with self.connection:
+			self.connection.executemany('INSERT OR REPLACE INTO piece_hashes (key, digest, last_used) VALUES (?, ?, ?)',
+				((key, digest, now) for key, digest in items))
+		self.evict()
+
+	def evict(self):
+		"""
+		Drop the least recently used entries down to 90% of max_entries once max_entries is exceeded
+		"""
+		count = len(self)
+		if count <= self.max_entries: return
+		with self.connection:
+			self.connection.execute(
+				'DELETE FROM piece_hashes WHERE key IN (SELECT key FROM piece_hashes ORDER BY last_used LIMIT ?)',
+				(count - int(self.max_entries * 0.9),))
+
+	def clear(self):
+		with self.connection:
+			self.connection.execute('DELETE FROM piece_hashes')
+		self._identities.clear()
@@ -1,14 +1,209 @@
+import os
 import csv
+import sys
+import json
+
+from . import stats
+
+"""
+Output of result tables. Rows are streamed into a sink (CSV, JSON Lines or SQLite) as they are produced, so
+large results are never held in memory just to be written out.
+"""
+
+SINK_FORMATS = ['csv', 'jsonl', 'sqlite']
+SOURCE_COLUMN = 'Source'
+
+_EXTENSIONS = {
+	'.csv': 'csv',
+	'.jsonl': 'jsonl',
+	'.ndjson': 'jsonl',
+	'.sqlite': 'sqlite',
+	'.sqlite3': 'sqlite',
+	'.db': 'sqlite'
+}
 
 def write_csv(path, table, header):
 	"""
-	Write table (list containing lists where each item is a row entry) to path with given header
+	Write table (sequence of lists where each item is a row entry, such as a list or peer table) to path with given header
 	"""
 	if path is None or header is None or table is None or len(table) == 0: return
-	
-	if not (type(table) == list and type(table[0] == list)): raise ValueError("Invalid type for table")
 
-	with open(path, 'w', newline='') as file:
-		writer = csv.writer(file, dialect='excel')
-		writer.writerow(header)
-		for entry in table: writer.writerow(entry)
\ No newline at end of file
+	if isinstance(table, (str, bytes)) or not isinstance(table[0], list): raise ValueError("Invalid type for table")
+
+	with CsvSink(path, header) as sink: sink.write_rows(table)
+
+def print_table(table, header):
+	"""
+	Print table to the terminal, tabulate is only imported when something is printed
+	"""
+	from tabulate import tabulate
+	print(tabulate(table, header))
+
+def get_sink_format(path, format=None):
+	"""
+	Output format for path, taken from its extension unless given (csv if the extension is unknown)
+	"""
+	if format is None: format = _EXTENSIONS.get(os.path.splitext(path)[1].lower(), 'csv')
+	if format not in SINK_FORMATS: raise ValueError(f"Invalid output format '{format}', must be one of {', '.join(SINK_FORMATS)}")
+	return format
+
+class ResultSink:
+	"""
+	Destination for the rows of a result table. If source is not None, a Source column is put in front of the
+	header and every row is written with the current value of source, which can be changed between inputs to
+	consolidate many of them in one output. With append, rows are added to an existing output.
+	"""
+	def __init__(self, path, header, *, append=False, source=None):
+		self.path = path
+		self.header = list(header)
+		self.append = append
+		self.source = source
+		self.columns = ([SOURCE_COLUMN] if source is not None else list()) + self.header
+		self.count = 0
+
+	def write(self, row):
+		if self.source is not None: row = [self.source] + list(row)
+		self._write(row)
+		self.count += 1
+
+	def write_rows(self, rows):
+		"""
+		Write all rows of an iterable
+		:returns: number of rows written
+		"""
+		count = self.count
+		with stats.stage('write output'):
+			for row in rows: self.write(row)
+		return self.count - count
+
+	def _write(self, row):
+		raise NotImplementedError
+
+	def close(self):
+		stats.count('rows_written', self.count)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+class CsvSink(ResultSink):
+	"""
+	Rows written as excel dialect CSV, the header is only written when the file is new or empty
+	"""
+	def __init__(self, path, header, *, append=False, source=None):
+		super().__init__(path, header, append=append, source=source)
+		self._file = open(path, 'a' if append else 'w', newline='')
+		self._writer = csv.writer(self._file, dialect='excel')
+		if self._file.tell() == 0: self._writer.writerow(self.columns)
+
+	def _write(self, row):
+		self._writer.writerow(row)
+
+	def close(self):
+		self._file.close()
+		super().close()
+
+class JsonLinesSink(ResultSink):
+	"""
+	Rows written as one JSON object per line, keyed by column name
+	"""
+	def __init__(self, path, header, *, append=False, source=None):
+		super().__init__(path, header, append=append, source=source)
+		self._file = open(path, 'a' if append else 'w', encoding='utf-8')
+
+	def _write(self, row):
+		self._file.write(json.dumps(dict(zip(self.columns, row)), default=str))
+		self._file.write('\n')
+
+	def close(self):
+		self._file.close()
+		super().close()
+
+class SqliteSink(ResultSink):
+	"""
+	Rows inserted into a table (default 'results') of an SQLite database in batches. When appending, the
+	columns of an existing table must match.
+	"""
+	BATCH_SIZE = 1000
+
+	def __init__(self, path, header, *, append=False, source=None, table='results'):
+		super().__init__(path, header, append=append, source=source)
+		self.table = table
+		self._pending = list()
+
+		import sqlite3 # only loaded by the subcommands that write SQLite
+		self.connection = sqlite3.connect(path)
+
+		quoted = _quote(table)
+		existing = [x[1] for x in self.connection.execute(f'PRAGMA table_info({quoted})')]
+		if existing and not append:
+			with self.connection: self.connection.execute(f'DROP TABLE {quoted}')
+			existing = list()
+		if existing and existing != self.columns:
+			self.connection.close()
+			raise ValueError(f"Table '{table}' in '{path}' has columns {', '.join(existing)}, expected {', '.join(self.columns)}")
+		if not existing:
+			with self.connection: self.connection.execute(f'CREATE TABLE {quoted} ({", ".join(_quote(x) for x in self.columns)})')
+
+		self._insert = f'INSERT INTO {quoted} VALUES ({", ".join("?" * len(self.columns))})'
+
+	def _write(self, row):
+		self._pending.append(row)
+		if len(self._pending) >= self.BATCH_SIZE: self.flush()
+
+	def flush(self):
+		with self.connection: self.connection.executemany(self._insert, self._pending)
+		self._pending.clear()
+
+	def close(self):
+		self.flush()
+		self.connection.close()
+		super().close()
+
+def _quote(name):
+	return '"' + name.replace('"', '""') + '"'
+
+def open_sink(path, header, *, format=None, append=False, source=None):
+	"""
+	Open a result sink for path, the format is taken from the extension of path unless given
+	:returns: CsvSink, JsonLinesSink or SqliteSink
+	"""
+	format = get_sink_format(path, format)
+	if format == 'jsonl': return JsonLinesSink(path, header, append=append, source=source)
+	if format == 'sqlite': return SqliteSink(path, header, append=append, source=source)
+	return CsvSink(path, header, append=append, source=source)
+
+def write_to_sinks(rows, sinks):
+	"""
+	Stream rows into several sinks at once, sinks that are None are ignored
+	:returns: number of rows
+	"""
+	sinks = [x for x in sinks if x is not None]
+	count = 0
+	for row in rows:
+		for sink in sinks: sink.write(row)
+		count += 1
+	return count
+
+def open_args_sink(args, header):
+	"""
+	Open the consolidated output given with --out of a subcommand, every row is written with the input it came from
+	as source (exits with an error if it can not be opened)
+	:returns: sink, or None without --out
+	"""
+	if 'out' not in args or not args.out: return None
+	try:
+		return open_sink(args.out, header, format=args.format, append=args.append, source='')
+	except (OSError, ValueError) as e:
+		sys.exit(f'Error: could not open output: {e}')
+
+def write_args_table(args, sink, source, table, csv_name, header):
+	"""
+	Write the table of one input to the sink from open_args_sink and, with --csv, to csv_name in the --csv folder
+	"""
+	if sink is not None:
+		sink.source = source
+		sink.write_rows(table)
+	if 'csv' in args and args.csv: write_csv(os.path.join(args.csv, csv_name), table, header)
@@ -0,0 +1,253 @@
+import os
+import time
+import threading
+import functools
+import collections
+
+from . import stats
+
+"""
+Read-ahead pipeline for piece analysis. Reader threads fill a bounded set of preallocated, reused buffers with
+the data of work units in layout order, so the hashing side always has the next piece in memory while the disk
+keeps reading. Each device gets its own readers, the read concurrency suits spinning drives (one sequential
+reader) and SSDs/NVMe (several outstanding reads) differently.
+"""
+
+DEFAULT_PREFETCH = 8 # pieces buffered ahead of hashing
+ROTATIONAL_READ_THREADS = 1
+SOLID_STATE_READ_THREADS = 4
+UNKNOWN_READ_THREADS = 2
+
+def get_device(path):
+	"""
+	:returns: device id (st_dev) of the file system holding path
+	"""
+	return os.stat(path).st_dev
+
+def is_rotational(device):
+	"""
+	Whether a device is a spinning drive, from /sys/dev/block on Linux
+	:returns: True, False or None if unknown
+	"""
+	sys_path = f'/sys/dev/block/{os.major(device)}:{os.minor(device)}'
+	for queue_path in (os.path.join(sys_path, 'queue', 'rotational'), os.path.join(sys_path, '..', 'queue', 'rotational')): # disk, partition
+		try:
+			with open(queue_path, 'r') as queue_file: return queue_file.read().strip() == '1'
+		except OSError:
+			continue
+	return None
+
+def get_default_read_threads(device):
+	rotational = is_rotational(device)
+	if rotational is None: return UNKNOWN_READ_THREADS
+	return ROTATIONAL_READ_THREADS if rotational else SOLID_STATE_READ_THREADS
+
+def parse_read_threads(values):
+	"""
+	Parse read concurrency settings, each value is either a number of reader threads for all devices or PATH=N for
+	the device holding PATH
+	:returns: dict of device id (None for all other devices) to number of reader threads
+	"""
+	result = dict()
+	for value in values or ():
+		path, _, count = value.rpartition('=')
+		try:
+			count = int(count)
+		except ValueError:
+			raise ValueError(f"Invalid read threads '{value}', must be N or PATH=N")
+		if count < 1: raise ValueError(f"Invalid read threads '{value}', must be at least 1")
+		if not path:
+			result[None] = count
+			continue
+		try:
+			result[get_device(path)] = count
+		except OSError as e:
+			raise ValueError(f"Invalid read threads '{value}': {e}")
+	return result
+
+def _merge_intervals(intervals):
+	"""
+	:returns: list of disjoint (start, end) intervals covering the given intervals, sorted
+	"""
+	merged = list()
+	for start, end in sorted(intervals):
+		if merged and start <= merged[-1][1]:
+			if end > merged[-1][1]: merged[-1][1] = end
+		else:
+			merged.append([start, end])
+	return merged
+
+def get_overlap(first, second):
+	"""
+	Time during which both kinds of intervals were active, e.g. reading and hashing
+	:returns: tuple of (busy seconds of first, busy seconds of second, seconds both were busy)
+	"""
+	first, second = _merge_intervals(first), _merge_intervals(second)
+	overlap = 0.0
+	i = j = 0
+	while i < len(first) and j < len(second):
+		overlap += max(0.0, min(first[i][1], second[j][1]) - max(first[i][0], second[j][0]))
+		if first[i][1] < second[j][1]: i += 1
+		else: j += 1
+	return sum(b - a for a, b in first), sum(b - a for a, b in second), overlap
+
+class PrefetchReader:
+	"""
+	Iterable of prefetched work units. units is an iterable of (segments, args) tuples where segments are
+	(path, offset, length) tuples (path None for padding, see FileLayout.get_work_unit) whose data is read back to
+	back into one buffer. Items must be passed to the function returned by process, which hands the data to the
+	hashing function and returns the buffer for reuse. At most prefetch units are read ahead of the consumer.
+	:param read_threads: number of reader threads for every device, or dict of device id to number (key None for
+	others, see parse_read_threads), unlisted devices get a default by drive type
+	"""
+	def __init__(self, units, buffer_size, *, prefetch=DEFAULT_PREFETCH, read_threads=None):
+		self.buffer_size = buffer_size
+		self.prefetch = max(1, prefetch)
+		self.read_intervals = list()
+		self.hash_intervals = list()
+		self.started = time.perf_counter()
+
+		self._free = list()
+		self._allocated = 0
+		self._ready = dict()
+		self._next = 0 # sequence number of the next item handed to the consumer
+		self._closed = False
+		self._condition = threading.Condition()
+
+		overrides = read_threads if isinstance(read_threads, dict) else {None: read_threads} if read_threads else dict()
+		pending = collections.OrderedDict() # device to deque of (sequence number, segments, args)
+		self.count = 0
+		for segments, args in units:
+			path = next((x[0] for x in segments if x[0] is not None), None)
+			device = get_device(path) if path is not None else None
+			pending.setdefault(device, collections.deque()).append((self.count, segments, args))
+			self.count += 1
+
+		self.threads = list()
+		for device, items in pending.items():
+			count = overrides.get(device, overrides.get(None)) or (get_default_read_threads(device) if device is not None else 1)
+			for _ in range(min(count, len(items))):
+				thread = threading.Thread(target=self._read_loop, args=(items,), daemon=True)
+				thread.start()
+				self.threads.append(thread)
+
+	def _get_buffer(self):
+		"""
+		Take a free buffer, allocating up to prefetch of them
+		:returns: bytearray, or None if the reader was closed while waiting
+		"""
+		with self._condition:
+			while not self._free and self._allocated >= self.prefetch and not self._closed: self._condition.wait()
+			if self._closed: return None
+			if self._free: return self._free.pop()
+			self._allocated += 1
+		return bytearray(self.buffer_size)
+
+	def _put_buffer(self, buffer):
+		with self._condition:
+			self._free.append(buffer)
+			self._condition.notify_all()
+
+	def _read_loop(self, items):
+		handles = dict()
+		try:
+			while True:
+				with self._condition:
+					if not items or self._closed: return
+					sequence, segments, args = items.popleft()
+					while sequence >= self._next + self.prefetch and not self._closed: self._condition.wait()
+					if self._closed: return
+
+				buffer = self._get_buffer()
+				if buffer is None: return
+				started = time.perf_counter()
+				try:
+					length = self._read(segments, buffer, handles)
+					result = (sequence, buffer, length, args, None)
+				except (OSError, ValueError) as e:
+					self._put_buffer(buffer)
+					result = (sequence, None, 0, args, e)
+				self.read_intervals.append((started, time.perf_counter()))
+
+				with self._condition:
+					self._ready[sequence] = result
+					self._condition.notify_all()
+		finally:
+			for handle in handles.values(): handle.close()
+
+	def _read(self, segments, buffer, handles):
+		"""
+		Read the segments of a work unit into buffer, keeping the file last read by this thread open
+		:returns: number of bytes read
+		"""
+		view = memoryview(buffer)
+		position = 0
+		for path, offset, length in segments:
+			if position + length > len(view): raise ValueError(f'Work unit larger than the buffer size {len(view)}')
+			if path is None: # padding
+				view[position:position + length] = bytes(length)
+				position += length
+				continue
+
+			handle = handles.get(path)
+			if handle is None:
+				for other in list(handles): handles.pop(other).close()
+				handle = handles[path] = open(path, 'rb', buffering=0)
+				if hasattr(os, 'posix_fadvise'): os.posix_fadvise(handle.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+			handle.seek(offset)
+			end = position + length
+			while position < end:
+				read = handle.readinto(view[position:end])
+				if not read: raise ValueError(f"Unexpected end of file '{path}' at offset {offset + length - (end - position)}")
+				position += read
+		return position
+
+	def __iter__(self):
+		for _ in range(self.count):
+			with self._condition:
+				while self._next not in self._ready: self._condition.wait()
+				sequence, buffer, length, args, error = self._ready.pop(self._next)
+				self._next += 1
+				self._condition.notify_all()
+			if error is not None: raise error
+			yield buffer, length, args
+
+	def process(self, func):
+		"""
+		:returns: function of an item of this reader calling func(data, *args) and returning the buffer for reuse
+		"""
+		return functools.partial(self._process, func)
+
+	def _process(self, func, item):
+		buffer, length, args = item
+		started = time.perf_counter()
+		try:
+			return func(memoryview(buffer)[:length], *args)
+		finally:
+			self.hash_intervals.append((started, time.perf_counter()))
+			self._put_buffer(buffer)
+
+	def get_overlap(self):
+		"""
+		:returns: dict of seconds spent reading, hashing, both at once and in total
+		"""
+		read, hashed, overlap = get_overlap(self.read_intervals, self.hash_intervals)
+		return {'read_seconds': read, 'hash_seconds': hashed, 'overlap_seconds': overlap, 'wall_seconds': time.perf_counter() - self.started}
+
+	def close(self):
+		"""
+		Stop the readers and record the overlap of reading and hashing in the statistics
+		"""
+		with self._condition:
+			self._closed = True
+			self._condition.notify_all()
+		for thread in self.threads: thread.join()
+		if stats.is_enabled():
+			for name, value in self.get_overlap().items():
+				if name != 'wall_seconds': stats.count(name, value)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
@@ -0,0 +1,53 @@
+import sys
+
+"""
+Progress bars that are only drawn on a terminal. tqdm is imported the first time a bar is actually shown, so
+batch runs with redirected output and --silent runs never load it.
+"""
+
+class NullProgress:
+	"""
+	Stand-in for a tqdm bar that passes the iterable through and ignores updates
+	"""
+	def __init__(self, iterable=None, total=None):
+		self.iterable = iterable
+		self.total = total
+		self.n = 0
+
+	def __iter__(self):
+		return iter(self.iterable)
+
+	def update(self, n=1):
+		self.n += n
+
+	def set_postfix(self, *args, **kwargs):
+		pass
+
+	def close(self):
+		pass
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		pass
+
+def is_terminal(stream=None):
+	"""
+	:returns: True if stream (default stderr, where progress is drawn) is attached to a TTY
+	"""
+	stream = sys.stderr if stream is None else stream
+	try:
+		return stream.isatty()
+	except (AttributeError, ValueError): # replaced or closed streams
+		return False
+
+def progress(iterable=None, *, total=None, disable=False, **kwargs):
+	"""
+	tqdm progress bar over iterable, or a NullProgress when disabled or stderr is not a terminal
+	:returns: tqdm or NullProgress
+	"""
+	if disable or not is_terminal(): return NullProgress(iterable, total)
+
+	from tqdm import tqdm
+	return tqdm(iterable, total=total, **kwargs)
@@ -0,0 +1,136 @@
+import sys
+import time
+import json
+import contextlib
+
+try:
+	import resource
+except ImportError: # not available on Windows, peak memory is then not reported
+	resource = None
+
+"""
+Optional instrumentation of stage timings, counters and worker utilization. Nothing is recorded until enable()
+is called, disabled calls cost a global lookup and return immediately.
+"""
+
+STATS_HEADER = ['Stage', 'Calls', 'Wall (s)', 'CPU (s)']
+
+_collector = None
+_NULL_STAGE = contextlib.nullcontext()
+
+class StatsCollector:
+	"""
+	Per stage wall and CPU time, named counters and per executor busy time
+	"""
+	def __init__(self):
+		self.started = time.perf_counter()
+		self.started_cpu = time.process_time()
+		self.stages = dict() # name to [calls, wall, cpu]
+		self.counters = dict()
+		self.executors = list() # dicts of kind, workers, tasks, busy and lifetime seconds
+
+	@contextlib.contextmanager
+	def stage(self, name):
+		wall = time.perf_counter()
+		cpu = time.process_time()
+		try:
+			yield
+		finally:
+			entry = self.stages.setdefault(name, [0, 0.0, 0.0])
+			entry[0] += 1
+			entry[1] += time.perf_counter() - wall
+			entry[2] += time.process_time() - cpu
+
+	def add(self, name, value=1):
+		self.counters[name] = self.counters.get(name, 0) + value
+
+	def get_report(self):
+		"""
+		:returns: dict of all statistics, suitable for JSON
+		"""
+		report = {
+			'wall_seconds': time.perf_counter() - self.started,
+			'cpu_seconds': time.process_time() - self.started_cpu,
+			'stages': {name: {'calls': calls, 'wall_seconds': wall, 'cpu_seconds': cpu} for name, (calls, wall, cpu) in self.stages.items()},
+			'counters': dict(self.counters),
+			'executors': [dict(x, utilization=x['busy_seconds'] / (x['lifetime_seconds'] * x['workers']) if x['lifetime_seconds'] > 0 else 0.0)
+				for x in self.executors]
+		}
+		if resource is not None:
+			scale = 1024 * 1024 if sys.platform == 'darwin' else 1024 # ru_maxrss is in bytes on macOS, KiB elsewhere
+			report['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+			report['peak_rss_children_mb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+		return report
+
+	def format_report(self):
+		"""
+		:returns: human readable report
+		"""
+		from tabulate import tabulate
+
+		report = self.get_report()
+		lines = [tabulate([[name, x['calls'], f"{x['wall_seconds']:.3f}", f"{x['cpu_seconds']:.3f}"] for name, x in report['stages'].items()],
+			headers=STATS_HEADER)]
+		lines.append(f"\nTotal: {report['wall_seconds']:.3f}s wall, {report['cpu_seconds']:.3f}s CPU (this process)")
+		for name, value in report['counters'].items():
+			if name == 'bytes_read' and report['wall_seconds'] > 0:
+				lines.append(f'{name}: {value} ({value / report["wall_seconds"] / (1024 * 1024):.1f} MB/s overall)')
+			elif isinstance(value, float): # durations such as read_seconds of the prefetch pipeline
+				lines.append(f'{name}: {value:.3f}')
+			else:
+				lines.append(f'{name}: {value}')
+		for x in report['executors']:
+			lines.append(f"Executor {x['kind']} x{x['workers']}: {x['tasks']} task(s), {x['busy_seconds']:.3f}s busy in "
+				f"{x['lifetime_seconds']:.3f}s, utilization {x['utilization']:.0%}")
+		if 'peak_rss_mb' in report:
+			lines.append(f"Peak RSS: {report['peak_rss_mb']:.1f} MB (largest worker process {report['peak_rss_children_mb']:.1f} MB)")
+		return '\n'.join(lines)
+
+def enable():
+	"""
+	Start recording statistics
+	:returns: StatsCollector
+	"""
+	global _collector
+	_collector = StatsCollector()
+	return _collector
+
+def disable():
+	global _collector
+	_collector = None
+
+def get_collector():
+	"""
+	:returns: StatsCollector, or None if statistics are disabled
+	"""
+	return _collector
+
+def is_enabled():
+	return _collector is not None
+
+def stage(name):
+	"""
+	Context manager timing a stage, does nothing when disabled
+	"""
+	if _collector is None: return _NULL_STAGE
+	return _collector.stage(name)
+
+def count(name, value=1):
+	"""
+	Add value to a named counter, does nothing when disabled
+	"""
+	if _collector is not None: _collector.add(name, value)
+
+def add_executor(kind, workers, tasks, busy, lifetime):
+	"""
+	Record the work done by an executor when it is closed
+	"""
+	if _collector is not None:
+		_collector.executors.append({'kind': kind, 'workers': workers, 'tasks': tasks, 'busy_seconds': busy, 'lifetime_seconds': lifetime})
+
+def write_json(path):
+	"""
+	Write the current statistics as JSON to path
+	"""
+	if _collector is None: return
+	with open(path, 'w') as stats_file: json.dump(_collector.get_report(), stats_file, indent=2)
@@ -1,8 +1,193 @@
+import os
+import time
 import hashlib
 import binascii
+import functools
+import itertools
+import collections
+
+from . import stats
+
+READ_SIZE = 1024 * 1024
+
+EXECUTOR_KINDS = ['auto', 'serial', 'thread', 'process']
 
 def compute_sha1(data):
 	"""
 	Computes SHA1 hash of hexlified data
 	"""
-	return hashlib.sha1(binascii.unhexlify(data)).hexdigest()
+	return compute_sha1_bytes(binascii.unhexlify(data)).hex()
+
+def compute_sha1_bytes(data):
+	"""
+	Computes binary SHA1 digest of raw data (bytes, bytearray or memoryview)
+	"""
+	return hashlib.sha1(data).digest()
+
+def hash_segments(segments):
+	"""
+	Computes binary SHA1 digest of the data described by a list of (path, offset, length) segments,
+	reading the data from disk in the calling worker. Segments without a path are padding (zeros).
+	"""
+	sha1 = hashlib.sha1()
+	for path, offset, length in segments:
+		if path is None: # padding, all zeros
+			while length > 0:
+				sha1.update(bytes(min(length, READ_SIZE)))
+				length -= READ_SIZE
+			continue
+		with open(path, 'rb') as data_file:
+			data_file.seek(offset)
+			while length > 0:
+				chunk = data_file.read(min(length, READ_SIZE))
+				if not chunk: raise ValueError(f"Unexpected end of file '{path}' at offset {offset}")
+				sha1.update(chunk)
+				length -= len(chunk)
+	return sha1.digest()
+
+def _call_chunk(func, items):
+	return [func(x) for x in items]
+
+def _timed_call(func, item):
+	started = time.perf_counter()
+	result = func(item)
+	return result, time.perf_counter() - started
+
+class SerialExecutor:
+	"""
+	Runs work units one after another in the calling thread
+	"""
+	kind = 'serial'
+
+	def __init__(self, workers=1, chunksize=1, initializer=None, initargs=()):
+		self.workers = 1
+		self.chunksize = 1
+		self._init_stats()
+		if initializer is not None: initializer(*initargs)
+
+	def _init_stats(self):
+		self._started = time.perf_counter()
+		self._tasks = 0
+		self._busy = 0.0
+
+	def map(self, func, iterable):
+		"""
+		Ordered map of func over iterable, with statistics enabled the time spent in func is measured in the workers
+		"""
+		if not stats.is_enabled(): return self._map(func, iterable)
+		return self._timed_map(func, iterable)
+
+	def _timed_map(self, func, iterable):
+		for result, busy in self._map(functools.partial(_timed_call, func), iterable):
+			self._tasks += 1
+			self._busy += busy
+			yield result
+
+	def _map(self, func, iterable):
+		return map(func, iterable)
+
+	def _record_stats(self):
+		stats.add_executor(self.kind, self.workers, self._tasks, self._busy, time.perf_counter() - self._started)
+
+	def close(self):
+		self._record_stats()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+class ThreadExecutor(SerialExecutor):
+	"""
+	Runs work units on a pool of threads. hashlib and file reads release the GIL for large buffers,
+	so this scales across cores for large pieces without any inter-process copying.
+	"""
+	kind = 'thread'
+
+	def __init__(self, workers=None, chunksize=1, initializer=None, initargs=()):
+		self.workers = workers or os.cpu_count() or 1
+		self.chunksize = 1
+		self._init_stats()
+		if initializer is not None: initializer(*initargs) # threads share the state set up by the initializer
+
+		import concurrent.futures # pool modules are only loaded when a pool is started
+		self._pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+
+	def _map(self, func, iterable):
+		"""
+		Ordered map that never submits more than a few items per worker ahead of the consumer
+		"""
+		window = 4 * self.workers
+		pending = collections.deque()
+		for item in iterable:
+			pending.append(self._pool.submit(func, item))
+			if len(pending) >= window: yield pending.popleft().result()
+		while pending: yield pending.popleft().result()
+
+	def close(self):
+		self._pool.shutdown()
+		self._record_stats()
+
+class ProcessExecutor(SerialExecutor):
+	"""
+	Runs work units on a pool of processes. Work units should be small descriptors (such as lists of
+	(path, offset, length) segments) so that workers read their own data and nothing large is pickled.
+	"""
+	kind = 'process'
+
+	def __init__(self, workers=None, chunksize=None, initializer=None, initargs=()):
+		self.workers = workers or os.cpu_count() or 1
+		self.chunksize = chunksize or 1
+		self._init_stats()
+
+		import multiprocessing
+		self._pool = multiprocessing.Pool(self.workers, initializer, initargs)
+
+	def _map(self, func, iterable):
+		"""
+		Ordered map that sends chunks of chunksize items and never submits more than a few chunks per worker ahead
+		of the consumer (Pool.imap would consume the whole iterable up front)
+		"""
+		window = 4 * self.workers
+		pending = collections.deque()
+		iterator = iter(iterable)
+		while True:
+			chunk = list(itertools.islice(iterator, self.chunksize))
+			if not chunk: break
+			pending.append(self._pool.apply_async(_call_chunk, (func, chunk)))
+			if len(pending) >= window: yield from pending.popleft().get()
+		while pending: yield from pending.popleft().get()
+
+	def close(self):
+		self._pool.close()
+		self._pool.join()
+		self._record_stats()
+
+def get_executor(kind='auto', workers=None, chunksize=None, *, piece_length=None, num_items=None, initializer=None, initargs=()):
+	"""
+	Create a hashing executor. 'auto' picks serial for a single core or little work, threads for large pieces
+	(where hashing releases the GIL and dominates per-piece overhead) and processes for small pieces.
+	initializer(*initargs) is called once in every worker process, or once in the calling process for the
+	serial and thread backends.
+	:returns: SerialExecutor, ThreadExecutor or ProcessExecutor
+	"""
+	if kind not in EXECUTOR_KINDS: raise ValueError(f"Invalid executor '{kind}', must be one of {', '.join(EXECUTOR_KINDS)}")
+
+	cores = workers or os.cpu_count() or 1
+
+	if kind == 'auto':
+		if cores == 1 or (num_items is not None and num_items < 4):
+			kind = 'serial'
+		elif piece_length is not None and piece_length >= 256 * 1024:
+			kind = 'thread'
+		else:
+			kind = 'process'
+
+	with stats.stage('pool startup'):
+		if kind == 'serial': return SerialExecutor(initializer=initializer, initargs=initargs)
+		if kind == 'thread': return ThreadExecutor(workers, initializer=initializer, initargs=initargs)
+
+		if chunksize is None:
+			chunksize = 1 if num_items is None else max(1, min(64, num_items // (cores * 16)))
+		return ProcessExecutor(workers, chunksize, initializer, initargs)
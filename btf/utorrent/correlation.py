@@ -0,0 +1,371 @@
+import os
+import socket
+import sqlite3
+import ipaddress
+
+from termcolor import cprint
+
+from ..utility import stats
+from ..utility.io import open_sink, print_table
+from ..utility.progress import progress
+from .datfile import open_dat, get_strings, iter_resume_entries, DHT_NAMES, RESUME_NAMES
+from .peers import decode_dht_nodes, decode_resume_peers, decode_compact_peers, format_ipv4, RESUME_PEER_STRUCT, COMPACT_PEER_STRUCT
+
+"""
+Correlation store of the peers found in many dht.dat and resume.dat artifacts (e.g. of several machines), to
+answer which artifacts hold a given IP, network or port. Peers are kept in SQLite with IPv4 addresses as
+integers and IPv6 addresses as 16 byte big endian blobs (128 bit integers that sort numerically), both indexed
+together with the port, so exact addresses and CIDR ranges are index range scans.
+"""
+
+PEER_QUERY_HEADER = ['Artifact', 'Label', 'Kind', 'Torrent', 'Info Hash', 'Key', 'Node ID', 'IP', 'Port']
+ARTIFACT_QUERY_HEADER = ['Artifact', 'Label', 'Kind', 'Peers', 'Distinct IPs', 'Ports']
+
+IPV4_MAPPED_PREFIX = bytes(10) + b'\xff\xff' # ::ffff:0:0/96, IPv4 peers stored in IPv6 records
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS artifacts (
+	id INTEGER PRIMARY KEY,
+	path TEXT UNIQUE NOT NULL,
+	kind TEXT NOT NULL,
+	label TEXT
+);
+CREATE TABLE IF NOT EXISTS torrents (
+	id INTEGER PRIMARY KEY,
+	artifact_id INTEGER NOT NULL REFERENCES artifacts(id),
+	name TEXT,
+	info_hash BLOB
+);
+CREATE TABLE IF NOT EXISTS peers (
+	artifact_id INTEGER NOT NULL REFERENCES artifacts(id),
+	torrent_id INTEGER REFERENCES torrents(id),
+	key TEXT NOT NULL,
+	node_id BLOB,
+	ipv4 INTEGER,
+	ipv6 BLOB,
+	port INTEGER NOT NULL
+);
+'''
+
+_INDEXES = '''
+CREATE INDEX IF NOT EXISTS peers_ipv4 ON peers(ipv4, port) WHERE ipv4 IS NOT NULL;
+CREATE INDEX IF NOT EXISTS peers_ipv6 ON peers(ipv6, port) WHERE ipv6 IS NOT NULL;
+CREATE INDEX IF NOT EXISTS peers_port ON peers(port);
+CREATE INDEX IF NOT EXISTS peers_artifact ON peers(artifact_id);
+CREATE INDEX IF NOT EXISTS torrents_artifact ON torrents(artifact_id);
+'''
+
+_DROP_INDEXES = '''
+DROP INDEX IF EXISTS peers_ipv4;
+DROP INDEX IF EXISTS peers_ipv6;
+DROP INDEX IF EXISTS peers_port;
+DROP INDEX IF EXISTS peers_artifact;
+'''
+
+_INSERT_PEER = 'INSERT INTO peers (artifact_id, torrent_id, key, node_id, ipv4, ipv6, port) VALUES (?, ?, ?, ?, ?, ?, ?)'
+
+BULK_ROWS = 500000 # loads expected to add more peers than this rebuild the peer indexes once afterwards
+
+def get_artifact_kind(path):
+	"""
+	:returns: 'dht' or 'resume' by file name, None for other files
+	"""
+	name = os.path.basename(path).lower()
+	if name in DHT_NAMES: return 'dht'
+	if name in RESUME_NAMES: return 'resume'
+	return None
+
+def iter_artifact_paths(paths):
+	"""
+	Expand a list of dht.dat/resume.dat files and folders (searched recursively) into artifact paths
+	"""
+	for path in paths:
+		if os.path.isdir(path):
+			for root, subdirectories, names in os.walk(path):
+				subdirectories.sort()
+				for name in sorted(names):
+					if get_artifact_kind(name) is not None: yield os.path.join(root, name)
+		else:
+			yield path
+
+def get_peer6_address(prefix, ipv6_port, ip):
+	"""
+	Reassemble the 16 byte address of a peers6 record from the columns of decode_resume_peers
+	:returns: tuple of (IPv4 int, None) for IPv4 mapped addresses, otherwise (None, 16 bytes)
+	"""
+	address = prefix + ipv6_port.to_bytes(2, 'little') + ip.to_bytes(4, 'big')
+	if address[:12] == IPV4_MAPPED_PREFIX: return ip, None
+	return None, address
+
+def parse_ip(text):
+	"""
+	Parse an IPv4 or IPv6 address, IPv4 mapped IPv6 addresses are IPv4
+	:returns: tuple of (IPv4 int, None) or (None, 16 bytes)
+	"""
+	try:
+		return int.from_bytes(socket.inet_pton(socket.AF_INET, text), 'big'), None
+	except OSError:
+		pass
+	try:
+		address = socket.inet_pton(socket.AF_INET6, text)
+	except OSError:
+		raise ValueError(f"Invalid IP address '{text}'")
+	if address[:12] == IPV4_MAPPED_PREFIX: return int.from_bytes(address[12:], 'big'), None
+	return None, address
+
+def format_ip(ipv4, ipv6):
+	if ipv4 is not None: return format_ipv4(ipv4)
+	return str(ipaddress.IPv6Address(ipv6))
+
+def get_address_range(network):
+	"""
+	Address range of an IP address or CIDR network, e.g. '203.0.113.0/24' or '2001:db8::/32'
+	:returns: tuple of (column, first address, last address) with column 'ipv4' or 'ipv6'
+	"""
+	try:
+		network = ipaddress.ip_network(network, strict=False)
+	except ValueError:
+		raise ValueError(f"Invalid IP address or network '{network}'")
+	if network.version == 6 and network.prefixlen >= 96 and network.network_address.ipv4_mapped is not None:
+		network = ipaddress.ip_network(f'{network.network_address.ipv4_mapped}/{network.prefixlen - 96}')
+	if network.version == 4: return 'ipv4', int(network.network_address), int(network.broadcast_address)
+	return 'ipv6', network.network_address.packed, network.broadcast_address.packed
+
+def _get_conditions(networks=None, ports=None, artifacts=None):
+	"""
+	SQL condition on the peers table (aliased p) matching any of networks and any of ports, and on the artifacts
+	table (aliased a) matching paths that contain any of artifacts
+	:returns: tuple of (condition, parameters)
+	"""
+	conditions = list()
+	parameters = list()
+	if networks:
+		ranges = list()
+		for network in networks:
+			column, first, last = get_address_range(network)
+			if first == last: ranges.append(f'p.{column} = ?')
+			else: ranges.append(f'p.{column} BETWEEN ? AND ?')
+			parameters.extend((first,) if first == last else (first, last))
+		conditions.append('(' + ' OR '.join(ranges) + ')')
+	if ports:
+		conditions.append(f'p.port IN ({", ".join("?" * len(ports))})')
+		parameters.extend(ports)
+	if artifacts:
+		conditions.append('(' + ' OR '.join('instr(a.path, ?) > 0' for _ in artifacts) + ')')
+		parameters.extend(artifacts)
+	return ' AND '.join(conditions) or '1', parameters
+
+class PeerStore:
+	"""
+	SQLite backed store of the peers of many dht.dat and resume.dat artifacts, indexed by address and port
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.connection = sqlite3.connect(path, timeout=30)
+		self.connection.execute('PRAGMA journal_mode = WAL')
+		self.connection.execute('PRAGMA synchronous = NORMAL')
+		self.connection.executescript(_SCHEMA + _INDEXES)
+
+	def close(self):
+		self.connection.execute('PRAGMA optimize') # refresh planner statistics after loads
+		self.connection.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def __len__(self):
+		return self.connection.execute('SELECT COUNT(*) FROM peers').fetchone()[0]
+
+	def get_artifact_count(self):
+		return self.connection.execute('SELECT COUNT(*) FROM artifacts').fetchone()[0]
+
+	def _add_artifact(self, path, kind, label):
+		"""
+		Register an artifact, replacing the peers of an earlier load of the same path
+		:returns: artifact id
+		"""
+		row = self.connection.execute('SELECT id FROM artifacts WHERE path = ?', (path,)).fetchone()
+		if row is None:
+			return self.connection.execute('INSERT INTO artifacts (path, kind, label) VALUES (?, ?, ?)', (path, kind, label)).lastrowid
+		self.connection.execute('DELETE FROM peers WHERE artifact_id = ?', (row[0],))
+		self.connection.execute('DELETE FROM torrents WHERE artifact_id = ?', (row[0],))
+		self.connection.execute('UPDATE artifacts SET kind = ?, label = ? WHERE id = ?', (kind, label, row[0]))
+		return row[0]
+
+	def _add_torrent(self, artifact_id, name, info_hash):
+		return self.connection.execute('INSERT INTO torrents (artifact_id, name, info_hash) VALUES (?, ?, ?)',
+			(artifact_id, name, info_hash)).lastrowid
+
+	def _insert(self, rows):
+		"""
+		Insert (artifact id, torrent id, key, node id, ipv4, ipv6, port) rows
+		:returns: number of rows
+		"""
+		with stats.stage('insert'):
+			count = self.connection.executemany(_INSERT_PEER, rows).rowcount
+		stats.count('peers_inserted', count)
+		return count
+
+	def add_dat(self, path, label=None, kind=None):
+		"""
+		Load the peers of a dht.dat (nodes key) or resume.dat (peers6 and peers keys of every torrent) file, the
+		records are decoded straight into integer rows without formatting addresses
+		:param kind: 'dht' or 'resume', by default from the file name
+		:returns: number of peers added
+		"""
+		kind = kind or get_artifact_kind(path)
+		if kind not in ('dht', 'resume'): raise ValueError(f"Unknown artifact kind of '{path}', expected dht.dat or resume.dat")
+
+		with open_dat(path) as data:
+			artifact_id = self._add_artifact(path, kind, label)
+			if kind == 'dht':
+				nodes = get_strings(data, 0, (b'nodes',)).get(b'nodes')
+				if nodes is None: raise ValueError(f"'{path}' has no nodes key")
+				columns = decode_dht_nodes(nodes)
+				return self._insert((artifact_id, None, 'nodes', node_id, ip, None, port) for node_id, ip, port in zip(*columns))
+
+			count = 0
+			for name, values in iter_resume_entries(data):
+				torrent_id = self._add_torrent(artifact_id, name, values.get(b'info'))
+				count += self._insert(self._iter_resume_rows(artifact_id, torrent_id, values))
+			return count
+
+	def _iter_resume_rows(self, artifact_id, torrent_id, values):
+		peers6 = values.get(b'peers6')
+		if peers6 and len(peers6) % RESUME_PEER_STRUCT.size == 0:
+			for prefix, ipv6_port, ip, ipv4_port in zip(*decode_resume_peers(peers6)):
+				ipv4, ipv6 = get_peer6_address(prefix, ipv6_port, ip)
+				yield artifact_id, torrent_id, 'peers6', None, ipv4, ipv6, ipv4_port
+		peers = values.get(b'peers')
+		if peers and len(peers) % COMPACT_PEER_STRUCT.size == 0:
+			for ip, port in zip(*decode_compact_peers(peers)):
+				yield artifact_id, torrent_id, 'peers', None, ip, None, port
+
+	def add_table(self, source, table, header, label=None, kind=None):
+		"""
+		Load a decoded peer table, as returned by the dht and resume modules (DHT_NODES_HEADER, RESUME_PEERS_HEADER
+		or RESUME_DAT_PEERS_HEADER), with the artifact it was decoded from as source
+		:returns: number of peers added
+		"""
+		columns = {name: i for i, name in enumerate(header)}
+		if 'IPv4' not in columns: raise ValueError('Peer table has no IPv4 column')
+		port_column = next((columns[x] for x in ('Port', 'IPv4 Port', 'Local IPv4 Port') if x in columns), None)
+		if port_column is None: raise ValueError('Peer table has no port column')
+		kind = kind or ('dht' if 'Node ID' in columns else 'resume')
+
+		artifact_id = self._add_artifact(source, kind, label)
+		torrents = dict()
+		def rows():
+			for row in table:
+				torrent_id = None
+				if 'Torrent' in columns:
+					name, info_hash = row[columns['Torrent']], row[columns['Info Hash']]
+					if (name, info_hash) not in torrents:
+						torrents[name, info_hash] = self._add_torrent(artifact_id, name, bytes.fromhex(info_hash) if info_hash else None)
+					torrent_id = torrents[name, info_hash]
+				if 'Key' in columns: key = row[columns['Key']]
+				else: key = 'nodes' if kind == 'dht' else 'peers6'
+
+				node_id = bytes.fromhex(row[columns['Node ID']]) if 'Node ID' in columns else None
+				prefix = row[columns['IPv6']] if 'IPv6' in columns else None
+				if prefix: ipv4, ipv6 = get_peer6_address(bytes.fromhex(prefix), row[columns['Local IPv6 Port']], parse_ip(row[columns['IPv4']])[0])
+				else: ipv4, ipv6 = parse_ip(row[columns['IPv4']])
+				yield artifact_id, torrent_id, key, node_id, ipv4, ipv6, row[port_column]
+		return self._insert(rows())
+
+	def add_paths(self, paths, label=None, silent=False):
+		"""
+		Load dht.dat and resume.dat files and folders searched for them in a single transaction. Large loads drop
+		the peer indexes and build them once at the end, which is much faster than updating them per row.
+		:returns: tuple of (artifacts loaded, peers added, failed) counts
+		"""
+		paths = list(iter_artifact_paths(paths))
+		expected = sum(os.path.getsize(x) for x in paths if os.path.isfile(x)) // COMPACT_PEER_STRUCT.size
+		bulk = expected > BULK_ROWS and expected > len(self)
+
+		loaded = count = failed = 0
+		if bulk: self.connection.executescript(_DROP_INDEXES)
+		try:
+			with self.connection:
+				self.connection.execute('BEGIN') # savepoints nest in it, outside a transaction each RELEASE would commit
+				for path in progress(paths, disable=silent):
+					self.connection.execute('SAVEPOINT artifact') # a failed artifact leaves nothing behind
+					try:
+						count += self.add_dat(path, label)
+						loaded += 1
+						self.connection.execute('RELEASE artifact')
+					except (OSError, ValueError, IndexError) as e: # truncated files run off the end of the map
+						self.connection.execute('ROLLBACK TO artifact')
+						self.connection.execute('RELEASE artifact')
+						if not silent: cprint(f"\tCould not load '{path}': {e}", 'red')
+						failed += 1
+		finally:
+			if bulk:
+				with stats.stage('index'): self.connection.executescript(_INDEXES)
+		return loaded, count, failed
+
+	def query(self, networks=None, ports=None, artifacts=None, limit=None):
+		"""
+		Peers with an address in any of networks (IP addresses or CIDR ranges) and any of ports, optionally only
+		those of artifacts whose path contains one of the given strings
+		:returns: generator of lists with header PEER_QUERY_HEADER
+		"""
+		condition, parameters = _get_conditions(networks, ports, artifacts)
+		sql = ('SELECT a.path, a.label, a.kind, t.name, t.info_hash, p.key, p.node_id, p.ipv4, p.ipv6, p.port FROM peers p '
+			'JOIN artifacts a ON a.id = p.artifact_id LEFT JOIN torrents t ON t.id = p.torrent_id '
+			f'WHERE {condition} ORDER BY a.path, p.rowid')
+		if limit is not None: sql += f' LIMIT {int(limit)}'
+
+		for path, label, kind, name, info_hash, key, node_id, ipv4, ipv6, port in self.connection.execute(sql, parameters):
+			yield [path, label, kind, name, info_hash.hex() if info_hash else None, key, node_id.hex() if node_id else None,
+				format_ip(ipv4, ipv6), port]
+
+	def query_artifacts(self, networks=None, ports=None, artifacts=None, limit=None):
+		"""
+		Artifacts holding a peer with an address in any of networks and any of ports, optionally only those whose
+		path contains one of artifacts
+		:returns: list of lists with header ARTIFACT_QUERY_HEADER
+		"""
+		condition, parameters = _get_conditions(networks, ports, artifacts)
+		sql = ('SELECT a.path, a.label, a.kind, COUNT(*), COUNT(DISTINCT COALESCE(p.ipv4, p.ipv6)), COUNT(DISTINCT p.port) '
+			f'FROM peers p JOIN artifacts a ON a.id = p.artifact_id WHERE {condition} GROUP BY a.id ORDER BY a.path')
+		if limit is not None: sql += f' LIMIT {int(limit)}'
+		return [list(x) for x in self.connection.execute(sql, parameters)]
+
+def _perform_peer_query(args):
+	if not args.add and not args.ip and not args.port and not args.artifact:
+		cprint('ERROR: nothing to do, use --add and/or --ip, --port or --artifact', 'red')
+		return
+
+	try:
+		for network in args.ip or (): get_address_range(network)
+	except ValueError as e:
+		cprint(f'ERROR: {e}', 'red')
+		return
+
+	with PeerStore(args.index) as store:
+		if args.add:
+			cprint(f'Loading peers into {args.index}', 'green')
+			loaded, count, failed = store.add_paths(args.add, args.label, args.silent)
+			cprint(f'Loaded {count} peer(s) from {loaded} artifact(s), {failed} failed. '
+				f'Store holds {len(store)} peer(s) from {store.get_artifact_count()} artifact(s)', 'green')
+
+		if not args.ip and not args.port and not args.artifact: return
+
+		if args.by_artifact:
+			header = ARTIFACT_QUERY_HEADER
+			with stats.stage('query'): table = store.query_artifacts(args.ip, args.port, args.artifact, args.limit)
+		else:
+			header = PEER_QUERY_HEADER
+			with stats.stage('query'): table = list(store.query(args.ip, args.port, args.artifact, args.limit))
+		stats.count('rows_found', len(table))
+
+		if args.out:
+			cprint(f'Writing {len(table)} row(s) to {args.out}', 'green')
+			with open_sink(args.out, header, format=args.format) as sink: sink.write_rows(table)
+		elif not args.silent:
+			print_table(table, header)
+		cprint(f'{len(table)} row(s) found', 'green')
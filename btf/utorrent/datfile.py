@@ -0,0 +1,65 @@
+import os
+import mmap
+import contextlib
+
+from ..utility import bencode
+
+"""
+Streaming access to bencoded uTorrent .dat files (dht.dat, resume.dat) through a read only memory map.
+Values are located by offset and only the keys asked for are copied out of the file.
+"""
+
+DHT_NAMES = ('dht.dat', 'dht.dat.old')
+RESUME_NAMES = ('resume.dat', 'resume.dat.old')
+RESUME_SKIP_KEYS = (b'.fileguard', b'rec') # top level keys of resume.dat that are not torrent entries
+
+_DIGITS = frozenset(b'0123456789')
+
+@contextlib.contextmanager
+def open_dat(path):
+	"""
+	Memory-map a .dat file
+	:returns: context manager yielding the mmap
+	"""
+	with open(path, 'rb') as dat_file:
+		if os.fstat(dat_file.fileno()).st_size == 0: raise ValueError(f"'{path}' is empty")
+		data = mmap.mmap(dat_file.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			yield data
+		finally:
+			data.close()
+
+def _get_strings(data, offset, keys):
+	found = dict()
+	end = offset + 1
+	for key, start, end in bencode.iter_dict(data, offset):
+		if key in keys and data[start] in _DIGITS:
+			payload_start, payload_end = bencode.string_span(data, start)
+			found[key] = data[payload_start:payload_end]
+	return found, end + 1
+
+def get_strings(data, offset, keys):
+	"""
+	Pull the string values of the given keys out of the bencoded dictionary at offset, all other values are skipped
+	:returns: dict of key to bytes for the keys found with string values
+	"""
+	return _get_strings(data, offset, keys)[0]
+
+def iter_resume_entries(data, keys=(b'info', b'peers6', b'peers')):
+	"""
+	Walk the torrent entries of a resume.dat buffer in one pass, each entry is only walked once
+	:returns: generator of (torrent name, dict of key to bytes for the requested string keys) tuples
+	"""
+	keys = frozenset(keys)
+	if len(data) == 0 or data[0] != ord('d'): raise bencode.BencodeError('Expected dictionary at offset 0')
+	offset = 1
+	while True:
+		if offset >= len(data): raise bencode.BencodeError('Unterminated dictionary')
+		if data[offset] == ord('e'): return
+		name_start, offset = bencode.string_span(data, offset)
+		name = data[name_start:offset]
+		if name in RESUME_SKIP_KEYS or data[offset] != ord('d'):
+			offset = bencode.skip(data, offset)
+			continue
+		values, offset = _get_strings(data, offset, keys)
+		yield name.decode('utf-8', errors='replace'), values
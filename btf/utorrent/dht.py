@@ -1,71 +1,78 @@
 import os
 import sys
 
-from tabulate import tabulate
-
-from ..utility.io import write_csv
-from ..utility.hex import ipv4_from_hex
+from ..utility import stats
+from ..utility.io import print_table, open_args_sink, write_args_table
+from .datfile import open_dat, get_strings
+from .peers import DHT_NODE_STRUCT, DHT_NODES_HEADER, DhtNodeTable, bytes_from_hex
 
 """
 Functions for parsing uTorrent dht.dat files.
 """
 
-DHT_NODES_HEADER = ['#', 'Node ID', 'IPv4', 'Port']
-
 def get_peers_from_hex(hex, silent=True):
 	"""
 	Return parsed table of IP addresses from given hex-encoded data string (from dht.dat). 
-	:returns: list of lists with header '#, Node ID, IPv4, Port'
+	:returns: DhtNodeTable, a sequence of lists with header '#, Node ID, IPv4, Port'
 	"""
-	if hex is None or len(hex) == 0:
-		raise ValueError('Error: hex cannot be empty')
-	if hex[0:2] != '0x':
-		raise ValueError('Error: hex string must start with 0x')
-	if not (len(hex) - 2) % 52 == 0:
-		raise ValueError('Error: hex string must have length multiple of 52 (excluding 0x)')
-	
+	data = bytes_from_hex(hex, DHT_NODE_STRUCT.size)
+
 	if not silent: print('\n==========================')
-	
-	nodes = list()
-	node_chunks = [hex[2:][i:i+52] for i in range(0, len(hex), 52)]
-	
-	table = list()
-	id = 1
-	for node_chunk in node_chunks:
-		if not node_chunk: continue # skip empty lines
-		
-		table.append([
-			id, 
-			node_chunk[0:40], 
-			ipv4_from_hex(node_chunk[40:48]),
-			int(node_chunk[48:52], 16)
-		])
-		
-		id += 1
-	
-	if not silent: print(tabulate(table, DHT_NODES_HEADER))
+
+	table = DhtNodeTable(data)
+
+	if not silent: print_table(table, DHT_NODES_HEADER)
 	if not silent: print('==========================\n')
 	
 	return table
 
+def get_nodes_from_dat(path, silent=True):
+	"""
+	Return parsed table of DHT nodes read directly from the nodes key of a dht.dat file
+	:returns: DhtNodeTable, a sequence of lists with header '#, Node ID, IPv4, Port'
+	"""
+	with stats.stage('read dat'), open_dat(path) as data:
+		nodes = get_strings(data, 0, (b'nodes',)).get(b'nodes')
+	if nodes is None: raise ValueError(f"'{path}' has no nodes key")
+
+	table = DhtNodeTable(nodes)
+
+	if not silent: print_table(table, DHT_NODES_HEADER)
+
+	return table
+
 def _parse_dht_nodes(args):
 	if 'csv' in args:
 		if args.csv and not os.path.isdir(args.csv): sys.exit('--csv must refer to folder')
 
-	if 'hex_str' in args and args.hex_str is not None and len(args.hex_str) != 0:
-		print("Processing hex...")
-		table = get_peers_from_hex(args.hex_str, args.silent)
-		if 'csv' in args: write_csv(os.path.join(args.csv, 'dht_peers.csv'), table, DHT_NODES_HEADER)
-	
-	if 'file' in args and args.file:
-		if not os.path.exists(args.file):
-			sys.exit('Invalid file')
-		
-		with open(args.file, 'r') as nodes_file:
-			line_count = 1
-			for line in nodes_file:
-				if line is None or len(line) == 0: continue
-				print('Processing line ' + str(line_count))
-				table = get_peers_from_hex(line.rstrip(), args.silent)
-				if 'csv' in args: write_csv(os.path.join(args.csv, f'dht_peers_{line_count}.csv'), table, DHT_NODES_HEADER)
-				line_count += 1
\ No newline at end of file
+	out = open_args_sink(args, DHT_NODES_HEADER)
+	try:
+		if 'hex_str' in args and args.hex_str is not None and len(args.hex_str) != 0:
+			print("Processing hex...")
+			table = get_peers_from_hex(args.hex_str, args.silent)
+			write_args_table(args, out, 'hex', table, 'dht_peers.csv', DHT_NODES_HEADER)
+
+		if 'dat' in args and args.dat:
+			if not os.path.exists(args.dat): sys.exit('Invalid file')
+
+			print(f'Processing {args.dat}...')
+			try:
+				table = get_nodes_from_dat(args.dat, args.silent)
+			except ValueError as e:
+				sys.exit(f'Error: {e}')
+			write_args_table(args, out, args.dat, table, 'dht_peers.csv', DHT_NODES_HEADER)
+
+		if 'file' in args and args.file:
+			if not os.path.exists(args.file):
+				sys.exit('Invalid file')
+
+			with open(args.file, 'r') as nodes_file:
+				line_count = 1
+				for line in nodes_file:
+					if line is None or len(line) == 0: continue
+					print('Processing line ' + str(line_count))
+					table = get_peers_from_hex(line.rstrip(), args.silent)
+					write_args_table(args, out, f'{args.file}:{line_count}', table, f'dht_peers_{line_count}.csv', DHT_NODES_HEADER)
+					line_count += 1
+	finally:
+		if out is not None: out.close()
@@ -0,0 +1,310 @@
+import array
+import struct
+import collections
+import collections.abc
+
+from ..utility import stats
+
+"""
+Batched decoding of compact peer records from uTorrent .dat files into columns, and compact tables of decoded
+records. Tables keep addresses and ports in arrays and node IDs and IPv6 prefixes in the raw record bytes, rows
+with formatted addresses are only built as they are read.
+"""
+
+DHT_NODES_HEADER = ['#', 'Node ID', 'IPv4', 'Port']
+RESUME_PEERS_HEADER = ['#', 'IPv6', 'Local IPv6 Port', 'IPv4', 'Local IPv4 Port']
+RESUME_DAT_PEERS_HEADER = ['#', 'Torrent', 'Info Hash', 'Key', 'IPv6', 'Local IPv6 Port', 'IPv4', 'IPv4 Port']
+
+DHT_NODE_STRUCT = struct.Struct('>20sIH') # node id, IPv4, port
+RESUME_PEER_STRUCT = struct.Struct('>10sHIH') # IPv6 prefix, local IPv6 port (little endian), IPv4, local IPv4 port (little endian)
+COMPACT_PEER_STRUCT = struct.Struct('>IH') # IPv4, port (BEP 23 compact peer list, resume.dat peers key)
+DHT_ADDRESS_STRUCT = struct.Struct('>20xIH') # the IPv4 and port of a DHT node record, skipping the node id
+RESUME_ADDRESS_STRUCT = struct.Struct('>10xHIH') # the ports and IPv4 of a peers6 record, skipping the prefix
+
+PREFIX_LENGTH = 10
+NODE_ID_LENGTH = 20
+RESUME_KEYS = ('peers6', 'peers') # key codes of ResumeDatPeerTable
+
+DhtNodeColumns = collections.namedtuple('DhtNodeColumns', ['node_ids', 'ips', 'ports'])
+ResumePeerColumns = collections.namedtuple('ResumePeerColumns', ['prefixes', 'ipv6_ports', 'ips', 'ipv4_ports'])
+CompactPeerColumns = collections.namedtuple('CompactPeerColumns', ['ips', 'ports'])
+
+def format_ipv4(value):
+	"""
+	Format an IPv4 address stored as a big endian int as a dotted quad
+	"""
+	return f'{value >> 24}.{(value >> 16) & 255}.{(value >> 8) & 255}.{value & 255}'
+
+def _check_size(data, record_size):
+	if len(data) % record_size != 0:
+		raise ValueError(f'Error: data must have length multiple of {record_size} bytes')
+
+def decode_dht_nodes(data):
+	"""
+	Decode 26 byte compact node info records (from the nodes key of dht.dat) in one pass
+	:returns: DhtNodeColumns of node ids (list of bytes), IPv4 addresses (array of 32 bit ints) and ports (array of ints)
+	"""
+	_check_size(data, DHT_NODE_STRUCT.size)
+	if len(data) == 0: return DhtNodeColumns(list(), array.array('I'), array.array('H'))
+
+	with stats.stage('decode'):
+		node_ids, ips, ports = zip(*DHT_NODE_STRUCT.iter_unpack(data))
+		columns = DhtNodeColumns(list(node_ids), array.array('I', ips), array.array('H', ports))
+	stats.count('records_decoded', len(node_ids))
+	return columns
+
+def decode_resume_peers(data):
+	"""
+	Decode 18 byte peers6 records (from resume.dat) in one pass
+	:returns: ResumePeerColumns of IPv6 prefixes (list of bytes), local IPv6 ports, IPv4 addresses and local IPv4 ports (arrays of ints)
+	"""
+	_check_size(data, RESUME_PEER_STRUCT.size)
+	if len(data) == 0: return ResumePeerColumns(list(), array.array('H'), array.array('I'), array.array('H'))
+
+	with stats.stage('decode'):
+		prefixes, ipv6_ports, ips, ipv4_ports = zip(*RESUME_PEER_STRUCT.iter_unpack(data))
+		ipv6_ports = array.array('H', ipv6_ports)
+		ipv4_ports = array.array('H', ipv4_ports)
+		ipv6_ports.byteswap() # ports are stored little endian
+		ipv4_ports.byteswap()
+	stats.count('records_decoded', len(prefixes))
+	return ResumePeerColumns(list(prefixes), ipv6_ports, array.array('I', ips), ipv4_ports)
+
+def decode_compact_peers(data):
+	"""
+	Decode 6 byte compact IPv4 peer records in one pass
+	:returns: CompactPeerColumns of IPv4 addresses and ports (arrays of ints)
+	"""
+	_check_size(data, COMPACT_PEER_STRUCT.size)
+	if len(data) == 0: return CompactPeerColumns(array.array('I'), array.array('H'))
+
+	with stats.stage('decode'):
+		ips, ports = zip(*COMPACT_PEER_STRUCT.iter_unpack(data))
+		columns = CompactPeerColumns(array.array('I', ips), array.array('H', ports))
+	stats.count('records_decoded', len(ips))
+	return columns
+
+def _unpack_columns(unpack_struct, data, typecodes):
+	"""
+	Unpack the fields of every record in data into arrays of the given typecodes
+	"""
+	if len(data) == 0: return tuple(array.array(x) for x in typecodes)
+	with stats.stage('decode'):
+		columns = tuple(array.array(typecode, x) for typecode, x in zip(typecodes, zip(*unpack_struct.iter_unpack(data))))
+	stats.count('records_decoded', len(columns[0]))
+	return columns
+
+class DhtNode:
+	"""
+	A DHT node, the IPv4 address is kept as an int and only formatted when asked for
+	"""
+	__slots__ = ('node_id', 'ip', 'port')
+
+	def __init__(self, node_id, ip, port):
+		self.node_id = node_id
+		self.ip = ip
+		self.port = port
+
+	@property
+	def ipv4(self):
+		return format_ipv4(self.ip)
+
+	def __eq__(self, other):
+		return isinstance(other, DhtNode) and (self.node_id, self.ip, self.port) == (other.node_id, other.ip, other.port)
+
+	def __repr__(self):
+		return f'DhtNode({self.node_id.hex()}, {self.ipv4}, {self.port})'
+
+class ResumePeer:
+	"""
+	A peer of a resume.dat peers6 or peers record, prefix and ipv6_port are None for peers records and torrent,
+	info_hash and key are None for records decoded from hex
+	"""
+	__slots__ = ('prefix', 'ipv6_port', 'ip', 'port', 'torrent', 'info_hash', 'key')
+
+	def __init__(self, prefix, ipv6_port, ip, port, torrent=None, info_hash=None, key=None):
+		self.prefix = prefix
+		self.ipv6_port = ipv6_port
+		self.ip = ip
+		self.port = port
+		self.torrent = torrent
+		self.info_hash = info_hash
+		self.key = key
+
+	@property
+	def ipv4(self):
+		return format_ipv4(self.ip)
+
+	def __eq__(self, other):
+		return isinstance(other, ResumePeer) and all(getattr(self, x) == getattr(other, x) for x in self.__slots__)
+
+	def __repr__(self):
+		return f'ResumePeer({self.prefix.hex() if self.prefix is not None else None}, {self.ipv6_port}, {self.ipv4}, {self.port})'
+
+class PeerTable(collections.abc.Sequence):
+	"""
+	Array backed table of decoded peer records. As a sequence it holds the rows of header (lists numbered from
+	start) that the decoding functions used to return, so it can be printed, written and compared like them;
+	records gives the records as DhtNode or ResumePeer objects instead.
+	"""
+	__slots__ = ('start',)
+	header = None
+
+	def __init__(self, start=1):
+		self.start = start
+
+	def __len__(self):
+		return len(self.ips)
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self._get_row(i) for i in range(*index.indices(len(self)))]
+		if index < 0: index += len(self)
+		if index < 0 or index >= len(self): raise IndexError('peer index out of range')
+		return self._get_row(index)
+
+	def __iter__(self):
+		return map(self._get_row, range(len(self)))
+
+	def __eq__(self, other):
+		if not isinstance(other, (list, tuple, PeerTable)) or len(self) != len(other): return False
+		return all(a == b for a, b in zip(self, other))
+
+	__hash__ = None
+
+	def __sizeof__(self):
+		return object.__sizeof__(self) + sum(getattr(self, x).__sizeof__() for x in self._columns)
+
+	def __repr__(self):
+		return f'{type(self).__name__}({len(self)} records)'
+
+	def records(self):
+		"""
+		:returns: generator of the records
+		"""
+		return map(self.get_record, range(len(self)))
+
+class DhtNodeTable(PeerTable):
+	"""
+	Table of DHT nodes from 26 byte compact node info records, rows with header DHT_NODES_HEADER
+	"""
+	__slots__ = ('data', 'ips', 'ports')
+	header = DHT_NODES_HEADER
+	_columns = __slots__
+
+	def __init__(self, data=b'', start=1):
+		super().__init__(start)
+		_check_size(data, DHT_NODE_STRUCT.size)
+		self.data = bytes(data)
+		self.ips, self.ports = _unpack_columns(DHT_ADDRESS_STRUCT, self.data, 'IH')
+
+	def get_node_id(self, index):
+		offset = index * DHT_NODE_STRUCT.size
+		return self.data[offset:offset + NODE_ID_LENGTH]
+
+	def get_record(self, index):
+		return DhtNode(self.get_node_id(index), self.ips[index], self.ports[index])
+
+	def _get_row(self, index):
+		return [self.start + index, self.get_node_id(index).hex(), format_ipv4(self.ips[index]), self.ports[index]]
+
+class ResumePeerTable(PeerTable):
+	"""
+	Table of 18 byte peers6 records decoded from hex, rows with header RESUME_PEERS_HEADER
+	"""
+	__slots__ = ('data', 'ipv6_ports', 'ips', 'ports')
+	header = RESUME_PEERS_HEADER
+	_columns = __slots__
+
+	def __init__(self, data=b'', start=1):
+		super().__init__(start)
+		_check_size(data, RESUME_PEER_STRUCT.size)
+		self.data = bytes(data)
+		self.ipv6_ports, self.ips, self.ports = _unpack_columns(RESUME_ADDRESS_STRUCT, self.data, 'HIH')
+		self.ipv6_ports.byteswap() # ports are stored little endian
+		self.ports.byteswap()
+
+	def get_prefix(self, index):
+		offset = index * RESUME_PEER_STRUCT.size
+		return self.data[offset:offset + PREFIX_LENGTH]
+
+	def get_record(self, index):
+		return ResumePeer(self.get_prefix(index), self.ipv6_ports[index], self.ips[index], self.ports[index])
+
+	def _get_row(self, index):
+		return [self.start + index, self.get_prefix(index).hex(), self.ipv6_ports[index], format_ipv4(self.ips[index]), self.ports[index]]
+
+class ResumeDatPeerTable(PeerTable):
+	"""
+	Table of the peers6 and peers records of many resume.dat torrent entries, rows with header
+	RESUME_DAT_PEERS_HEADER. The torrent of each peer is stored as an index into torrents.
+	"""
+	__slots__ = ('torrents', 'torrent_indexes', 'keys', 'prefixes', 'ipv6_ports', 'ips', 'ports')
+	header = RESUME_DAT_PEERS_HEADER
+	_columns = __slots__
+
+	def __init__(self, start=1):
+		super().__init__(start)
+		self.torrents = list() # (name, info hash hex or None)
+		self.torrent_indexes = array.array('I')
+		self.keys = array.array('B')
+		self.prefixes = bytearray()
+		self.ipv6_ports = array.array('H')
+		self.ips = array.array('I')
+		self.ports = array.array('H')
+
+	def add(self, name, info_hash, key, data):
+		"""
+		Decode and append the records of the peers6 or peers key of a torrent entry
+		:returns: number of records added
+		"""
+		if not self.torrents or self.torrents[-1] != (name, info_hash): self.torrents.append((name, info_hash))
+		if key == 'peers6':
+			columns = decode_resume_peers(data)
+			self.prefixes += b''.join(columns.prefixes)
+			self.ipv6_ports.extend(columns.ipv6_ports)
+			ports = columns.ipv4_ports
+		elif key == 'peers':
+			columns = decode_compact_peers(data)
+			self.prefixes += bytes(PREFIX_LENGTH * len(columns.ips))
+			self.ipv6_ports.frombytes(bytes(len(columns.ips) * self.ipv6_ports.itemsize))
+			ports = columns.ports
+		else:
+			raise ValueError(f"Unknown peers key '{key}'")
+		count = len(columns.ips)
+		self.torrent_indexes.extend([len(self.torrents) - 1] * count)
+		self.keys.extend([RESUME_KEYS.index(key)] * count)
+		self.ips.extend(columns.ips)
+		self.ports.extend(ports)
+		return count
+
+	def _get_fields(self, index):
+		name, info_hash = self.torrents[self.torrent_indexes[index]]
+		key = RESUME_KEYS[self.keys[index]]
+		if key == 'peers6': prefix, ipv6_port = bytes(self.prefixes[index * PREFIX_LENGTH:(index + 1) * PREFIX_LENGTH]), self.ipv6_ports[index]
+		else: prefix = ipv6_port = None
+		return name, info_hash, key, prefix, ipv6_port
+
+	def get_record(self, index):
+		name, info_hash, key, prefix, ipv6_port = self._get_fields(index)
+		return ResumePeer(prefix, ipv6_port, self.ips[index], self.ports[index], name, info_hash, key)
+
+	def _get_row(self, index):
+		name, info_hash, key, prefix, ipv6_port = self._get_fields(index)
+		return [self.start + index, name, info_hash, key, prefix.hex() if prefix is not None else None, ipv6_port,
+			format_ipv4(self.ips[index]), self.ports[index]]
+
+def bytes_from_hex(hex, record_size):
+	"""
+	Convert a 0x prefixed hex string of whole records to bytes
+	"""
+	if hex is None or len(hex) == 0:
+		raise ValueError('Error: hex cannot be empty')
+	if hex[0:2] != '0x':
+		raise ValueError('Error: hex string must start with 0x')
+	if not (len(hex) - 2) % (record_size * 2) == 0:
+		raise ValueError(f'Error: hex string must have length multiple of {record_size * 2} (excluding 0x)')
+
+	with stats.stage('unhexlify'): data = bytes.fromhex(hex[2:])
+	if len(data) * 2 != len(hex) - 2: raise ValueError('Error: hex string must not contain whitespace')
+	return data
@@ -1,73 +1,150 @@
 import os
 import sys
 
-from tabulate import tabulate
-
-from ..utility.io import write_csv
-from ..utility.hex import swap_endianness, port_from_little_endian_hex, ipv4_from_hex
+from ..utility import stats
+from ..utility.io import print_table, CsvSink, write_to_sinks, open_args_sink, write_args_table
+from .datfile import open_dat, iter_resume_entries
+from .peers import RESUME_PEER_STRUCT, COMPACT_PEER_STRUCT, RESUME_PEERS_HEADER, RESUME_DAT_PEERS_HEADER, ResumePeerTable, ResumeDatPeerTable, bytes_from_hex
 
 """
 Functions for parsing uTorrent resume.dat files.
 """
 
-RESUME_PEERS_HEADER = ['#', 'IPv6', 'Local IPv6 Port', 'IPv4', 'Local IPv4 Port']
-
 def get_peers_from_hex(hex, silent=True):
 	"""
 	Return parsed table of IP addresses from given hex-encoded data string (from resume.dat). 
-	:returns: list of lists with header '#, IPv6, Local IPv6 port, IPv4, Local IPv4 Port'
-	"""
-	if hex is None or len(hex) == 0:
-		raise ValueError('Error: hex cannot be empty')
-	if hex[0:2] != '0x':
-		raise ValueError('Error: hex string must start with 0x')
-	if not (len(hex) - 2) % 36 == 0:
-		raise ValueError('Error: hex string must have length multiple of 36 (excluding 0x)')
-	
+	:returns: ResumePeerTable, a sequence of lists with header '#, IPv6, Local IPv6 port, IPv4, Local IPv4 Port'
+	"""
+	data = bytes_from_hex(hex, RESUME_PEER_STRUCT.size)
+
 	if not silent: print('\n==========================')
-	
-	nodes = list()
-	peer_chunks = [hex[2:][i:i+36] for i in range(0, len(hex), 36)]
-	
-	table = list()
-	id = 1
-	for peer_chunk in peer_chunks:
-		if not peer_chunk: continue # skip empty lines
-				
-		table.append([
-			id, 
-			peer_chunk[0:20],
-			port_from_little_endian_hex(peer_chunk[20:24]),
-			ipv4_from_hex(peer_chunk[24:32]),
-			port_from_little_endian_hex(peer_chunk[32:36])
-		])
-		
-		id += 1
-	
-	if not silent: print(tabulate(table, RESUME_PEERS_HEADER))
+
+	table = ResumePeerTable(data)
+
+	if not silent: print_table(table, RESUME_PEERS_HEADER)
 	if not silent: print('==========================\n')
 	
 	return table
 
+def iter_peers_from_dat(data, silent=True):
+	"""
+	Decode the peers6 and compact IPv4 peers keys of every torrent entry in a resume.dat buffer in one pass.
+	Keys with a length that is not a whole number of records are reported and skipped.
+	:returns: generator of lists with header '#, Torrent, Info Hash, Key, IPv6, Local IPv6 Port, IPv4, IPv4 Port'
+	"""
+	return iter_peers_from_entries(iter_resume_entries(data), silent)
+
+def iter_peer_keys(entries, silent=True):
+	"""
+	The peers6 and peers values of (torrent name, values) entries from btf.utorrent.datfile.iter_resume_entries,
+	values that are not a whole number of records are reported and skipped
+	:returns: generator of (torrent name, info hash hex or None, key, bytes) tuples
+	"""
+	for name, values in entries:
+		info_hash = values[b'info'].hex() if b'info' in values else None
+		for key, record_size in (('peers6', RESUME_PEER_STRUCT.size), ('peers', COMPACT_PEER_STRUCT.size)):
+			data = values.get(key.encode())
+			if not data: continue
+			if len(data) % record_size != 0:
+				if not silent: print(f"Skipping {key} of '{name}': length {len(data)} is not a multiple of {record_size}")
+				continue
+			yield name, info_hash, key, data
+
+def iter_peers_from_entries(entries, silent=True):
+	"""
+	Decode the peers of (torrent name, values) entries from btf.utorrent.datfile.iter_resume_entries, one entry at a time
+	:returns: generator of lists with header '#, Torrent, Info Hash, Key, IPv6, Local IPv6 Port, IPv4, IPv4 Port'
+	"""
+	count = 1
+	for name, info_hash, key, data in iter_peer_keys(entries, silent):
+		table = ResumeDatPeerTable(count)
+		table.add(name, info_hash, key, data)
+		yield from table
+		count += len(table)
+
+def get_peer_table_from_entries(entries, silent=True):
+	"""
+	Decode the peers of (torrent name, values) entries from btf.utorrent.datfile.iter_resume_entries into one table
+	:returns: ResumeDatPeerTable, a sequence of lists with header '#, Torrent, Info Hash, Key, IPv6, Local IPv6 Port, IPv4, IPv4 Port'
+	"""
+	table = ResumeDatPeerTable()
+	for name, info_hash, key, data in iter_peer_keys(entries, silent): table.add(name, info_hash, key, data)
+	return table
+
+def get_peers_from_dat(path, silent=True):
+	"""
+	Return parsed table of peers read directly from a resume.dat file
+	:returns: ResumeDatPeerTable, a sequence of lists with header '#, Torrent, Info Hash, Key, IPv6, Local IPv6 Port, IPv4, IPv4 Port'
+	"""
+	with stats.stage('read dat'), open_dat(path) as data:
+		table = get_peer_table_from_entries(iter_resume_entries(data), silent)
+
+	if not silent: print_table(table, RESUME_DAT_PEERS_HEADER)
+
+	return table
+
+def get_resume_entry(path, info_hash, keys=(b'info', b'have', b'path', b'caption')):
+	"""
+	Find the entry of a torrent in a resume.dat file by its 20 byte (v1) info hash
+	:returns: tuple of (torrent name, dict of key to bytes for the requested keys found), or None if no entry has
+	the info hash
+	"""
+	with stats.stage('read dat'), open_dat(path) as data:
+		for name, values in iter_resume_entries(data, keys if b'info' in keys else tuple(keys) + (b'info',)):
+			if values.get(b'info') == info_hash: return name, values
+	return None
+
 def _parse_resume_peers(args):
 	if 'csv' in args:
 		if args.csv and not os.path.isdir(args.csv):
 			sys.exit('--csv must refer to folder')
 
-	if 'hex_str' in args and args.hex_str is not None and len(args.hex_str) != 0:
-		print("Processing hex...")
-		table = get_peers_from_hex(args.hex_str, args.silent)
-		if 'csv' in args: write_csv(os.path.join(args.csv, 'resume_peers.csv'), table, RESUME_PEERS_HEADER)
-	
-	if 'file' in args and args.file:
-		if not os.path.exists(args.file):
-			sys.exit('Invalid file')
-		
-		with open(args.file, 'r') as nodes_file:
-			line_count = 1
-			for line in nodes_file:
-				if line is None or len(line) == 0: continue
-				print('Processing line ' + str(line_count))
-				table = get_peers_from_hex(line.rstrip(), args.silent)
-				if 'csv' in args: write_csv(os.path.join(args.csv, f'resume_peers_{line_count}.csv'), table, RESUME_PEERS_HEADER)
-				line_count += 1
\ No newline at end of file
+	if 'dat' in args and args.dat: # rows of resume.dat carry the torrent they belong to
+		_parse_resume_dat(args)
+		return
+
+	out = open_args_sink(args, RESUME_PEERS_HEADER)
+	try:
+		if 'hex_str' in args and args.hex_str is not None and len(args.hex_str) != 0:
+			print("Processing hex...")
+			table = get_peers_from_hex(args.hex_str, args.silent)
+			write_args_table(args, out, 'hex', table, 'resume_peers.csv', RESUME_PEERS_HEADER)
+
+		if 'file' in args and args.file:
+			if not os.path.exists(args.file):
+				sys.exit('Invalid file')
+
+			with open(args.file, 'r') as nodes_file:
+				line_count = 1
+				for line in nodes_file:
+					if line is None or len(line) == 0: continue
+					print('Processing line ' + str(line_count))
+					table = get_peers_from_hex(line.rstrip(), args.silent)
+					write_args_table(args, out, f'{args.file}:{line_count}', table, f'resume_peers_{line_count}.csv', RESUME_PEERS_HEADER)
+					line_count += 1
+	finally:
+		if out is not None: out.close()
+
+def _parse_resume_dat(args):
+	"""
+	Stream the peers of a resume.dat file into the outputs, the table is only held in memory to print it
+	"""
+	if not os.path.exists(args.dat): sys.exit('Invalid file')
+
+	print(f'Processing {args.dat}...')
+	out = open_args_sink(args, RESUME_DAT_PEERS_HEADER)
+	csv_sink = CsvSink(os.path.join(args.csv, 'resume_peers.csv'), RESUME_DAT_PEERS_HEADER) if 'csv' in args and args.csv else None
+	try:
+		if out is not None: out.source = args.dat
+		with open_dat(args.dat) as data:
+			rows = iter_peers_from_dat(data, args.silent)
+			if not args.silent:
+				rows = list(rows)
+				print_table(rows, RESUME_DAT_PEERS_HEADER)
+			with stats.stage('read dat and write'): count = write_to_sinks(rows, [out, csv_sink])
+		print(f'{count} peer(s) found')
+	except ValueError as e:
+		sys.exit(f'Error: {e}')
+	finally:
+		if out is not None: out.close()
+		if csv_sink is not None: csv_sink.close()
@@ -0,0 +1,304 @@
+import os
+import collections
+import concurrent.futures
+
+from termcolor import cprint
+
+from .dht import get_nodes_from_dat, DHT_NODES_HEADER
+from .resume import get_peer_table_from_entries, RESUME_DAT_PEERS_HEADER
+from .datfile import open_dat, iter_resume_entries, DHT_NAMES, RESUME_NAMES
+from ..bittorrent import sampling
+from ..bittorrent.layout import FileLayout, V2Layout
+from ..bittorrent.metainfo import Metainfo
+from ..bittorrent.pieces import iter_layout_digests, iter_table_from_v2_layout
+from ..bittorrent.report import PieceResult
+from ..utility.io import SqliteSink
+from ..utility.progress import progress
+from ..utility.cache import PieceHashCache, get_default_cache_path
+from ..utility.threading import SerialExecutor
+
+"""
+Discovery and batch processing of every uTorrent artifact under an evidence root (such as a mounted image
+holding many user profiles) into one SQLite database per case.
+"""
+
+TORRENT_BATCH_SIZE = 64 # .torrent files parsed per job, they are too small to be worth a job each
+
+ARTIFACTS_HEADER = ['Profile', 'Kind', 'Path', 'Status', 'Records', 'Error']
+RESUME_TORRENTS_HEADER = ['Torrent', 'Info Hash', 'Path', 'Caption']
+TORRENTS_HEADER = ['Path', 'Info Hash', 'Name', 'Total Size', 'Pieces', 'Files']
+VERIFICATION_HEADER = ['Torrent', 'Info Hash', 'Content', 'Pieces', 'Pieces Checked', 'Verified', 'Failed', 'Unverifiable', 'Verdict', 'Error']
+
+Job = collections.namedtuple('Job', ['kind', 'func', 'arg', 'artifacts', 'heavy'])
+
+def discover_artifacts(root):
+	"""
+	Find dht.dat, resume.dat (and their .old backups) and .torrent files anywhere under root
+	:returns: generator of (kind, path) tuples, kind is 'dht', 'resume' or 'torrent'
+	"""
+	for directory, subdirectories, names in os.walk(root):
+		subdirectories.sort()
+		for name in sorted(names):
+			lower = name.lower()
+			if lower in DHT_NAMES: yield 'dht', os.path.join(directory, name)
+			elif lower in RESUME_NAMES: yield 'resume', os.path.join(directory, name)
+			elif lower.endswith('.torrent'): yield 'torrent', os.path.join(directory, name)
+
+def get_mounted_path(path, mount):
+	"""
+	Translate a Windows path recorded in resume.dat (such as C:\\Users\\x\\Downloads\\file) to the same path under mount
+	"""
+	path = path.replace('\\', '/')
+	if len(path) >= 2 and path[1] == ':': path = path[2:]
+	return os.path.join(mount, *[x for x in path.split('/') if x])
+
+def _scan_dht(path):
+	return get_nodes_from_dat(path)
+
+def _scan_resume(path):
+	"""
+	:returns: tuple of (list of lists with header RESUME_TORRENTS_HEADER, ResumeDatPeerTable)
+	"""
+	torrents = list()
+	def entries(data):
+		for name, values in iter_resume_entries(data, (b'info', b'peers6', b'peers', b'path', b'caption')):
+			torrents.append([
+				name,
+				values[b'info'].hex() if b'info' in values else None,
+				values[b'path'].decode('utf-8', errors='replace') if b'path' in values else None,
+				values[b'caption'].decode('utf-8', errors='replace') if b'caption' in values else None
+			])
+			yield name, values
+
+	with open_dat(path) as data:
+		peers = get_peer_table_from_entries(entries(data))
+	return torrents, peers
+
+def _scan_torrents(paths):
+	"""
+	:returns: list of (path, list with header TORRENTS_HEADER or None, error or None) tuples
+	"""
+	result = list()
+	for path in paths:
+		try:
+			metainfo = Metainfo.from_file(path)
+			result.append((path, [path, metainfo.info_hash.hex(), metainfo.name, metainfo.content_length,
+				len(metainfo.pieces or ()), len(metainfo.files)], None))
+		except (OSError, ValueError, KeyError, TypeError) as e:
+			result.append((path, None, str(e) or type(e).__name__))
+	return result
+
+def _verify_torrent(task):
+	"""
+	Piece analysis of one torrent against its content on a single worker
+	:returns: list with header VERIFICATION_HEADER
+	"""
+	torrent_path, content_path, sample, seed, cache_path = task
+	metainfo = Metainfo.from_file(torrent_path)
+	if metainfo.pieces is None and not metainfo.is_v2: raise ValueError('pieces key not found')
+	if not metainfo.is_multi_file and os.path.isdir(content_path): content_path = os.path.join(content_path, metainfo.name)
+
+	if metainfo.pieces is None: # v2 only, verified against the Merkle trees of its files
+		layout = V2Layout(metainfo, content_path)
+	else:
+		layout = FileLayout(metainfo.get_file_list(content_path), metainfo.piece_length, metainfo.padding_files)
+		if layout.num_pieces != len(metainfo.pieces):
+			raise ValueError(f'Number of pieces ({layout.num_pieces}) must match number of hashes ({len(metainfo.pieces)})')
+	verifiable = sum(1 for i in range(layout.num_pieces) if layout.is_verifiable(i))
+
+	cache = PieceHashCache(cache_path) if cache_path else None
+	try:
+		with SerialExecutor() as executor: # the scan's worker budget is spent on jobs, not within them
+			if metainfo.pieces is not None and sample is not None and verifiable > 0:
+				result = sampling.sample_layout(layout, metainfo.pieces, executor, count=sampling.get_sample_size(sample, verifiable),
+					seed=seed, silent=True, cache=cache)
+				checked, verified, verdict = result.checked, result.matched, result.verdict
+			else:
+				if metainfo.pieces is None:
+					verified = sum(1 for row in iter_table_from_v2_layout(layout, None, executor, silent=True) if row[5] is True)
+				else:
+					verified = PieceResult(metainfo.pieces).update(iter_layout_digests(layout, executor, silent=True, cache=cache)).get_counts()[0]
+				checked = verifiable
+				if verifiable == 0: verdict = sampling.INCONCLUSIVE
+				elif verified == layout.num_pieces: verdict = sampling.MATCH
+				elif verified == 0: verdict = sampling.MISMATCH
+				else: verdict = sampling.PARTIAL
+	finally:
+		if cache is not None: cache.close()
+
+	return [torrent_path, metainfo.info_hash.hex(), content_path, layout.num_pieces, checked, verified,
+		checked - verified, layout.num_pieces - verifiable, verdict, None]
+
+def run_jobs(quick, heavy, handle, *, workers=None, heavy_workers=None):
+	"""
+	Run jobs on one process pool of workers processes. At most heavy_workers heavy jobs (piece analyses) run at a
+	time, so the remaining workers keep working through the quick jobs. handle(job, result, error) is called in
+	this process as jobs finish and may add jobs to the quick and heavy deques.
+	"""
+	workers = workers or os.cpu_count() or 1
+	if heavy_workers is None: heavy_workers = max(1, workers // 2)
+	heavy_workers = max(1, min(heavy_workers, workers - 1 if workers > 1 else 1))
+
+	running = dict()
+	running_heavy = 0
+	with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+		while quick or heavy or running:
+			while len(running) < workers:
+				if heavy and running_heavy < heavy_workers: job = heavy.popleft()
+				elif quick: job = quick.popleft()
+				else: break
+				running[pool.submit(job.func, job.arg)] = job
+				running_heavy += job.heavy
+
+			done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+			for future in done:
+				job = running.pop(future)
+				running_heavy -= job.heavy
+				error = future.exception()
+				handle(job, None if error is not None else future.result(), error)
+
+class CaseScan:
+	"""
+	Scan of one evidence root. Quick jobs parse dht.dat, resume.dat and batches of .torrent files; a piece
+	analysis job is added for every torrent whose content is found at the path recorded for its info hash in a
+	resume.dat, translated to mount. All results go to one SQLite database.
+	"""
+	def __init__(self, root, out, *, mount=None, verify=True, sample=None, seed=None, cache_path=None, silent=False):
+		self.root = root
+		self.mount = mount or root
+		self.verify = verify
+		self.sample = sample
+		self.seed = seed
+		self.cache_path = cache_path
+		self.silent = silent
+
+		self.quick = collections.deque()
+		self.heavy = collections.deque()
+		self.torrent_paths = dict() # info hash to .torrent paths
+		self.content_paths = dict() # info hash to content paths from resume.dat
+		self.scheduled = set()
+		self.errors = 0
+		self.progress = None
+
+		self.sinks = dict()
+		try:
+			self.sinks['artifacts'] = SqliteSink(out, ARTIFACTS_HEADER, table='artifacts')
+			self.sinks['dht_nodes'] = SqliteSink(out, DHT_NODES_HEADER, source='', table='dht_nodes')
+			self.sinks['resume_torrents'] = SqliteSink(out, RESUME_TORRENTS_HEADER, source='', table='resume_torrents')
+			self.sinks['resume_peers'] = SqliteSink(out, RESUME_DAT_PEERS_HEADER, source='', table='resume_peers')
+			self.sinks['torrents'] = SqliteSink(out, TORRENTS_HEADER, table='torrents')
+			self.sinks['verification'] = SqliteSink(out, VERIFICATION_HEADER, table='verification')
+		except Exception:
+			self.close()
+			raise
+
+	def close(self):
+		for sink in self.sinks.values(): sink.close()
+		self.sinks.clear()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def discover(self):
+		"""
+		Queue the quick jobs for all artifacts under root
+		:returns: dict of artifact kind to count
+		"""
+		counts = collections.Counter()
+		batch = list()
+		for kind, path in discover_artifacts(self.root):
+			counts[kind] += 1
+			if kind == 'dht': self.quick.append(Job('dht', _scan_dht, path, 1, False))
+			elif kind == 'resume': self.quick.append(Job('resume', _scan_resume, path, 1, False))
+			else:
+				batch.append(path)
+				if len(batch) >= TORRENT_BATCH_SIZE:
+					self.quick.append(Job('torrent', _scan_torrents, batch, len(batch), False))
+					batch = list()
+		if batch: self.quick.append(Job('torrent', _scan_torrents, batch, len(batch), False))
+		return counts
+
+	def run(self, workers=None, heavy_workers=None):
+		total = sum(job.artifacts for job in self.quick)
+		with progress(total=total, unit='artifact', disable=self.silent) as self.progress:
+			run_jobs(self.quick, self.heavy, self.handle, workers=workers, heavy_workers=heavy_workers)
+
+	def _artifact(self, kind, path, status, records=None, error=None):
+		if error is not None: self.errors += 1
+		self.sinks['artifacts'].write([os.path.dirname(path), kind, path, status, records, error])
+
+	def handle(self, job, result, error):
+		if job.kind == 'torrent' and error is None:
+			for path, row, torrent_error in result:
+				if row is None:
+					self._artifact('torrent', path, 'error', error=torrent_error)
+					continue
+				self._artifact('torrent', path, 'ok', 1)
+				self.sinks['torrents'].write(row)
+				self.torrent_paths.setdefault(row[1], list()).append(path)
+				self._schedule(row[1])
+		elif job.kind == 'torrent':
+			for path in job.arg: self._artifact('torrent', path, 'error', error=str(error))
+		elif job.kind == 'verify' and error is not None:
+			self.errors += 1
+			self.sinks['verification'].write([job.arg[0], None, job.arg[1], None, None, None, None, None, None, str(error) or type(error).__name__])
+		elif error is not None:
+			self._artifact(job.kind, job.arg, 'error', error=str(error) or type(error).__name__)
+		elif job.kind == 'dht':
+			self.sinks['dht_nodes'].source = job.arg
+			self._artifact('dht', job.arg, 'ok', self.sinks['dht_nodes'].write_rows(result))
+		elif job.kind == 'resume':
+			torrents, peers = result
+			self.sinks['resume_torrents'].source = job.arg
+			self.sinks['resume_torrents'].write_rows(torrents)
+			self.sinks['resume_peers'].source = job.arg
+			self._artifact('resume', job.arg, 'ok', self.sinks['resume_peers'].write_rows(peers))
+			for _, info_hash, path, _ in torrents:
+				if info_hash is None or not path: continue
+				self.content_paths.setdefault(info_hash, list()).append(get_mounted_path(path, self.mount))
+				self._schedule(info_hash)
+		elif job.kind == 'verify':
+			self.sinks['verification'].write(result)
+
+		self.progress.update(job.artifacts)
+		self.progress.set_postfix(errors=self.errors, queued_analyses=len(self.heavy), refresh=False)
+
+	def _schedule(self, info_hash):
+		"""
+		Queue piece analyses once both a .torrent file and existing content are known for an info hash
+		"""
+		if not self.verify or info_hash not in self.torrent_paths or info_hash not in self.content_paths: return
+		for content_path in self.content_paths[info_hash]:
+			key = (info_hash, content_path)
+			if key in self.scheduled or not os.path.exists(content_path): continue
+			self.scheduled.add(key)
+			torrent_path = self.torrent_paths[info_hash][0]
+			self.heavy.append(Job('verify', _verify_torrent, (torrent_path, content_path, self.sample, self.seed, self.cache_path), 1, True))
+			if self.progress is not None: self.progress.total += 1
+
+def _perform_scan(args):
+	if not os.path.isdir(args.root):
+		cprint(f"ERROR: root '{args.root}' is not a directory", 'red')
+		return
+
+	cache_path = None
+	if not args.no_verify and not args.no_cache:
+		cache_path = args.cache or get_default_cache_path()
+
+	try:
+		scan = CaseScan(args.root, args.out, mount=args.mount, verify=not args.no_verify, sample=args.sample, seed=args.seed,
+			cache_path=cache_path, silent=args.silent)
+	except (OSError, ValueError) as e:
+		cprint(f'ERROR: could not open output: {e}', 'red')
+		return
+
+	with scan:
+		counts = scan.discover()
+		cprint(f"Found {counts['dht']} dht.dat, {counts['resume']} resume.dat and {counts['torrent']} .torrent file(s) under {args.root}", 'green')
+		scan.run(args.workers, args.analysis_workers)
+
+	cprint(f'Ran {len(scan.scheduled)} piece analysis job(s), {scan.errors} error(s)', 'green' if scan.errors == 0 else 'red')
+	cprint(f'Results written to {args.out}', 'green')
@@ -25,7 +25,6 @@ setup(
     packages=find_packages(where='.'),
     python_requires='>=3.3',
     install_requires=[
-        'bencode-parser',
         'colorama',
         'tqdm',
         'tabulate',